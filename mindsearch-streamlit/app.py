@@ -1,7 +1,32 @@
+import os
 import streamlit as st
-import asyncio
-import json
-from mindsearch.agent import create_model, init_agent
+from mindsearch.agent import init_agent
+from mindsearch.cancellation import CancelToken
+from mindsearch.client import stream_remote
+from mindsearch.models import MODEL_CONFIGS
+from mindsearch.registry import get_registry
+from mindsearch.streaming import AgentReturnReducer
+from mindsearch.ui import StreamRenderer, tick_every
+
+MODEL_FORMATS = list(MODEL_CONFIGS)
+# 指定すると、エージェントはこのプロセスでは動かさず mindsearch.server に任せる
+SERVER_URL = os.environ.get("MINDSEARCH_SERVER_URL", "")
+# 画面の更新は 1 秒あたりこの回数まで（間の状態はまとめて最新だけ描く）
+UI_FPS = float(os.environ.get("MINDSEARCH_UI_FPS", 10))
+
+
+def open_stream(query, lang, model_format, cancel_token):
+    if SERVER_URL:
+        return stream_remote(SERVER_URL, query, lang=lang, model_format=model_format)
+    # ウォームなモデルを使ってエージェントを初期化
+    agent = init_agent(lang=lang, model_format=model_format)
+    return agent.stream_deltas(query, cancel_token=cancel_token)
+
+# モデルはプロセス全体で保持し、起動時にバックグラウンドでロードしておく
+registry = get_registry()
+preload = os.environ.get("MINDSEARCH_PRELOAD", "")
+if preload and not SERVER_URL:
+    registry.preload([fmt.strip() for fmt in preload.split(",") if fmt.strip()])
 
 # Set page title and favicon
 st.set_page_config(
@@ -12,24 +37,39 @@ st.set_page_config(
 # Sidebar for user input and model selection
 st.sidebar.title("MindSearch")
 query = st.sidebar.text_area("質問を入力してください:", "")
-model_format = st.sidebar.selectbox("モデルを選択してください:", ["internlm_server", "internlm_client", "internlm_hf", "gpt4", "qwen"])
+model_format = st.sidebar.selectbox("モデルを選択してください:", MODEL_FORMATS)
+if not SERVER_URL:
+    st.sidebar.caption(f"モデルの状態: {registry.status(model_format)}")
 lang = st.sidebar.selectbox("言語を選択してください:", ["cn", "en"])
 if st.sidebar.button("実行"):
     if query:
         with st.spinner("Thinking..."):
-            # Initialize the selected model
-            llm = create_model(model_format)
-            agent = init_agent(llm, lang=lang)
+            # 前の質問がまだ動いていれば取り消して、サーチャーの枠を空ける
+            previous = st.session_state.get("cancel_token")
+            if previous is not None:
+                previous.cancel("superseded")
+            cancel_token = st.session_state["cancel_token"] = CancelToken()
 
             # Generate response using the agent
-            response = ""
-            references = {}
-            for agent_return in agent.stream_chat(query):
-                response = agent_return.response
-                references = agent_return.references
-                st.text_area("回答:", value=response, key="response_area")
-                st.write("参考文献:")
-                for key, value in references.items():
-                    st.write(f"{key}: {value}")
+            st.write("回答:")
+            renderer = StreamRenderer(fps=UI_FPS)
+            reducer = AgentReturnReducer()
+            # 差分が途切れても、間引いた最後の状態をフレームの間隔で描く
+            deltas = tick_every(
+                open_stream(query, lang, model_format, cancel_token),
+                renderer.throttle.interval or None)
+            try:
+                for delta in deltas:
+                    if cancel_token.cancelled:
+                        break
+                    if delta is None:
+                        renderer.flush()
+                        continue
+                    reducer.apply(delta)
+                    renderer.update(reducer.agent_return)
+            finally:
+                # 途中で止めた場合も、エージェント（またはサーバーの質問）を取り消す
+                deltas.close()
+            renderer.update(reducer.agent_return, force=True)
     else:
         st.sidebar.warning("質問を入力してください")
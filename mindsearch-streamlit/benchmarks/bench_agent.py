@@ -0,0 +1,355 @@
+"""GPU・API キーなしで MindSearch の各コンポーネントを計測するベンチマーク。
+
+使い方::
+
+    python benchmarks/bench_agent.py --output bench.json
+    python benchmarks/bench_agent.py --compare bench.json
+
+偽の LLM と検索バックエンドを使うので、結果は決定的でコミット間で比較できる。
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import queue
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lagent.schema import ActionStatusCode  # noqa: E402
+
+from fakes import (PLANNER_SCRIPT, SEARCHER_ANSWER, FakeLLM,  # noqa: E402
+                   FakeSearchClient, LocalSearchServer,
+                   install_fake_search)
+
+from mindsearch.agent import (MindSearchAgent, MindSearchProtocol,  # noqa: E402
+                              SearcherAgent, WebSearchGraph)
+from mindsearch.context_packer import ContextPacker  # noqa: E402
+from mindsearch.models import GoogleSearch  # noqa: E402
+from mindsearch.rate_limit import DailyQuota, RateLimiter  # noqa: E402
+from mindsearch.search_backend import AsyncSearchClient, run_sync  # noqa: E402
+from mindsearch.search_cache import SearchCache  # noqa: E402
+from mindsearch.streaming import (AgentReturnReducer, ResponseUpdated,  # noqa: E402
+                                  TokenAppended)
+
+QUESTION = '量子コンピュータの実用化はいつ頃になりますか？'
+
+
+def searcher_cfg(args):
+    llm = FakeLLM([SEARCHER_ANSWER],
+                  tokens_per_second=args.searcher_tps,
+                  chars_per_token=args.chars_per_token)
+    return dict(llm=llm,
+                protocol=MindSearchProtocol(meta_prompt='searcher'),
+                template=dict(input='## 質問\n{question}\n## 主題\n{topic}',
+                              context='## 過去の質問\n{question}\n## 回答\n{answer}'))
+
+
+def build_agent(args):
+    planner = FakeLLM(PLANNER_SCRIPT,
+                      tokens_per_second=args.planner_tps,
+                      chars_per_token=args.chars_per_token)
+    protocol = MindSearchProtocol(meta_prompt='planner',
+                                  response_prompt='最終回答を書いてください。')
+    return MindSearchAgent(llm=planner,
+                           searcher_cfg=searcher_cfg(args),
+                           protocol=protocol)
+
+
+def measure(run):
+    """``run`` を実行し、経過時間・最初のトークンまでの時間・ピークメモリを返す。"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    first_token = None
+    events = 0
+    for is_token in run():
+        events += 1
+        if first_token is None and is_token:
+            first_token = time.perf_counter() - start
+    total = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(total_s=total,
+                ttft_s=first_token,
+                events=events,
+                peak_mem_kb=peak / 1024)
+
+
+def bench_agent_deltas(args):
+    agent = build_agent(args)
+
+    def run():
+        for delta in agent.stream_deltas(QUESTION):
+            yield isinstance(delta, ResponseUpdated) and bool(delta.text)
+
+    return measure(run)
+
+
+def bench_agent_snapshots(args):
+    agent = build_agent(args)
+
+    def run():
+        for item in agent.stream_chat(QUESTION):
+            agent_return = item[0] if isinstance(item, tuple) else item
+            yield bool(agent_return.response)
+
+    return measure(run)
+
+
+def bench_graph(args):
+    WebSearchGraph.searcher_cfg = searcher_cfg(args)
+
+    def run():
+        graph = WebSearchGraph()
+        graph.add_root_node(QUESTION)
+        for idx in range(args.graph_nodes):
+            graph.add_node(f'n{idx}', f'{QUESTION} 観点{idx}')
+            graph.add_edge('root', f'n{idx}')
+        graph.run()
+
+        def wait():
+            graph.wait()
+            graph.searcher_resp_queue.put(graph.end_signal)
+
+        threading.Thread(target=wait, daemon=True).start()
+        while True:
+            delta = graph.searcher_resp_queue.get()
+            if delta is graph.end_signal:
+                break
+            yield isinstance(delta, TokenAppended)
+        graph.close()
+
+    return measure(run)
+
+
+def bench_searcher(args):
+    agent = SearcherAgent(**searcher_cfg(args))
+
+    def run():
+        for agent_return in agent.stream_chat(f'{QUESTION} 背景', QUESTION):
+            yield bool(agent_return.response)
+
+    return measure(run)
+
+
+def per_op(func, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number * 1e6
+
+
+def bench_overheads(args):
+    """ストリーミング 1 トークンあたりの各経路のコスト（マイクロ秒）。"""
+    reducer = AgentReturnReducer()
+    for delta in build_agent(args).stream_deltas(QUESTION):
+        reducer.apply(delta)
+    protocol = MindSearchProtocol()
+    response = PLANNER_SCRIPT[0].replace('{question}', QUESTION)
+    chunks = [
+        response[:end]
+        for end in range(args.chars_per_token, len(response),
+                         args.chars_per_token)
+    ]
+
+    def full_parse():
+        for chunk in chunks:
+            protocol.parse(chunk)
+
+    def incremental_parse():
+        parser = protocol.stream_parser()
+        for chunk in chunks:
+            parser.feed(chunk)
+
+    delta = TokenAppended('a', 'トークン', reducer.agent_return.state)
+    q = queue.Queue()
+
+    def queue_round_trip():
+        q.put(delta)
+        q.get()
+
+    return dict(
+        snapshot_deepcopy_us=per_op(lambda: deepcopy(reducer.agent_return),
+                                    200),
+        delta_apply_us=per_op(lambda: reducer.apply(delta), 20000),
+        full_parse_per_token_us=per_op(full_parse, 20) / len(chunks),
+        incremental_parse_per_token_us=per_op(incremental_parse, 20) /
+        len(chunks),
+        queue_round_trip_us=per_op(queue_round_trip, 20000),
+    )
+
+
+def bench_context(args):
+    """グラフの深さ（親ノードの数）に対するサーチャーのプロンプト長と詰め込み時間。"""
+    packer = ContextPacker(budget=args.context_tokens)
+    results = [
+        dict(title=f'結果 {idx}',
+             link=f'https://example.com/{idx}',
+             snippet=SEARCHER_ANSWER[:120]) for idx in range(5)
+    ]
+    pages = {result['link']: SEARCHER_ANSWER * 4 for result in results}
+    report = {}
+    for depth in (1, 4, 16, 64):
+        parents = [f'## 過去の質問\n観点 {idx}\n## 回答\n{SEARCHER_ANSWER}'
+                   for idx in range(depth)]
+        packed = None
+
+        def pack():
+            nonlocal packed
+            packed = packer.pack(QUESTION, parents, results, pages)
+
+        report[f'depth{depth}_pack_us'] = per_op(pack, 20)
+        report[f'depth{depth}_tokens'] = packed.stats['context_tokens']
+        report[f'depth{depth}_dropped_tokens'] = packed.stats[
+            'context_dropped_tokens']
+    return report
+
+
+def bench_coalesce(args):
+    """同じ検索を同時に投げたときに、実際に API を呼んだ回数と待ち時間。"""
+    client = FakeSearchClient(latency=max(args.search_latency, 0.05))
+    search = GoogleSearch(cache=SearchCache(max_size=0), client=client)
+    # 表記ゆれ（大文字小文字・空白）も同じ検索としてまとめられる
+    queries = [QUESTION, f' {QUESTION}  ', QUESTION.upper()]
+    threads = [
+        threading.Thread(target=search.run,
+                         args=(queries[idx % len(queries)], ))
+        for idx in range(args.concurrent_searches)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return dict(seconds=time.perf_counter() - start,
+                api_calls=client.calls,
+                **search.inflight.stats)
+
+
+def bench_rate_limit(args):
+    """クォータ（``--search-qps``）を超える検索を投げたときの成功数とスループット。
+
+    制限なし（再試行なし）と、レート制限・バックオフありを比べる。
+    """
+
+    def run(server, client):
+        search = GoogleSearch(cache=SearchCache(max_size=0), client=client)
+        returns = []
+
+        def call(idx):
+            returns.append(search.run(f'{QUESTION} {idx}'))
+
+        threads = [
+            threading.Thread(target=call, args=(idx, ))
+            for idx in range(args.rate_limit_searches)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+        ok = sum(1 for r in returns if r.state == ActionStatusCode.SUCCESS)
+        return dict(seconds=seconds,
+                    ok=ok,
+                    errors=len(returns) - ok,
+                    ok_per_s=ok / seconds,
+                    throttled=server.throttled)
+
+    report = {}
+    for name, rate, retries in (('unlimited', 1e9, 0),
+                                ('limited', args.search_qps, 4)):
+        with LocalSearchServer(qps=args.search_qps) as server:
+            client = AsyncSearchClient(api_key='bench',
+                                       search_engine_id='bench',
+                                       max_retries=retries,
+                                       limiter=RateLimiter(rate),
+                                       quota=DailyQuota(),
+                                       endpoint=server.url)
+            try:
+                for key, value in run(server, client).items():
+                    report[f'{name}_{key}'] = value
+            finally:
+                run_sync(client.close())
+    return report
+
+
+BENCHMARKS = dict(agent_deltas=bench_agent_deltas,
+                  agent_snapshots=bench_agent_snapshots,
+                  graph=bench_graph,
+                  searcher=bench_searcher,
+                  overheads=bench_overheads,
+                  context=bench_context,
+                  coalesce=bench_coalesce,
+                  rate_limit=bench_rate_limit)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(current, previous):
+    for name, result in current['results'].items():
+        before = previous.get('results', {}).get(name, {})
+        for key, value in result.items():
+            old = before.get(key)
+            if isinstance(value, (int, float)) and isinstance(
+                    old, (int, float)) and old:
+                print(f'{name}.{key}: {old:.4g} -> {value:.4g} '
+                      f'({(value - old) / old * 100:+.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS))
+    parser.add_argument('--planner-tps', type=float, default=None)
+    parser.add_argument('--searcher-tps', type=float, default=None)
+    parser.add_argument('--chars-per-token', type=int, default=2)
+    parser.add_argument('--search-latency', type=float, default=0.0)
+    parser.add_argument('--graph-nodes', type=int, default=8)
+    parser.add_argument('--context-tokens', type=int, default=3000)
+    parser.add_argument('--concurrent-searches', type=int, default=8)
+    parser.add_argument('--search-qps', type=float, default=10)
+    parser.add_argument('--rate-limit-searches', type=int, default=40)
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    parser.add_argument('--compare', help='比較対象の以前の結果 JSON')
+    args = parser.parse_args()
+
+    # 同じ質問を何度も流すので、サブ質問の回答キャッシュは使わない
+    os.environ.setdefault('MINDSEARCH_ANSWER_CACHE_SIZE', '0')
+    # 偽の検索結果の URL は実在しないので、ページ取得は bench_fetch.py で測る
+    os.environ.setdefault('MINDSEARCH_FETCH_TOP_K', '0')
+    search = install_fake_search(latency=args.search_latency)
+    results = {}
+    for name in args.only or BENCHMARKS:
+        # エージェントの進捗表示は結果の JSON と混ざらないように捨てる
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = BENCHMARKS[name](args)
+    report = dict(meta=dict(commit=git_commit(),
+                            python=platform.python_version(),
+                            timestamp=time.time(),
+                            config=vars(args),
+                            search_calls=search.calls),
+                  results=results)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
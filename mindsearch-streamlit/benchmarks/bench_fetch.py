@@ -0,0 +1,103 @@
+"""検索結果ページの取得・本文抽出をローカル HTTP サーバー相手に計測する。
+
+使い方::
+
+    python benchmarks/bench_fetch.py --output fetch.json
+    python benchmarks/bench_fetch.py --latency 0.2 --compare fetch.json
+
+外部ネットワークには接続しない。
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_agent import compare, git_commit  # noqa: E402
+from fakes import LocalPageServer  # noqa: E402
+
+from mindsearch.page_fetcher import PageCache, PageFetcher  # noqa: E402
+from mindsearch.search_backend import run_sync  # noqa: E402
+
+
+def timed(fetcher, urls):
+    start = time.perf_counter()
+    pages = run_sync(fetcher.fetch_many(urls))
+    return time.perf_counter() - start, pages
+
+
+def bench(args, server):
+    urls = [server.url(idx) for idx in range(args.pages)]
+
+    def new_fetcher():
+        # ローカルのサーバーから取得するので、プライベートアドレスを許可する
+        return PageFetcher(per_host=args.per_host,
+                           max_chars=args.max_chars,
+                           allow_private=True,
+                           cache=PageCache())
+
+    sequential = new_fetcher()
+    start = time.perf_counter()
+    for url in urls:
+        run_sync(sequential.fetch(url))
+    sequential_s = time.perf_counter() - start
+
+    server.requests.clear()
+    fetcher = new_fetcher()
+    cold_s, pages = timed(fetcher, urls)
+    cold_requests = sum(server.requests.values())
+    warm_s, _ = timed(fetcher, urls)
+    warm_requests = sum(server.requests.values()) - cold_requests
+
+    server.requests.clear()
+    duplicate_s, _ = timed(new_fetcher(), [urls[0]] * args.pages)
+    return dict(
+        sequential_s=sequential_s,
+        cold_s=cold_s,
+        warm_s=warm_s,
+        duplicate_s=duplicate_s,
+        cold_requests=cold_requests,
+        warm_requests=warm_requests,
+        duplicate_requests=sum(server.requests.values()),
+        pages_ok=sum(1 for page in pages if page and page['text']),
+        avg_text_chars=sum(len(page['text'])
+                           for page in pages if page) / max(len(pages), 1),
+        page_bytes=sum(len(part) for part in server.page(0)),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--chunk-delay', type=float, default=0.001)
+    parser.add_argument('--paragraphs', type=int, default=200)
+    parser.add_argument('--per-host', type=int, default=4)
+    parser.add_argument('--max-chars', type=int, default=4000)
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    parser.add_argument('--compare', help='比較対象の以前の結果 JSON')
+    args = parser.parse_args()
+
+    with LocalPageServer(latency=args.latency,
+                         paragraphs=args.paragraphs,
+                         chunk_delay=args.chunk_delay) as server:
+        results = dict(fetch=bench(args, server))
+    report = dict(meta=dict(commit=git_commit(),
+                            python=platform.python_version(),
+                            timestamp=time.time(),
+                            config=vars(args)),
+                  results=results)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""ローカル HF モデルの生成スループットを、逐次実行とバッチ実行で比較する。
+
+使い方::
+
+    python benchmarks/bench_generation.py --model sshleifer/tiny-gpt2 \
+        --output generation.json
+    python benchmarks/bench_generation.py --model sshleifer/tiny-gpt2 \
+        --concurrency 8 --compare generation.json
+
+``torch`` と ``transformers`` が必要。
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_agent import compare, git_commit  # noqa: E402
+
+from mindsearch.batch_generation import BatchedGenerationService  # noqa: E402
+
+PROMPT = '以下の質問に答えてください: {idx} 番目のサブ質問について調べた結果'
+
+
+def run_callers(service, args):
+    tokens = [0] * args.concurrency
+    first_token = [None] * args.concurrency
+
+    def caller(idx):
+        start = time.perf_counter()
+        for _, text in service.stream(PROMPT.format(idx=idx),
+                                      max_new_tokens=args.max_new_tokens,
+                                      temperature=0):
+            if first_token[idx] is None:
+                first_token[idx] = time.perf_counter() - start
+        tokens[idx] = len(service.tokenizer(text)['input_ids'])
+
+    threads = [
+        threading.Thread(target=caller, args=(idx, ))
+        for idx in range(args.concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    return dict(seconds=seconds,
+                tokens=sum(tokens),
+                tokens_per_s=sum(tokens) / seconds,
+                avg_first_token_s=sum(first_token) / len(first_token))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--max-new-tokens', type=int, default=64)
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    parser.add_argument('--compare', help='比較対象の以前の結果 JSON')
+    args = parser.parse_args()
+
+    # バッチサイズ 1 は以前の 1 リクエストずつの生成に相当する
+    sequential = BatchedGenerationService.from_pretrained(args.model,
+                                                          max_batch_size=1)
+    batched = BatchedGenerationService(sequential.model,
+                                       sequential.tokenizer,
+                                       max_batch_size=args.concurrency)
+    results = dict(sequential=run_callers(sequential, args),
+                   batched=dict(run_callers(batched, args),
+                                **batched.stats()))
+    report = dict(meta=dict(commit=git_commit(),
+                            python=platform.python_version(),
+                            timestamp=time.time(),
+                            config=vars(args)),
+                  results=results)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
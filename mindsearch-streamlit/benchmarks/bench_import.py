@@ -0,0 +1,109 @@
+"""パッケージの import と各 LLM バックエンドの読み込みにかかる時間を計測する。
+
+使い方::
+
+    python benchmarks/bench_import.py --output import.json
+    python benchmarks/bench_import.py --compare import.json
+
+計測ごとに新しいインタープリターを起動し、インタープリター自体の起動時間を
+除いた import の時間と、新たに読み込まれたモジュール数を中央値で報告する。
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_agent import compare, git_commit  # noqa: E402
+
+from mindsearch.models import MODEL_CONFIGS  # noqa: E402
+
+HEAVY_MODULES = ['torch', 'transformers', 'lmdeploy', 'openai', 'lagent.llms']
+
+CHILD = '''
+import json, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+error = None
+try:
+{statement}
+except Exception as exc:
+    error = repr(exc)
+seconds = time.perf_counter() - start
+print(json.dumps(dict(seconds=seconds,
+                      modules=len(set(sys.modules) - before),
+                      heavy=[m for m in {heavy!r} if m in sys.modules],
+                      error=error)))
+'''
+
+
+def scenarios():
+    cases = dict(
+        package='import mindsearch',
+        models='import mindsearch.models',
+        agent='import mindsearch.agent',
+    )
+    for model_format in MODEL_CONFIGS:
+        cases[f'backend_{model_format}'] = (
+            'import mindsearch.models as m\n'
+            f'm.load_backend({model_format!r})')
+    # 以前のように全バックエンドを読み込んだ場合の比較用
+    cases['all_backends'] = ('import mindsearch.models as m\n'
+                             'for f in m.MODEL_CONFIGS:\n'
+                             '    m.load_backend(f)')
+    return cases
+
+
+def measure(statement, repeat):
+    code = CHILD.format(statement='\n'.join(
+        '    ' + line for line in statement.splitlines()),
+                        heavy=HEAVY_MODULES)
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code],
+                                cwd=ROOT,
+                                capture_output=True,
+                                text=True,
+                                check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return dict(seconds=statistics.median(run['seconds'] for run in runs),
+                modules=statistics.median(run['modules'] for run in runs),
+                heavy=runs[-1]['heavy'],
+                error=runs[-1]['error'])
+
+
+def main():
+    cases = scenarios()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', nargs='*', choices=list(cases))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    parser.add_argument('--compare', help='比較対象の以前の結果 JSON')
+    args = parser.parse_args()
+
+    results = {
+        name: measure(cases[name], args.repeat)
+        for name in args.only or cases
+    }
+    report = dict(meta=dict(commit=git_commit(),
+                            python=platform.python_version(),
+                            timestamp=time.time(),
+                            config=vars(args)),
+                  results=results)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""セッションを何百件もメモリに置いたときの 1 セッションあたりのメモリ量。
+
+使い方::
+
+    python benchmarks/bench_memory.py --sessions 200 --output memory.json
+    python benchmarks/bench_memory.py --compare memory.json
+
+偽の LLM と検索バックエンドで質問を 1 件ずつ解き、エージェント（検索グラフを
+含む）と最終状態のスナップショットを残したまま次のセッションに進む。全部を
+解き終えたあとの RSS と tracemalloc の増分をセッション数で割って報告する。
+"""
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_agent import (QUESTION, build_agent, compare, git_commit,  # noqa: E402
+                         per_op)
+from fakes import install_fake_search  # noqa: E402
+
+from mindsearch.context_packer import _terms, get_token_counter  # noqa: E402
+
+
+def rss_bytes():
+    """現在の RSS（バイト）。``/proc`` がない環境では ``None``。"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def run_session(args, idx):
+    agent = build_agent(args)
+    agent_return = None
+    for item in agent.stream_chat(f'{QUESTION} ({idx})'):
+        agent_return = item[0] if isinstance(item, tuple) else item
+    return agent, agent_return
+
+
+def build_sessions(args, count):
+    sessions = [run_session(args, idx) for idx in range(count)]
+    # トークン数・語の頻度はプロセス共有の上限付きキャッシュなので、
+    # セッションの分に数えない
+    get_token_counter().count.cache_clear()
+    _terms.cache_clear()
+    gc.collect()
+    return sessions
+
+
+def bench_sessions(args):
+    build_sessions(args, 2)  # import や共有オブジェクトの初期化を除く
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    sessions = build_sessions(args, args.sessions)
+    seconds = time.perf_counter() - start
+    rss_after = rss_bytes()
+    del sessions
+    gc.collect()
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    sessions = build_sessions(args, args.traced_sessions)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    agent, agent_return = sessions[-1]
+    graph = agent.local_dict['graph']
+    return dict(
+        sessions=args.sessions,
+        build_s=seconds,
+        rss_per_session_kb=(rss_after - rss_before) / args.sessions / 1024
+        if rss_before is not None else None,
+        traced_per_session_kb=(after - before) / args.traced_sessions / 1024,
+        nodes_per_session=len(graph.nodes),
+        edges_per_session=sum(len(e) for e in graph.adjacency_list.values()),
+    ), agent_return
+
+
+def bench_snapshot(agent_return):
+    """解き終えたセッションの状態を 1 回 ``deepcopy`` するコスト。"""
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    copy = deepcopy(agent_return)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del copy
+    return dict(deepcopy_us=per_op(lambda: deepcopy(agent_return), 200),
+                deepcopy_kb=(after - before) / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--traced-sessions', type=int, default=50,
+                        help='tracemalloc で測るセッション数（遅いので少なめ）')
+    parser.add_argument('--planner-tps', type=float, default=None)
+    parser.add_argument('--searcher-tps', type=float, default=None)
+    parser.add_argument('--chars-per-token', type=int, default=2)
+    parser.add_argument('--search-latency', type=float, default=0.0)
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    parser.add_argument('--compare', help='比較対象の以前の結果 JSON')
+    args = parser.parse_args()
+
+    # セッションごとに質問が違うのでキャッシュは効かないが、測る対象から外す
+    os.environ.setdefault('MINDSEARCH_ANSWER_CACHE_SIZE', '0')
+    os.environ.setdefault('MINDSEARCH_FETCH_TOP_K', '0')
+    install_fake_search(latency=args.search_latency)
+    # エージェントの進捗表示は捨てる（溜めるとメモリの計測に混ざる）
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        sessions, agent_return = bench_sessions(args)
+        results = dict(sessions=sessions,
+                       snapshot=bench_snapshot(agent_return))
+    report = dict(meta=dict(commit=git_commit(),
+                            python=platform.python_version(),
+                            timestamp=time.time(),
+                            config=vars(args)),
+                  results=results)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""記録した実行（``mindsearch.replay``）を再生してエンジンの処理時間を計測する。
+
+使い方::
+
+    python benchmarks/bench_replay.py --log runs.jsonl.gz --output replay.json
+    python benchmarks/bench_replay.py --log runs.jsonl.gz --compare replay.json
+
+``--log`` を省略すると偽の LLM と検索バックエンドで 1 回記録してから再生する。
+できるだけ速く再生した時間は LLM・検索の待ち時間を含まないので、エンジン
+（パース・グラフ・ストリーミング）自体の変更の比較に使える。
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_agent import QUESTION, build_agent, compare, git_commit  # noqa: E402
+from fakes import install_fake_search  # noqa: E402
+
+from mindsearch.page_fetcher import PageCache, PageFetcher  # noqa: E402
+from mindsearch.replay import (RunLog, final_state, record_run,  # noqa: E402
+                               replay_run)
+from mindsearch.search_backend import run_sync  # noqa: E402
+
+
+def build_offline_agent(args, fetcher):
+    agent = build_agent(args)
+    agent.searcher_cfg['page_fetcher'] = fetcher
+    return agent
+
+
+def record_fake_run(args, path, fetcher):
+    install_fake_search(latency=args.search_latency)
+    for _ in record_run(build_offline_agent(args, fetcher), QUESTION, path):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', help='再生する記録。省略すると偽のエージェントで記録する')
+    parser.add_argument('--run', type=int, default=-1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--realtime', action='store_true',
+                        help='記録どおりの速さでも 1 回再生する')
+    parser.add_argument('--planner-tps', type=float, default=200)
+    parser.add_argument('--searcher-tps', type=float, default=200)
+    parser.add_argument('--chars-per-token', type=int, default=2)
+    parser.add_argument('--search-latency', type=float, default=0.05)
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    parser.add_argument('--compare', help='比較対象の以前の結果 JSON')
+    args = parser.parse_args()
+
+    # 偽の検索結果の URL は実在しないので、ページは取得しない
+    fetcher = PageFetcher(top_k=0, cache=PageCache())
+    try:
+        run(args, fetcher)
+    finally:
+        run_sync(fetcher.close())
+
+
+def run(args, fetcher):
+    path = args.log
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), 'run.jsonl.gz')
+        record_fake_run(args, path, fetcher)
+    log = RunLog.load(path, args.run)
+    # 記録時と同じプロンプト設定のエージェント（LLM は再生用に差し替わる）
+    factory = None if args.log else (
+        lambda _: build_offline_agent(args, fetcher))
+    expected = final_state(log.deltas)
+
+    def replay(speed):
+        start = time.perf_counter()
+        deltas = list(
+            replay_run(path, speed=speed, agent_factory=factory, log=log))
+        return time.perf_counter() - start, final_state(deltas) == expected
+
+    runs = [replay(None) for _ in range(args.repeat)]
+    results = dict(replay=dict(recorded_s=log.seconds,
+                               fastest_s=min(s for s, _ in runs),
+                               median_s=statistics.median(s for s, _ in runs),
+                               matches=all(ok for _, ok in runs),
+                               log_bytes=os.path.getsize(path),
+                               records=len(log.records)))
+    if args.realtime:
+        seconds, ok = replay(1.0)
+        results['replay'].update(realtime_s=seconds, realtime_matches=ok)
+    report = dict(meta=dict(commit=git_commit(),
+                            python=platform.python_version(),
+                            timestamp=time.time(),
+                            config=vars(args)),
+                  results=results)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
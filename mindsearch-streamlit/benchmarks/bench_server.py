@@ -0,0 +1,141 @@
+"""``mindsearch.server`` の SSE API に同時に質問を投げる負荷試験。
+
+使い方::
+
+    python benchmarks/bench_server.py --clients 1 8 32 --output server.json
+    python benchmarks/bench_server.py --max-queries 16 --compare server.json
+
+偽の LLM と検索バックエンドを使うエージェントでローカルにサーバーを起動し、
+同時接続数ごとに最初の差分までの時間・完了までの時間・断られた数を計測する。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import threading
+import time
+
+import aiohttp
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_agent import build_agent, compare, git_commit  # noqa: E402
+from fakes import install_fake_search  # noqa: E402
+
+from mindsearch.server import QueryServer, create_app  # noqa: E402
+
+QUESTION = '量子コンピュータの実用化はいつ頃になりますか？'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args):
+    server = QueryServer(lambda request: build_agent(args),
+                         max_queries=args.max_queries,
+                         max_pending=args.max_pending)
+    config = uvicorn.Config(create_app(server=server),
+                            host='127.0.0.1',
+                            port=free_port(),
+                            log_level='warning')
+    uvicorn_server = uvicorn.Server(config)
+    threading.Thread(target=uvicorn_server.run, daemon=True).start()
+    while not uvicorn_server.started:
+        time.sleep(0.01)
+    return f'http://127.0.0.1:{config.port}', server
+
+
+async def one_query(session, url, idx):
+    start = time.perf_counter()
+    first, deltas = None, 0
+    async with session.post(f'{url}/solve',
+                            json=dict(query=f'{QUESTION} {idx}')) as resp:
+        if resp.status == 503:
+            return None
+        resp.raise_for_status()
+        async for line in resp.content:
+            if line.startswith(b'event: delta'):
+                deltas += 1
+                if first is None:
+                    first = time.perf_counter() - start
+            elif line.startswith(b'event: done'):
+                break
+    return dict(first_delta_s=first,
+                total_s=time.perf_counter() - start,
+                deltas=deltas)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+async def run_level(url, clients):
+    timeout = aiohttp.ClientTimeout(total=None)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout,
+                                     connector=connector) as session:
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(one_query(session, url, idx) for idx in range(clients)))
+        seconds = time.perf_counter() - start
+    done = [r for r in results if r is not None]
+    first = [r['first_delta_s'] for r in done if r['first_delta_s']]
+    total = [r['total_s'] for r in done]
+    return dict(seconds=seconds,
+                completed=len(done),
+                rejected=len(results) - len(done),
+                queries_per_s=len(done) / seconds,
+                first_delta_p50_s=percentile(first, 0.5),
+                first_delta_p95_s=percentile(first, 0.95),
+                total_p50_s=percentile(total, 0.5),
+                total_p95_s=percentile(total, 0.95),
+                deltas_per_query=statistics.mean(r['deltas'] for r in done)
+                if done else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--max-queries', type=int, default=8)
+    parser.add_argument('--max-pending', type=int, default=32)
+    parser.add_argument('--planner-tps', type=float, default=500)
+    parser.add_argument('--searcher-tps', type=float, default=500)
+    parser.add_argument('--chars-per-token', type=int, default=2)
+    parser.add_argument('--search-latency', type=float, default=0.05)
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    parser.add_argument('--compare', help='比較対象の以前の結果 JSON')
+    args = parser.parse_args()
+
+    install_fake_search(latency=args.search_latency)
+    url, server = start_server(args)
+    results = {}
+    for clients in args.clients:
+        results[f'clients{clients}'] = asyncio.run(run_level(url, clients))
+    results['server'] = server.stats()
+    report = dict(meta=dict(commit=git_commit(),
+                            python=platform.python_version(),
+                            timestamp=time.time(),
+                            config=vars(args)),
+                  results=results)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import asyncio
+import json
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from lagent.actions import ActionExecutor
+from lagent.schema import ModelStatusCode
+
+from mindsearch import models
+from mindsearch.models import GoogleSearch
+from mindsearch.search_cache import SearchCache
+
+PLANNER_SCRIPT = [
+    '検索グラフを作成します。<|action_start|><|interpreter|>```python\n'
+    'graph = WebSearchGraph()\n'
+    'graph.add_root_node(node_content="{question}", node_name="root")\n'
+    'graph.add_node(node_name="a", node_content="{question} の背景は?")\n'
+    'graph.add_edge(start_node="root", end_node="a")\n'
+    'graph.add_node(node_name="b", node_content="{question} の現状は?")\n'
+    'graph.add_edge(start_node="root", end_node="b")\n'
+    'graph.add_node(node_name="c", node_content="{question} の今後は?")\n'
+    'graph.add_edge(start_node="a", end_node="c")\n'
+    'graph.add_edge(start_node="b", end_node="c")\n'
+    'graph.node("a"), graph.node("b"), graph.node("c")\n'
+    '```<|action_end|>\n',
+    '回答をまとめます。<|action_start|><|interpreter|>```python\n'
+    'graph.add_response_node(node_name="response")\n'
+    '```<|action_end|>\n',
+    '{question} についての最終回答です。' + '詳細な説明が続きます。' * 40 +
+    '[[0]][[1]]',
+]
+
+SEARCHER_ANSWER = ('検索結果によると、' + '関連する事実が述べられています。' * 30 +
+                   '[[0]]')
+
+
+class FakeLLM:
+    """台本どおりのテキストを一定のトークンレートでストリーミングする LLM。
+
+    ``script`` の各要素を 1 回の ``stream_chat`` で 1 つずつ返し、最後の要素を
+    使い切った後は最後の要素を繰り返す。``{question}`` は最初のユーザー発話に
+    置き換える。
+    """
+
+    def __init__(self,
+                 script: List[str],
+                 tokens_per_second: Optional[float] = None,
+                 chars_per_token: int = 2,
+                 first_token_latency: float = 0.0):
+        self.script = script
+        self.tokens_per_second = tokens_per_second
+        self.chars_per_token = chars_per_token
+        self.first_token_latency = first_token_latency
+        self.calls = 0
+
+    def _question(self, inputs):
+        for message in inputs:
+            if message.get('role') == 'user':
+                return message['content'].split('\n')[0]
+        return ''
+
+    def stream_chat(self, inputs, session_id=0, **kwargs):
+        text = self.script[min(self.calls, len(self.script) - 1)]
+        self.calls += 1
+        text = text.replace('{question}', self._question(inputs))
+        delay = 1 / self.tokens_per_second if self.tokens_per_second else 0
+        time.sleep(self.first_token_latency)
+        for end in range(self.chars_per_token,
+                         len(text) + self.chars_per_token,
+                         self.chars_per_token):
+            if delay:
+                time.sleep(delay)
+            yield ModelStatusCode.STREAM_ING, text[:end], None
+        yield ModelStatusCode.END, text, None
+
+
+class FakeSearchClient:
+    """``AsyncSearchClient`` と同じインターフェースで固定の結果を返す。"""
+
+    def __init__(self, latency: float = 0.0, num_items: int = 5):
+        self.latency = latency
+        self.num_items = num_items
+        self.calls = 0
+
+    async def search(self, query: str, num_results: int = 5):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return [
+            dict(title=f'{query} {idx}',
+                 link=f'https://example.com/{idx}',
+                 snippet=f'{query} に関する概要 {idx}')
+            for idx in range(min(num_results, self.num_items))
+        ]
+
+
+class LocalPageServer:
+    """ページ取得を試すためのローカル HTTP サーバー。
+
+    ``/page/<n>`` でナビゲーションやスクリプトを含む HTML を返す。本文は
+    ``chunk_delay`` 秒ごとに少しずつ送るので、ストリーミング抽出と途中での
+    打ち切りを確認できる。パスごとのリクエスト数を ``requests`` に数える。
+    """
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 paragraphs: int = 200,
+                 chunk_delay: float = 0.0):
+        self.latency = latency
+        self.paragraphs = paragraphs
+        self.chunk_delay = chunk_delay
+        self.requests = Counter()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                           self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def url(self, idx: int) -> str:
+        return f'{self.base_url}/page/{idx}'
+
+    def page(self, idx: int) -> List[bytes]:
+        head = ('<html><head><title>ページ {idx}</title>'
+                '<script>var tracking = "x".repeat(1000);</script></head>'
+                '<body><nav><a href="/">ホーム</a><a href="/a">一覧</a></nav>'
+                '<article>').format(idx=idx)
+        body = [
+            f'<p>ページ {idx} の段落 {n}。検索結果の本文として使われる'
+            f'十分な長さのテキストです。</p>' for n in range(self.paragraphs)
+        ]
+        tail = '</article><footer>著作権表示</footer></body></html>'
+        return [part.encode('utf-8') for part in [head] + body + [tail]]
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                server.requests[self.path] += 1
+                time.sleep(server.latency)
+                if not self.path.startswith('/page/'):
+                    self.send_error(404)
+                    return
+                parts = server.page(int(self.path.rsplit('/', 1)[-1]))
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length',
+                                 str(sum(len(part) for part in parts)))
+                self.end_headers()
+                try:
+                    for part in parts:
+                        self.wfile.write(part)
+                        if server.chunk_delay:
+                            self.wfile.flush()
+                            time.sleep(server.chunk_delay)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class LocalSearchServer:
+    """Custom Search JSON API を真似たローカル HTTP サーバー。
+
+    直近 1 秒のリクエストが ``qps`` を超えると 429 を返す。成功・拒否の
+    回数を ``served`` と ``throttled`` に数える。
+    """
+
+    def __init__(self, qps: float = 10, latency: float = 0.0):
+        self.qps = qps
+        self.latency = latency
+        self.served = 0
+        self.throttled = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                           self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/customsearch/v1'
+
+    def _admit(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] >= 1:
+                self._recent.popleft()
+            if len(self._recent) >= self.qps:
+                self.throttled += 1
+                return False
+            self._recent.append(now)
+            self.served += 1
+            return True
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if not server._admit():
+                    self.send_error(429)
+                    return
+                time.sleep(server.latency)
+                body = json.dumps(dict(items=[
+                    dict(title=f'結果 {idx}',
+                         link=f'https://example.com/{idx}',
+                         snippet=f'概要 {idx}') for idx in range(5)
+                ])).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def install_fake_search(latency: float = 0.0,
+                        cache: bool = False) -> FakeSearchClient:
+    """共有の action executor の検索アクションを遅延付きの偽物に差し替える。"""
+    client = FakeSearchClient(latency=latency)
+    search_cache = SearchCache(max_size=1024 if cache else 0)
+    executor = ActionExecutor(
+        actions=[GoogleSearch(cache=search_cache, client=client)])
+    models.global_action_executor = executor
+    return client
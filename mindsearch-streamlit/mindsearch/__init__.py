@@ -1,4 +1,11 @@
+import importlib
 
-from . import agent
-from . import models
-from . import mindsearch_prompt
+# サブモジュールは参照されたときに読み込む。``import mindsearch`` だけで
+# LLM バックエンドやプロンプトまで読み込まないようにするため。
+__all__ = ['agent', 'models', 'mindsearch_prompt']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
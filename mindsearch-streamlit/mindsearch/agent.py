@@ -1,26 +1,43 @@
 from . import models
 from . import mindsearch_prompt
 
-import asyncio
+import concurrent.futures
+import hashlib
+import itertools
 import json
 import logging
+import os
 import queue
-import random
 import re
 import threading
+import time
 import uuid
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from copy import deepcopy
-from dataclasses import asdict
+from functools import partial
 from typing import Dict, List, Optional
 
 from lagent.actions import ActionExecutor
 from lagent.agents import BaseAgent, Internlm2Agent
 from lagent.agents.internlm2_agent import Internlm2Protocol
-from lagent.schema import AgentReturn, AgentStatusCode, ModelStatusCode
+from lagent.schema import (ActionStatusCode, AgentReturn, AgentStatusCode,
+                           ModelStatusCode)
 from termcolor import colored
 
+from .cancellation import CancelToken
+from .context_packer import ContextPacker
+from .deadline import Deadline, current_deadline
+from .graph_index import FINISHED, RUNNING, Edge, GraphIndex, Node
+from .page_fetcher import get_page_fetcher
+from .scheduler import get_scheduler
+from .search_backend import run_sync
+from .search_cache import get_answer_cache
+from .session import get_session_manager
+from .tracing import tracer
+from .streaming import (AgentReturnReducer, BudgetReported, EdgeAdded,
+                        NodeAdded, NodeFinished, ReferencesUpdated,
+                        ResponseUpdated, StateChanged, StepsUpdated,
+                        TokenAppended)
+
 # ... (rest of the imports)
 
 logging.basicConfig(level=logging.INFO)
@@ -30,48 +47,251 @@ from lagent.schema import ActionReturn
 
 class SearcherAgent(Internlm2Agent):
 
-    def __init__(self, template='{query}', **kwargs) -> None:
+    def __init__(self,
+                 template='{query}',
+                 context_budget=None,
+                 action_executor=None,
+                 page_fetcher=None,
+                 **kwargs) -> None:
         super().__init__(**kwargs)
         self.template = template
-        # models.pyから更新されたget_action_executor()を使用
-        self.action_executor = models.get_action_executor()
+        # 親ノードの回答と検索結果はこのトークン数までに詰めて渡す
+        if context_budget is None:
+            context_budget = int(
+                os.environ.get('MINDSEARCH_CONTEXT_TOKENS', 3000))
+        self.context_packer = ContextPacker(budget=context_budget)
+        # 指定がなければプロセス共有の検索アクションとページ取得を使う
+        self.action_executor = (action_executor if action_executor is not None
+                                else models.get_action_executor())
+        self.page_fetcher = page_fetcher
 
     def stream_chat(self,
                     question: str,
                     root_question: str = None,
                     parent_response: List[dict] = None,
+                    cancel_token: Optional[CancelToken] = None,
                     **kwargs) -> AgentReturn:
+        cancel_token = cancel_token or CancelToken()
         message = self.template['input'].format(question=question,
                                                 topic=root_question)
+        parents = []
         if parent_response:
             if 'context' in self.template:
-                parent_response = [
+                parents = [
                     self.template['context'].format(**item)
                     for item in parent_response
                 ]
-                message = '\n'.join(parent_response + [message])
         print(colored(f'現在のクエリ: {message}', 'green'))
         
         # action_executorを使用してGoogle検索を実行
-        search_action_return: ActionReturn = self.action_executor.execute_action("GoogleSearch", message)
-        if search_action_return.status == ActionStatusCode.SUCCESS:
+        if cancel_token.cancelled:
+            return
+        search_action_return: ActionReturn = self.action_executor(
+            'google_search', dict(query='\n'.join(parents + [message])))
+        search_results, pages = [], {}
+        if search_action_return.state == ActionStatusCode.SUCCESS:
             search_results = json.loads(search_action_return.result[0]['content'])
-            context = "\n".join([f"タイトル: {result['title']}\nURL: {result['link']}\n概要: {result['snippet']}\n" for result in search_results])
-        else:
-            context = "検索結果がありません。"
+            # スニペットだけでは足りないので、上位ページの本文も渡す
+            pages = self._fetch_pages(search_results, cancel_token)
 
-                        
+        # 親ノードの回答と検索結果は、サブ質問に関係の深いものから予算内で詰める
+        packed = self.context_packer.pack(question, parents, search_results,
+                                          pages)
+        if packed.stats['context_dropped_tokens']:
+            logger.info(f'Packed context for {question!r}: {packed.stats}')
+        message = '\n'.join(packed.parents + [message])
+        context = packed.context or "検索結果がありません。"
         
         # 検索結果をコンテキストとして追加
         message_with_context = f"{message}\n\nSearch Results:\n{context}"
         
-        for agent_return in super().stream_chat(message_with_context,
-                                                session_id=random.randint(0, 999999),
-                                                **kwargs):
-            agent_return.type = 'searcher'
-            agent_return.content = question
-            yield deepcopy(agent_return)
+        # 1 回で終わる生成なので、衝突しない ID だけを払い出す（グループは統計用）
+        prefix = self._protocol.prompt_prefix(self._action_executor)
+        span = tracer.start_span('searcher_llm',
+                                 question=question,
+                                 **packed.stats)
+        deadline, started = current_deadline(), time.monotonic()
+        try:
+            with get_session_manager().session(f'searcher:{prefix.digest}',
+                                               self._llm) as session_id:
+                for agent_return in super().stream_chat(message_with_context,
+                                                        session_id=session_id,
+                                                        **kwargs):
+                    # キャンセルされたら生成を打ち切る（ジェネレーターは破棄される）
+                    if cancel_token.cancelled:
+                        span.set(cancelled=True)
+                        break
+                    span.mark_token()
+                    agent_return.type = 'searcher'
+                    agent_return.content = question
+                    yield agent_return
+        finally:
+            deadline.charge('searcher_llm', time.monotonic() - started)
+            span.end()
+
+    def _fetch_pages(self, search_results, cancel_token):
+        fetcher = self.page_fetcher or get_page_fetcher()
+        urls = [result['link'] for result in search_results[:fetcher.top_k]]
+        if not urls:
+            return {}
+        deadline = current_deadline()
+        try:
+            with deadline.stage('fetch'):
+                pages = run_sync(fetcher.fetch_many(urls),
+                                 timeout=deadline.remaining(),
+                                 cancel_token=cancel_token)
+        except (concurrent.futures.CancelledError,
+                concurrent.futures.TimeoutError):
+            return {}
+        return {page['url']: page['text'] for page in pages if page}
+
+
+class IncrementalProtocolParser:
+    """プランナーの累積応答を差分だけ走査してパースする。
+
+    ``feed`` には ``llm.stream_chat`` が返す累積テキストをそのまま渡す。
+    戻り値は同じテキストに対する ``protocol.parse`` の
+    ``(name, language, action)`` と同じ。マーカーの位置だけを差分で探し、
+    ``parse`` がエラーにする形（開始トークンのないマーカーなど）は
+    ``parse`` にそのまま任せる。
+    """
+
+    def __init__(self,
+                 protocol: Internlm2Protocol,
+                 interpreter_executor: Optional[ActionExecutor] = None):
+        tool = protocol.tool
+        self.protocol = protocol
+        self.interpreter_executor = interpreter_executor
+        self.start_token = tool['start_token']
+        self.plugin_name = tool['name_map']['plugin']
+        self.interpreter_name = tool['name_map']['interpreter']
+        self.plugin_start = self.start_token + self.plugin_name
+        self.interpreter_start = self.start_token + self.interpreter_name
+        self.end_token = tool['end'].strip()
+        self._markers = (('start', self.start_token),
+                         ('plugin', self.plugin_name),
+                         ('interpreter', self.interpreter_name),
+                         ('plugin_start', self.plugin_start),
+                         ('interpreter_start', self.interpreter_start))
+        self._overlap = max(
+            len(marker)
+            for marker in (self.plugin_start, self.interpreter_start,
+                           self.end_token)) - 1
+        # マーカーはどれも同じ文字列（``<|``）で始まるので、新しく届いた部分に
+        # それがなければ探し直さない
+        self._lead = os.path.commonprefix(
+            [marker for _, marker in self._markers] + [self.end_token])
+        self.reset()
+
+    def reset(self):
+        self._scanned = 0
+        # 各マーカーが最初に現れる位置（-1 はまだ現れていない）
+        self._first = {key: -1 for key, _ in self._markers}
+        # アクションの開始マーカーより後ろで最初に現れる終了・開始マーカー
+        self._after = {}
+
+    def _find_after(self, response, key, marker, begin, code_start, scan):
+        # 途中でプラグインの形に変わると開始位置も変わるので、開始位置ごとに持つ
+        pos = self._after.get((key, code_start), -1)
+        if pos < 0 and scan:
+            pos = self._after[key, code_start] = response.find(
+                marker, max(begin, code_start))
+        return pos
+
+    def feed(self, response: str):
+        if self.protocol.language['begin']:
+            return self._parse(response)
+        if len(response) < self._scanned:
+            self.reset()
+        begin = max(self._scanned - self._overlap, 0)
+        self._scanned = len(response)
+        scan = not self._lead or response.find(self._lead, begin) >= 0
+        first = self._first
+        if scan:
+            for key, marker in self._markers:
+                if first[key] < 0:
+                    first[key] = response.find(marker, begin)
+
+        if first['plugin'] >= 0:
+            plugin_start = first['plugin_start']
+            if plugin_start < 0:
+                return self._parse(response)
+            code_start = plugin_start + len(self.plugin_start)
+            if self._find_after(response, 'plugin_start', self.plugin_start,
+                                begin, code_start, scan) >= 0:
+                return self._parse(response)
+            code_end = self._code_end(response, begin, code_start, scan)
+            return 'plugin', response[:plugin_start], response[
+                code_start:code_end]
+        if first['interpreter'] >= 0:
+            interpreter_start = first['interpreter_start']
+            if interpreter_start < 0:
+                return self._parse(response)
+            code_start = interpreter_start + len(self.interpreter_start)
+            code_end = self._code_end(response, begin, code_start, scan)
+            next_start = self._find_after(response, 'interpreter_start',
+                                          self.interpreter_start, begin,
+                                          code_start, scan)
+            if next_start >= 0:
+                code_end = min(code_end, next_start)
+            code = response[code_start:code_end].strip()
+            return 'interpreter', response[:interpreter_start], dict(
+                name=self._interpreter_action_name(),
+                parameters=dict(command=code))
+        start = first['start']
+        return None, response[:start] if start >= 0 else response, None
+
+    def _code_end(self, response, begin, code_start, scan):
+        pos = self._find_after(response, 'end', self.end_token, begin,
+                               code_start, scan)
+        return pos if pos >= 0 else len(response)
+
+    def _interpreter_action_name(self):
+        if isinstance(self.interpreter_executor, ActionExecutor):
+            return self.interpreter_executor.action_names()[0]
+        return 'IPythonInterpreter'
+
+    def _parse(self, response):
+        return self.protocol.parse(
+            response, interpreter_executor=self.interpreter_executor)
+
+
+class PromptPrefix:
+    """フォーマット済みの静的なプロンプト接頭辞（system・few-shot など）。
+
+    同じ内容の接頭辞はプロセス内で同一のオブジェクトになるので、バックエンドは
+    ``digest`` や ``is`` で共通の接頭辞を判別できる。``messages`` は共有される
+    ため変更してはならない。
+    """
+
+    _interned = {}
+    _lock = threading.Lock()
+
+    def __init__(self, messages, digest):
+        self.messages = tuple(messages)
+        self.digest = digest
+
+    @classmethod
+    def intern(cls, messages) -> 'PromptPrefix':
+        digest = hashlib.sha1(
+            json.dumps(messages, ensure_ascii=False,
+                       sort_keys=True).encode()).hexdigest()
+        with cls._lock:
+            prefix = cls._interned.get(digest)
+            if prefix is None:
+                prefix = cls._interned[digest] = cls(messages, digest)
+        return prefix
+
+    def __len__(self):
+        return len(self.messages)
+
 
+class FormattedPrompt(list):
+    """``MindSearchProtocol.format`` の戻り値。先頭が ``prefix`` と一致する。"""
+
+    def __init__(self, messages=(), prefix: Optional[PromptPrefix] = None):
+        super().__init__(messages)
+        self.prefix = prefix
 
 
 class MindSearchProtocol(Internlm2Protocol):
@@ -101,6 +321,7 @@ class MindSearchProtocol(Internlm2Protocol):
                              fallback_role='environment'),
     ) -> None:
         self.response_prompt = response_prompt
+        self._prefixes = {}
         super().__init__(meta_prompt=meta_prompt,
                          interpreter_prompt=interpreter_prompt,
                          plugin_prompt=plugin_prompt,
@@ -109,16 +330,21 @@ class MindSearchProtocol(Internlm2Protocol):
                          tool=tool,
                          execute=execute)
 
-    def format(self,
-               inner_step: List[Dict],
-               plugin_executor: ActionExecutor = None,
-               **kwargs) -> list:
+    def prompt_prefix(self,
+                      plugin_executor: ActionExecutor = None) -> PromptPrefix:
+        # system・interpreter・few-shot は毎ターン同じなので一度だけ整形する
+        tool_info = None
+        if self.plugin_prompt:
+            tool_info = json.dumps(plugin_executor.get_actions_info(),
+                                   ensure_ascii=False)
+        prefix = self._prefixes.get(tool_info)
+        if prefix is not None:
+            return prefix
         formatted = []
         if self.meta_prompt:
             formatted.append(dict(role='system', content=self.meta_prompt))
         if self.plugin_prompt:
-            plugin_prompt = self.plugin_prompt.format(tool_info=json.dumps(
-                plugin_executor.get_actions_info(), ensure_ascii=False))
+            plugin_prompt = self.plugin_prompt.format(tool_info=tool_info)
             formatted.append(
                 dict(role='system', content=plugin_prompt, name='plugin'))
         if self.interpreter_prompt:
@@ -129,77 +355,286 @@ class MindSearchProtocol(Internlm2Protocol):
         if self.few_shot:
             for few_shot in self.few_shot:
                 formatted += self.format_sub_role(few_shot)
+        prefix = self._prefixes[tool_info] = PromptPrefix.intern(formatted)
+        return prefix
+
+    def format(self,
+               inner_step: List[Dict],
+               plugin_executor: ActionExecutor = None,
+               **kwargs) -> list:
+        prefix = self.prompt_prefix(plugin_executor)
+        formatted = FormattedPrompt(prefix.messages, prefix=prefix)
         formatted += self.format_sub_role(inner_step)
         return formatted
 
+    def stream_parser(
+            self,
+            interpreter_executor: ActionExecutor = None
+    ) -> IncrementalProtocolParser:
+        # プロトコルはセッション間で共有されるため、状態はストリームごとに持つ
+        return IncrementalProtocolParser(self, interpreter_executor)
+
 
 class WebSearchGraph:
     end_signal = 'end'
     searcher_cfg = dict()
 
-    def __init__(self):
+    def __init__(self, session_id=None, searcher_cfg=None, answer_cache=None):
         self.nodes = {}
-        self.adjacency_list = defaultdict(list)
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        # 指定がなければクラス属性の設定を使う
+        if searcher_cfg is not None:
+            self.searcher_cfg = searcher_cfg
+        self.index = GraphIndex()
+        self._edge_ids = itertools.count()
+        # サーチャーはプロセス共有のスケジューラーでセッション単位に公平に実行する
+        self.session_id = session_id or uuid.uuid4().hex
+        self.scheduler = get_scheduler()
         self.future_to_query = dict()
         self.searcher_resp_queue = queue.Queue()
+        # 親ノードがすべて終わったノードから順に実行する（DAG 実行）
+        self._cond = threading.Condition(threading.RLock())
+        self._pending = {}
+        self._running = set()
+        self._plan_nodes = set()
+        self.timings = {}
+        self.trace_parent = None
+        self.cancel_token = CancelToken()
+        self.cancel_token.on_cancel(self._on_cancel)
+        # 持ち時間が尽きたときに実行中のノードだけを打ち切るためのトークン
+        self.cutoff = self.cancel_token.child()
+        self.deadline = Deadline()
+        # 同じ前提の同じサブ質問は、以前の回答を再利用する
+        self.answer_cache = (answer_cache if answer_cache is not None else
+                             get_answer_cache())
 
     def add_root_node(self, node_content, node_name='root'):
-        self.nodes[node_name] = dict(content=node_content, type='root')
-        self.adjacency_list[node_name] = []
-        self.searcher_resp_queue.put((node_name, self.nodes[node_name], []))
+        node = Node(node_name, 'root', node_content)
+        self.nodes[node.name] = node
+        self.index.add_node(node_name)
+        self.index.set_status(node_name, FINISHED)
+        self.searcher_resp_queue.put(
+            NodeAdded(node_name, 'root', node_content))
 
     def add_node(self, node_name, node_content):
-        self.nodes[node_name] = dict(content=node_content, type='searcher')
-        self.adjacency_list[node_name] = []
+        node = Node(node_name, 'searcher', node_content)
+        self.nodes[node.name] = node
+        self.index.add_node(node_name)
+        self.searcher_resp_queue.put(
+            NodeAdded(node_name, 'searcher', node_content))
+        # 親ノードはこの後の add_edge で決まるため、実行は run() まで待つ
+        with self._cond:
+            self._pending[node_name] = node_content
 
-        def model_stream_thread():
+    def _run_searcher(self, node_name, node_content):
+        timing = self.timings[node_name]
+        timing['start'] = time.monotonic()
+        queue_wait = timing['start'] - timing['ready']
+        self.deadline.charge('searcher_queue', queue_wait)
+        if self.cancel_token.cancelled:
+            return
+        if self.cutoff.cancelled:
+            self._skip_node(node_name)
+            return
+        self.index.set_status(node_name, RUNNING)
+        with tracer.start_span('searcher_node',
+                               parent=self.trace_parent,
+                               node=node_name,
+                               queue_wait=queue_wait) as span:
+            self._stream_searcher(node_name, node_content, span)
+
+    def _stream_searcher(self, node_name, node_content, span):
+        try:
+            parent_response = [
+                dict(question=self.nodes[parent]['content'],
+                     answer=self.nodes[parent]['response'])
+                for parent in self.parents[node_name]
+                if 'response' in self.nodes.get(parent, {})
+            ]
+            cache_key = self.answer_cache.make_key(
+                node_content, self.nodes['root']['content'], parent_response)
+            cached = self.answer_cache.get(cache_key)
+            span.set(cache_hit=cached is not None)
+            if cached is not None:
+                self._replay_node(node_name, *cached)
+                return
             agent = SearcherAgent(**self.searcher_cfg)
-            try:
-                parent_nodes = []
-                for start_node, adj in self.adjacency_list.items():
-                    for neighbor in adj:
-                        if node_name == neighbor[
-                                'name'] and start_node in self.nodes and 'response' in self.nodes[
-                                    start_node]:
-                            parent_nodes.append(self.nodes[start_node])
-                parent_response = [
-                    dict(question=node['content'], answer=node['response'])
-                    for node in parent_nodes
-                ]
+            # チャンクごとに全体をコピーせず、増えた分のテキストだけを送る
+            response, state = '', None
+            answer = None
+            # 検索アクションからもキャンセルと持ち時間を参照できるようにする
+            with self.cutoff.bind(), self.deadline.bind():
                 for answer in agent.stream_chat(
                         node_content,
                         self.nodes['root']['content'],
-                        parent_response=parent_response):
-                    self.searcher_resp_queue.put(
-                        deepcopy((node_name,
-                                  dict(response=answer.response,
-                                       detail=answer), [])))
-                self.nodes[node_name]['response'] = answer.response
-                self.nodes[node_name]['detail'] = answer
-            except Exception as e:
-                logger.exception(f'Error in model_stream_thread: {e}')
+                        parent_response=parent_response,
+                        cancel_token=self.cutoff):
+                    text = answer.response or ''
+                    if text.startswith(response):
+                        delta = TokenAppended(node_name, text[len(response):],
+                                              answer.state)
+                    else:
+                        delta = TokenAppended(node_name, text, answer.state,
+                                              replace=True)
+                    if delta.text or delta.replace or answer.state != state:
+                        self.searcher_resp_queue.put(delta)
+                    response, state = text, answer.state
+            if self.cancel_token.cancelled:
+                return
+            if answer is None:
+                self._skip_node(node_name)
+                return
+            if self.cutoff.cancelled:
+                # 打ち切ったノードはそこまでの回答で終える
+                answer.state = AgentStatusCode.END
+                answer.response = response
+            elif answer.state == AgentStatusCode.END and answer.response:
+                self.answer_cache.set(cache_key, (answer.response, answer))
+            self.nodes[node_name]['response'] = answer.response
+            self.nodes[node_name]['detail'] = answer
+            self.searcher_resp_queue.put(
+                NodeFinished(node_name, answer.response, answer))
+        except Exception as e:
+            logger.exception(f'Error in model_stream_thread: {e}')
+
+    def _replay_node(self, node_name, response, detail):
+        """キャッシュした回答を、完了したノードのストリームとして流す。"""
+        detail.content = self.nodes[node_name].get('content')
+        self.nodes[node_name]['response'] = response
+        self.nodes[node_name]['detail'] = detail
+        self.searcher_resp_queue.put(
+            TokenAppended(node_name, response, AgentStatusCode.END))
+        self.searcher_resp_queue.put(NodeFinished(node_name, response, detail))
+
+    def _skip_node(self, node_name):
+        detail = AgentReturn(state=AgentStatusCode.END, response='')
+        detail.type = 'searcher'
+        detail.content = self.nodes[node_name].get('content')
+        self.nodes[node_name]['response'] = ''
+        self.nodes[node_name]['detail'] = detail
+        self.searcher_resp_queue.put(NodeFinished(node_name, '', detail))
+
+    def _submit(self, node_name):
+        node_content = self._pending.pop(node_name)
+        self._running.add(node_name)
+        self.timings[node_name] = dict(ready=time.monotonic())
+        future = self.scheduler.submit(self.session_id, self._run_searcher,
+                                       node_name, node_content)
+        self.future_to_query[future] = f'{node_name}-{node_content}'
+        future.add_done_callback(partial(self._on_done, node_name))
+
+    def _on_done(self, node_name, future):
+        with self._cond:
+            self._running.discard(node_name)
+            self.timings[node_name]['end'] = time.monotonic()
+            self.index.set_status(node_name, FINISHED)
+            self._schedule_ready()
+            self._cond.notify_all()
 
-        self.future_to_query[self.executor.submit(
-            model_stream_thread)] = f'{node_name}-{node_content}'
+    def _schedule_ready(self):
+        if self.cancel_token.cancelled:
+            return
+        if self.cutoff.cancelled or self.deadline.low:
+            # 最終回答の時間を残すため、新しいサブ質問は実行しない
+            for node_name in list(self._pending):
+                del self._pending[node_name]
+                self.index.set_status(node_name, FINISHED)
+                self._skip_node(node_name)
+            return
+        for node_name in list(self._pending):
+            if node_name not in self._pending:
+                continue
+            if not any(parent in self._pending or parent in self._running
+                       for parent in self.parents[node_name]):
+                self._submit(node_name)
+        if self._pending and not self._running:
+            # 循環などで親が終わらないノードは、親を待たずに実行する
+            logger.warning(f'Unresolvable dependencies: {list(self._pending)}')
+            for node_name in list(self._pending):
+                self._submit(node_name)
+
+    def run(self):
+        with self._cond:
+            self._plan_nodes = set(self._pending)
+            self._schedule_ready()
+
+    def wait(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self.cancel_token.cancelled or
+                (not self._pending and not self._running), timeout)
+
+    def critical_path(self):
+        """直近のプランで最も遅く終わったノードに至るクリティカルパスを返す。"""
+        with self._cond:
+            timings = {
+                name: dict(self.timings[name])
+                for name in self._plan_nodes
+                if 'end' in self.timings.get(name, {})
+            }
+        if not timings:
+            return dict(path=[], duration=0.0, nodes={})
+        path = [max(timings, key=lambda name: timings[name]['end'])]
+        while True:
+            parents = [p for p in self.parents[path[-1]] if p in timings]
+            if not parents:
+                break
+            path.append(max(parents, key=lambda p: timings[p]['end']))
+        path.reverse()
+        plan_start = min(t['ready'] for t in timings.values())
+        nodes = {
+            name: dict(queue_wait=t.get('start', t['end']) - t['ready'],
+                       run=t['end'] - t.get('start', t['end']))
+            for name, t in timings.items()
+        }
+        return dict(path=path,
+                    duration=timings[path[-1]]['end'] - plan_start,
+                    nodes=nodes)
 
     def add_response_node(self, node_name='response'):
-        self.nodes[node_name] = dict(type='end')
-        self.searcher_resp_queue.put((node_name, self.nodes[node_name], []))
+        node = Node(node_name, 'end')
+        self.nodes[node.name] = node
+        self.searcher_resp_queue.put(NodeAdded(node_name, 'end'))
 
     def add_edge(self, start_node, end_node):
-        self.adjacency_list[start_node].append(
-            dict(id=str(uuid.uuid4()), name=end_node, state=2))
-        self.searcher_resp_queue.put((start_node, self.nodes[start_node],
-                                      self.adjacency_list[start_node]))
+        edge_id = next(self._edge_ids)
+        self.index.add_edge(start_node, end_node, Edge(edge_id, end_node))
+        self.searcher_resp_queue.put(EdgeAdded(start_node, end_node, edge_id))
+
+    @property
+    def adjacency_list(self):
+        return self.index.children
+
+    @property
+    def parents(self):
+        return self.index.parents
 
     def reset(self):
         self.nodes = {}
-        self.adjacency_list = defaultdict(list)
+        self.index.clear()
 
     def node(self, node_name):
         return self.nodes[node_name].copy()
 
+    def cancel(self, reason='cancelled'):
+        self.cancel_token.cancel(reason)
+
+    def cut(self, reason='deadline'):
+        """実行中のノードを次のチャンクの境界で打ち切り、途中までの回答で終える。"""
+        self.cutoff.cancel(reason)
+        with self._cond:
+            self._schedule_ready()
+
+    def _on_cancel(self):
+        # 未実行のノードは捨て、実行中のノードは次のチャンクの境界で止まる
+        self.scheduler.close_session(self.session_id)
+        with self._cond:
+            self._pending.clear()
+            self._cond.notify_all()
+        self.searcher_resp_queue.put(self.end_signal)
+
+    def close(self):
+        self.cancel('closed')
+
 
 class MindSearchAgent(BaseAgent):
 
@@ -207,104 +642,225 @@ class MindSearchAgent(BaseAgent):
                  llm,
                  searcher_cfg,
                  protocol=MindSearchProtocol(),
-                 max_turn=10):
+                 max_turn=10,
+                 time_budget=None,
+                 answer_reserve=None,
+                 answer_cache=None):
         self.local_dict = {}
         self.ptr = 0
         self.llm = llm
         self.max_turn = max_turn
-        WebSearchGraph.searcher_cfg = searcher_cfg
+        # 1 つの質問の持ち時間（秒）。None なら無制限
+        if time_budget is None and os.environ.get('MINDSEARCH_TIME_BUDGET'):
+            time_budget = float(os.environ['MINDSEARCH_TIME_BUDGET'])
+        self.time_budget = time_budget
+        self.answer_reserve = answer_reserve
+        self.cancel_token = CancelToken()
+        self.deadline = Deadline()
+        # サーチャーの設定と回答キャッシュは、このエージェントのグラフにだけ渡す
+        self.searcher_cfg = searcher_cfg
+        self.answer_cache = answer_cache
         super().__init__(llm=llm, action_executor=None, protocol=protocol)
 
+    def cancel(self, reason='cancelled'):
+        """実行中の質問を取り消す。別スレッドから呼んでもよい。"""
+        self.cancel_token.cancel(reason)
+
     def stream_chat(self, message, **kwargs):
+        """``stream_deltas`` の上に構築した、全体スナップショットを返す互換 API。"""
+        as_dict = kwargs.pop('as_dict', False)
+        reducer = AgentReturnReducer()
+        for delta in self.stream_deltas(message, **kwargs):
+            node_name = reducer.apply(delta)
+            if isinstance(delta, (EdgeAdded, ReferencesUpdated, StepsUpdated)):
+                continue
+            if node_name is not None:
+                yield reducer.snapshot(as_dict), node_name
+            else:
+                yield reducer.snapshot(as_dict)
+
+    def stream_deltas(self, message, cancel_token=None, **kwargs):
+        """ノード追加・エッジ追加・トークン追加などの小さな差分を順に返す。
+
+        全体の状態は ``AgentReturnReducer`` で差分を畳み込めば復元できる。
+        ``cancel_token`` を渡すか ``cancel()`` を呼ぶと、プランナーと実行中の
+        サーチャーをチャンクの境界で止める。トークンは呼び出した時点でこの
+        質問に結び付くので、読み始める前の ``cancel()`` も効く。途中で
+        ジェネレーターを閉じた場合も同様に取り消す。``deadline``（秒または
+        ``Deadline``）を渡すと持ち時間が少なくなった時点で最終回答に進み、
+        最後に ``BudgetReported`` で時間の内訳を返す。
+        """
+        self.cancel_token = cancel_token or CancelToken()
+        return self._stream_deltas(message, **kwargs)
+
+    def _stream_deltas(self, message, **kwargs):
         if isinstance(message, str):
             message = [{'role': 'user', 'content': message}]
         elif isinstance(message, dict):
             message = [message]
-        as_dict = kwargs.pop('as_dict', False)
         return_early = kwargs.pop('return_early', False)
+        deadline = kwargs.pop('deadline', None)
+        if not isinstance(deadline, Deadline):
+            deadline = Deadline(
+                self.time_budget if deadline is None else deadline,
+                self.answer_reserve)
+        self.deadline = deadline
+        self._wrapped_up = False
         self.local_dict.clear()
+        # 計画のコードの ``WebSearchGraph()`` はこのエージェントの設定で作る
+        self.local_dict['WebSearchGraph'] = partial(
+            WebSearchGraph,
+            searcher_cfg=self.searcher_cfg,
+            answer_cache=self.answer_cache)
         self.ptr = 0
         inner_history = message[:]
-        agent_return = AgentReturn()
-        agent_return.type = 'planner'
-        agent_return.nodes = {}
-        agent_return.adjacency_list = {}
-        agent_return.inner_steps = deepcopy(inner_history)
-        for _ in range(self.max_turn):
+        # プランナーは 1 つの質問の全ターンで同じセッションを使う
+        sessions = get_session_manager()
+        session_id = sessions.acquire('planner')
+        # 1 つの質問の全スパンはこのトレース ID でつながる
+        self._query_span = tracer.start_span('query',
+                                             question=message[-1]['content'])
+        self.trace_id = self._query_span.trace_id
+        finished = False
+        try:
+            yield from self._stream_turns(inner_history, session_id,
+                                          return_early, **kwargs)
+            report = self.deadline.report()
+            logger.info(f'Time budget: {report}')
+            self._query_span.set(elapsed=report['elapsed'],
+                                 wrapped_up=self._wrapped_up)
+            yield BudgetReported(report)
+            finished = True
+        finally:
+            # 読み手がいなくなった場合もサーチャーを止めて枠を空ける
+            if not finished:
+                self.cancel_token.cancel('abandoned')
+            self._query_span.set(cancelled=self.cancel_token.cancelled)
+            graph = self.local_dict.get('graph')
+            if graph is not None:
+                graph.close()
+            sessions.release(session_id, self.llm)
+            self._query_span.end()
+
+    def _stream_turns(self, inner_history, session_id, return_early,
+                      **kwargs):
+        yield StepsUpdated(list(inner_history))
+        for turn in range(self.max_turn):
+            if self.cancel_token.cancelled:
+                yield StateChanged(AgentStatusCode.SESSION_CLOSED)
+                return
+            answering = self._answering()
+            if not answering and self.deadline.low:
+                yield from self._wrap_up(inner_history, return_early)
+                answering = True
             prompt = self._protocol.format(inner_step=inner_history)
             code = None
-            for model_state, response, _ in self.llm.stream_chat(
-                    prompt, session_id=random.randint(0, 999999), **kwargs):
+            language = ''
+            last_text, last_state = None, None
+            parser = self._protocol.stream_parser()
+            span = tracer.start_span('planner_turn',
+                                     parent=self._query_span,
+                                     turn=turn)
+            turn_start, overrun = time.monotonic(), False
+            for model_state, response, _ in get_session_manager().stream_chat(
+                    session_id, self.llm, prompt, **kwargs):
+                if self.cancel_token.cancelled:
+                    break
+                # 最終回答以外のターンは持ち時間を超えたら打ち切る
+                if not answering and self.deadline.expired:
+                    overrun = True
+                    break
+                span.mark_token()
                 if model_state.value < 0:
-                    agent_return.state = getattr(AgentStatusCode,
-                                                 model_state.name)
-                    yield deepcopy(agent_return)
+                    span.set(error=model_state.name)
+                    span.end()
+                    self.deadline.charge('planner',
+                                         time.monotonic() - turn_start)
+                    yield StateChanged(
+                        getattr(AgentStatusCode, model_state.name))
                     return
-                response = response.replace('<|plugin|>', '<|interpreter|>')
-                _, language, action = self._protocol.parse(response)
+                name, language, action = parser.feed(response)
                 if not language and not action:
                     continue
-                code = action['parameters']['command'] if action else ''
-                agent_return.state = self._determine_agent_state(
-                    model_state, code, agent_return)
-                agent_return.response = language if not code else code
-
-                # if agent_return.state == AgentStatusCode.STREAM_ING:
-                yield deepcopy(agent_return)
+                if name == 'interpreter':
+                    code = action['parameters']['command']
+                else:
+                    # プラグインとして書かれたコードもインタープリターで実行する
+                    code = action.strip() if action else ''
+                state = self._determine_agent_state(model_state, code)
+                text = language if not code else code
+                if last_text is not None and text.startswith(last_text):
+                    if len(text) > len(last_text) or state != last_state:
+                        yield ResponseUpdated(state, text[len(last_text):])
+                else:
+                    yield ResponseUpdated(state, text, replace=True)
+                last_text, last_state = text, state
+            span.end()
+            self.deadline.charge('planner', time.monotonic() - turn_start)
+            if self.cancel_token.cancelled:
+                yield StateChanged(AgentStatusCode.SESSION_CLOSED)
+                return
+            if overrun:
+                # 書きかけのプランは捨て、次のターンで最終回答に進む
+                span.set(deadline_exceeded=True)
+                continue
 
             inner_history.append({'role': 'language', 'content': language})
             print(colored(response, 'blue'))
 
             if code:
-                yield from self._process_code(agent_return, inner_history,
-                                              code, as_dict, return_early)
+                yield from self._process_code(inner_history, code,
+                                              return_early)
+                if self.cancel_token.cancelled:
+                    yield StateChanged(AgentStatusCode.SESSION_CLOSED)
+                    return
             else:
-                agent_return.state = AgentStatusCode.END
-                yield deepcopy(agent_return)
+                yield StateChanged(AgentStatusCode.END)
                 return
 
-        agent_return.state = AgentStatusCode.END
-        yield deepcopy(agent_return)
+        yield StateChanged(AgentStatusCode.END)
+
+    def _answering(self):
+        graph = self.local_dict.get('graph')
+        return self._wrapped_up or (graph is not None
+                                    and 'response' in graph.nodes)
 
-    def _determine_agent_state(self, model_state, code, agent_return):
+    def _wrap_up(self, inner_history, return_early=False):
+        """持ち時間が少ないので、新しいサブ質問は出さずに最終回答へ進む。"""
+        logger.info(f'Time budget is running low after '
+                    f'{self.deadline.elapsed():.1f}s, answering now')
+        self._wrapped_up = True
+        code = 'graph.add_response_node(node_name="response")'
+        inner_history.append({'role': 'language', 'content': ''})
+        if self.local_dict.get('graph') is not None:
+            yield from self._process_code(inner_history, code, return_early)
+            return
+        inner_history.append({
+            'role': 'tool',
+            'content': code,
+            'name': 'plugin'
+        })
+        inner_history.append({
+            'role': 'environment',
+            'content': self._protocol.response_prompt,
+            'name': 'plugin'
+        })
+        yield StepsUpdated(list(inner_history))
+
+    def _determine_agent_state(self, model_state, code):
         if code:
             return (AgentStatusCode.PLUGIN_START if model_state
                     == ModelStatusCode.END else AgentStatusCode.PLUGIN_START)
+        graph = self.local_dict.get('graph')
         return (AgentStatusCode.ANSWER_ING
-                if agent_return.nodes and 'response' in agent_return.nodes else
+                if graph is not None and 'response' in graph.nodes else
                 AgentStatusCode.STREAM_ING)
 
-    def _process_code(self,
-                      agent_return,
-                      inner_history,
-                      code,
-                      as_dict=False,
-                      return_early=False):
-        for node_name, node, adj in self.execute_code(
-                code, return_early=return_early):
-            if as_dict and 'detail' in node:
-                node['detail'] = asdict(node['detail'])
-            if not adj:
-                agent_return.nodes[node_name] = node
-            else:
-                agent_return.adjacency_list[node_name] = adj
-            # state  1进行中，2未开始，3已结束
-            for start_node, neighbors in agent_return.adjacency_list.items():
-                for neighbor in neighbors:
-                    if neighbor['name'] not in agent_return.nodes:
-                        state = 2
-                    elif 'detail' not in agent_return.nodes[neighbor['name']]:
-                        state = 2
-                    elif agent_return.nodes[neighbor['name']][
-                            'detail'].state == AgentStatusCode.END:
-                        state = 3
-                    else:
-                        state = 1
-                    neighbor['state'] = state
-            if not adj:
-                yield deepcopy((agent_return, node_name))
-        reference, references_url = self._generate_reference(
-            agent_return, code, as_dict)
+    def _process_code(self, inner_history, code, return_early=False):
+        yield from self.execute_code(code, return_early=return_early)
+        if self.cancel_token.cancelled:
+            return
+        reference, references_url = self._generate_reference(code)
         inner_history.append({
             'role': 'tool',
             'content': code,
@@ -315,30 +871,27 @@ class MindSearchAgent(BaseAgent):
             'content': reference,
             'name': 'plugin'
         })
-        agent_return.inner_steps = deepcopy(inner_history)
-        agent_return.state = AgentStatusCode.PLUGIN_RETURN
-        agent_return.references.update(references_url)
-        yield deepcopy(agent_return)
+        yield ReferencesUpdated(references_url)
+        yield StepsUpdated(list(inner_history))
+        yield StateChanged(AgentStatusCode.PLUGIN_RETURN)
 
-    def _generate_reference(self, agent_return, code, as_dict):
+    def _generate_reference(self, code):
         node_list = [
             node.strip().strip('\"') for node in re.findall(
                 r'graph\.node\("((?:[^"\\]|\\.)*?)"\)', code)
         ]
         if 'add_response_node' in code:
             return self._protocol.response_prompt, dict()
+        nodes = self.local_dict['graph'].nodes
         references = []
         references_url = dict()
         for node_name in node_list:
             ref_results = None
             ref2url = None
-            if as_dict:
-                actions = agent_return.nodes[node_name]['detail']['actions']
-            else:
-                actions = agent_return.nodes[node_name]['detail'].actions
+            detail = nodes[node_name].get('detail')
+            actions = detail.actions if detail is not None else None
             if actions:
-                ref_results = actions[0]['result'][0][
-                    'content'] if as_dict else actions[0].result[0]['content']
+                ref_results = actions[0].result[0]['content']
             if ref_results:
                 ref_results = json.loads(ref_results)
                 ref2url = {
@@ -346,7 +899,7 @@ class MindSearchAgent(BaseAgent):
                     for idx, item in ref_results.items()
                 }
 
-            ref = f"## {node_name}\n\n{agent_return.nodes[node_name]['response']}\n"
+            ref = f"## {node_name}\n\n{nodes[node_name].get('response', '')}\n"
             updated_ref = re.sub(
                 r'\[\[(\d+)\]\]',
                 lambda match: f'[[{int(match.group(1)) + self.ptr}]]', ref)
@@ -366,6 +919,16 @@ class MindSearchAgent(BaseAgent):
         return '\n'.join(references), references_url
 
     def execute_code(self, command: str, return_early=False):
+        span = tracer.start_span('execute_code',
+                                 parent=getattr(self, '_query_span', None))
+        started = time.monotonic()
+        try:
+            yield from self._execute_code(command, span, return_early)
+        finally:
+            self.deadline.charge('graph', time.monotonic() - started)
+            span.end()
+
+    def _execute_code(self, command, span, return_early=False):
 
         def extract_code(text: str) -> str:
             text = re.sub(r'from ([\w.]+) import WebSearchGraph', '', text)
@@ -377,72 +940,92 @@ class MindSearchAgent(BaseAgent):
                 return single_match.group(1)
             return text
 
+        graph_created = threading.Event()
+
         def run_command(cmd):
             try:
-                exec(cmd, globals(), self.local_dict)
+                try:
+                    exec(cmd, globals(), self.local_dict)
+                finally:
+                    graph_created.set()
                 plan_graph = self.local_dict.get('graph')
                 assert plan_graph is not None
-                for future in as_completed(plan_graph.future_to_query):
-                    future.result()
+                self.cancel_token.on_cancel(plan_graph.cancel)
+                plan_graph.trace_parent = span
+                plan_graph.deadline = self.deadline
+                plan_graph.run()
+                if not plan_graph.wait(self.deadline.time_left()):
+                    # 最終回答の時間に食い込むノードは途中で打ち切る
+                    span.set(cut_off=True)
+                    plan_graph.cut()
+                    plan_graph.wait()
                 plan_graph.future_to_query.clear()
-                plan_graph.searcher_resp_queue.put(plan_graph.end_signal)
+                critical_path = plan_graph.critical_path()
+                span.set(nodes=len(critical_path['nodes']),
+                         critical_path='->'.join(critical_path['path']),
+                         critical_path_duration=critical_path['duration'])
+                logger.info(f'Critical path: {critical_path}')
             except Exception as e:
                 logger.exception(f'Error executing code: {e}')
                 raise
+            finally:
+                # 読み手はタイムアウトなしで待つので、終了は必ず知らせる
+                plan_graph = self.local_dict.get('graph')
+                if plan_graph is not None:
+                    plan_graph.searcher_resp_queue.put(plan_graph.end_signal)
 
         command = extract_code(command)
         producer_thread = threading.Thread(target=run_command,
                                            args=(command, ))
         producer_thread.start()
+        # exec が graph を作る前にキューを読みに行かないようにする
+        graph_created.wait()
+        plan_graph = self.local_dict.get('graph')
+        if plan_graph is None:
+            producer_thread.join()
+            return
 
+        # ノードの差分はノードごとに順番にまとめて流す（構造の差分はそのまま流す）
         responses = defaultdict(list)
         ordered_nodes = []
         active_node = None
+        queue_wait = 0.0
 
         while True:
-            try:
-                item = self.local_dict.get('graph').searcher_resp_queue.get(
-                    timeout=60)
-                if item is WebSearchGraph.end_signal:
-                    for node_name in ordered_nodes:
-                        # resp = None
-                        for resp in responses[node_name]:
-                            yield deepcopy(resp)
-                        # if resp:
-                        #     assert resp[1][
-                        #         'detail'].state == AgentStatusCode.END
+            wait_start = time.monotonic()
+            item = plan_graph.searcher_resp_queue.get()
+            queue_wait += time.monotonic() - wait_start
+            span.set(queue_wait=queue_wait)
+            if item is WebSearchGraph.end_signal:
+                if self.cancel_token.cancelled:
+                    span.set(cancelled=True)
                     break
-                node_name, node, adj = item
-                if node_name in ['root', 'response']:
-                    yield deepcopy((node_name, node, adj))
+                for node_name in ordered_nodes:
+                    yield from responses[node_name]
+                break
+            if not isinstance(item, (TokenAppended, NodeFinished)):
+                yield item
+                continue
+            node_name = item.name
+            if node_name not in ordered_nodes:
+                ordered_nodes.append(node_name)
+            responses[node_name].append(item)
+            if not active_node and ordered_nodes:
+                active_node = ordered_nodes[0]
+            while active_node and responses[active_node]:
+                if return_early and isinstance(responses[active_node][-1],
+                                               NodeFinished):
+                    item = responses[active_node][-1]
                 else:
-                    if node_name not in ordered_nodes:
-                        ordered_nodes.append(node_name)
-                    responses[node_name].append((node_name, node, adj))
-                    if not active_node and ordered_nodes:
-                        active_node = ordered_nodes[0]
-                    while active_node and responses[active_node]:
-                        if return_early:
-                            if 'detail' in responses[active_node][-1][
-                                    1] and responses[active_node][-1][1][
-                                        'detail'].state == AgentStatusCode.END:
-                                item = responses[active_node][-1]
-                            else:
-                                item = responses[active_node].pop(0)
-                        else:
-                            item = responses[active_node].pop(0)
-                        if 'detail' in item[1] and item[1][
-                                'detail'].state == AgentStatusCode.END:
-                            ordered_nodes.pop(0)
-                            responses[active_node].clear()
-                            active_node = None
-                        yield deepcopy(item)
-            except queue.Empty:
-                if not producer_thread.is_alive():
-                    break
+                    item = responses[active_node].pop(0)
+                if isinstance(item, NodeFinished):
+                    ordered_nodes.pop(0)
+                    responses[active_node].clear()
+                    active_node = ordered_nodes[0] if ordered_nodes else None
+                yield item
         producer_thread.join()
         return
-from .models import create_model
+from .registry import get_registry
 from .mindsearch_prompt import (
     GRAPH_PROMPT_CN, GRAPH_PROMPT_EN, FINAL_RESPONSE_CN, FINAL_RESPONSE_EN,
     graph_fewshot_example_cn, graph_fewshot_example_en,
@@ -452,11 +1035,23 @@ from .mindsearch_prompt import (
 )
 
 
+def init_agent(lang='cn', model_format='internlm_server', llm=None):
+    # モデルはプロセス全体で共有するウォームなインスタンスを使う
+    if llm is None:
+        llm = get_registry().get(model_format)
 
-def init_agent(lang='cn', model_format='internlm_server'):
-    # ... (previous code remains the same)
-
-    llm = create_model(model_format)
+    if lang == 'cn':
+        graph_prompt, few_shot = GRAPH_PROMPT_CN, graph_fewshot_example_cn
+        final_response = FINAL_RESPONSE_CN
+        searcher_prompt = searcher_system_prompt_cn
+        template = dict(input=searcher_input_template_cn,
+                        context=searcher_context_template_cn)
+    else:
+        graph_prompt, few_shot = GRAPH_PROMPT_EN, graph_fewshot_example_en
+        final_response = FINAL_RESPONSE_EN
+        searcher_prompt = searcher_system_prompt_en
+        template = dict(input=searcher_input_template_en,
+                        context=searcher_context_template_en)
 
     protocol = MindSearchProtocol(
         meta_prompt=graph_prompt,
@@ -464,6 +1059,10 @@ def init_agent(lang='cn', model_format='internlm_server'):
         few_shot=few_shot,
         response_prompt=final_response
     )
+    # サーチャーは検索結果をメッセージに含めて渡すので、ツールの説明は不要
+    searcher_cfg = dict(llm=llm,
+                        protocol=MindSearchProtocol(meta_prompt=searcher_prompt),
+                        template=template)
 
     agent = MindSearchAgent(llm=llm, searcher_cfg=searcher_cfg, protocol=protocol)
     return agent
@@ -0,0 +1,366 @@
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from lagent.llms.base_llm import BaseModel
+from lagent.schema import ModelStatusCode
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Request:
+    input_ids: List[int]
+    max_new_tokens: int = 512
+    temperature: float = 0.8
+    top_p: float = 0.8
+    top_k: Optional[int] = 40
+    repetition_penalty: float = 1.0
+    stop_words: List[str] = field(default_factory=list)
+    stop_ids: Set[int] = field(default_factory=set)
+    output: queue.Queue = field(default_factory=queue.Queue)
+    generated: List[int] = field(default_factory=list)
+    text: str = ''
+    # generated[prefix_offset:read_offset] は text の末尾としてデコード済み
+    prefix_offset: int = 0
+    read_offset: int = 0
+    cancelled: bool = False
+    submitted_at: float = field(default_factory=time.monotonic)
+
+
+class BatchedGenerationService:
+    """1 つの HF モデルを共有し、同時に来た生成リクエストをまとめて実行する。
+
+    専用スレッドがデコードの 1 ステップごとに待っているリクエストをバッチに
+    加え（プリフィルして KV キャッシュを左詰めで結合する）、終わった系列は
+    その場でバッチから外す（連続バッチング）。各呼び出し元にはトークンが
+    出るたびに累積テキストを返す。
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 8):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.device = next(model.parameters()).device
+        if tokenizer.pad_token_id is None:
+            tokenizer.pad_token_id = tokenizer.eos_token_id
+        self.eos_ids = {tokenizer.eos_token_id}
+        self._cache_cls = None
+        self._waiting = queue.Queue()
+        self._steps = 0
+        self._tokens = 0
+        self._batch_rows = 0
+        self._thread = threading.Thread(target=self._loop,
+                                        name='mindsearch-hf-batch',
+                                        daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_pretrained(cls, path: str, max_batch_size: int = 8):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=True)
+        model = AutoModelForCausalLM.from_pretrained(
+            path,
+            trust_remote_code=True,
+            torch_dtype='auto',
+            device_map='auto' if torch.cuda.is_available() else None)
+        model.eval()
+        return cls(model, tokenizer, max_batch_size=max_batch_size)
+
+    def stream(self,
+               prompt: str,
+               max_new_tokens: int = 512,
+               temperature: float = 0.8,
+               top_p: float = 0.8,
+               top_k: Optional[int] = 40,
+               repetition_penalty: float = 1.0,
+               stop_words: Optional[List[str]] = None,
+               **kwargs) -> Iterator[Tuple[ModelStatusCode, str]]:
+        stop_words = list(stop_words or [])
+        request = _Request(self.tokenizer(prompt)['input_ids'],
+                           max_new_tokens=max_new_tokens,
+                           temperature=temperature,
+                           top_p=top_p,
+                           top_k=top_k,
+                           repetition_penalty=repetition_penalty,
+                           stop_words=stop_words,
+                           stop_ids=self._stop_ids(stop_words))
+        self._waiting.put(request)
+        try:
+            while True:
+                item = request.output.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield ModelStatusCode.STREAM_ING, item
+            yield ModelStatusCode.END, request.text
+        finally:
+            # 読み手がいなくなった系列は次のステップでバッチから外す
+            request.cancelled = True
+
+    def stats(self) -> Dict:
+        return dict(steps=self._steps,
+                    tokens=self._tokens,
+                    avg_batch=self._batch_rows / self._steps
+                    if self._steps else 0.0,
+                    waiting=self._waiting.qsize())
+
+    def _stop_ids(self, stop_words: List[str]) -> Set[int]:
+        """1 トークンで表される停止語（``<|action_end|>`` など）のトークン ID。"""
+        stop_ids = set()
+        for stop in stop_words:
+            ids = self.tokenizer.encode(stop, add_special_tokens=False)
+            if len(ids) == 1:
+                stop_ids.add(ids[0])
+        return stop_ids
+
+    def _legacy(self, past):
+        self._cache_cls = type(past)
+        return past.to_legacy_cache() if hasattr(past,
+                                                 'to_legacy_cache') else past
+
+    def _model_cache(self, legacy):
+        if hasattr(self._cache_cls, 'from_legacy_cache'):
+            return self._cache_cls.from_legacy_cache(legacy)
+        return legacy
+
+    def _prefill(self, requests):
+        import torch
+        length = max(len(r.input_ids) for r in requests)
+        pad = self.tokenizer.pad_token_id
+        input_ids = torch.tensor(
+            [[pad] * (length - len(r.input_ids)) + r.input_ids
+             for r in requests],
+            device=self.device)
+        mask = torch.tensor([[0] * (length - len(r.input_ids)) +
+                             [1] * len(r.input_ids) for r in requests],
+                            device=self.device)
+        position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+        with torch.no_grad():
+            out = self.model(input_ids=input_ids,
+                             attention_mask=mask,
+                             position_ids=position_ids,
+                             use_cache=True)
+        return out.logits[:, -1, :], self._legacy(out.past_key_values), mask
+
+    def _decode(self, requests, cache, mask):
+        import torch
+        input_ids = torch.tensor([[r.generated[-1]] for r in requests],
+                                 device=self.device)
+        position_ids = mask.sum(-1, keepdim=True)
+        mask = torch.cat([mask, mask.new_ones((mask.size(0), 1))], dim=-1)
+        with torch.no_grad():
+            out = self.model(input_ids=input_ids,
+                             attention_mask=mask,
+                             position_ids=position_ids,
+                             past_key_values=self._model_cache(cache),
+                             use_cache=True)
+        return out.logits[:, -1, :], self._legacy(out.past_key_values), mask
+
+    @staticmethod
+    def _left_pad(tensor, length, dim):
+        import torch
+        missing = length - tensor.size(dim)
+        if missing <= 0:
+            return tensor
+        shape = list(tensor.shape)
+        shape[dim] = missing
+        return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+    def _merge(self, cache, mask, new_cache, new_mask):
+        import torch
+        if cache is None:
+            return new_cache, new_mask
+        length = max(mask.size(1), new_mask.size(1))
+        merged = tuple(
+            tuple(
+                torch.cat([
+                    self._left_pad(old, length, 2),
+                    self._left_pad(new, length, 2)
+                ],
+                          dim=0) for old, new in zip(old_layer, new_layer))
+            for old_layer, new_layer in zip(cache, new_cache))
+        mask = torch.cat([
+            self._left_pad(mask, length, 1),
+            self._left_pad(new_mask, length, 1)
+        ],
+                         dim=0)
+        return merged, mask
+
+    @staticmethod
+    def _select(cache, mask, keep):
+        import torch
+        index = torch.tensor(keep, device=mask.device)
+        mask = mask.index_select(0, index)
+        # 全行がパディングになった先頭の列は捨てる
+        start = int((mask.sum(0) > 0).nonzero()[0]) if mask.numel() else 0
+        cache = tuple(
+            tuple(t.index_select(0, index.to(t.device))[:, :, start:]
+                  for t in layer) for layer in cache)
+        return cache, mask[:, start:]
+
+    def _sample(self, request, logits):
+        import torch
+        logits = logits.float()
+        if request.repetition_penalty != 1.0:
+            seen = torch.tensor(list(set(request.input_ids + request.generated)),
+                                device=logits.device)
+            scores = logits[seen]
+            logits[seen] = torch.where(scores > 0,
+                                       scores / request.repetition_penalty,
+                                       scores * request.repetition_penalty)
+        if request.temperature <= 1e-5 or request.top_k == 1:
+            return int(logits.argmax())
+        logits = logits / request.temperature
+        if request.top_k:
+            threshold = torch.topk(logits, min(request.top_k,
+                                                 logits.numel())).values[-1]
+            logits[logits < threshold] = -float('inf')
+        probs = torch.softmax(logits, dim=-1)
+        if request.top_p < 1.0:
+            sorted_probs, order = probs.sort(descending=True)
+            drop = sorted_probs.cumsum(-1) - sorted_probs > request.top_p
+            sorted_probs[drop] = 0
+            probs = torch.zeros_like(probs).scatter(0, order, sorted_probs)
+        return int(torch.multinomial(probs, 1))
+
+    def _emit(self, request, token) -> bool:
+        """トークンを系列に加えて呼び出し元に送る。系列が終わったら True。"""
+        self._tokens += 1
+        if token in self.eos_ids or token in request.stop_ids:
+            return True
+        request.generated.append(token)
+        done = len(request.generated) >= request.max_new_tokens
+        new = self._decode_new(request)
+        if not new:
+            return done
+        start = len(request.text)
+        text = request.text + new
+        # それまでの本文に停止語はないので、新しい部分と境界をまたぐ分だけ探す
+        found = [
+            text.find(stop, max(start - len(stop) + 1, 0))
+            for stop in request.stop_words
+        ]
+        found = [idx for idx in found if idx >= 0]
+        if found:
+            request.text = text[:min(found)]
+            return True
+        request.text = text
+        request.output.put(text)
+        return done
+
+    def _decode_new(self, request) -> str:
+        """前回から増えた本文。系列全体ではなく末尾の数トークンだけをデコードする。
+
+        前回の新しいトークンから続けてデコードするので、単語の先頭の空白など
+        前のトークンによって変わる文字も、系列全体をデコードした場合と同じに
+        なる。末尾が文字の途中（置換文字）なら次のトークンを待つ。停止語は
+        特殊トークンのことが多いので、特殊トークンも消さずにデコードする。
+        """
+        ids = request.generated
+        prefix = self.tokenizer.decode(
+            ids[request.prefix_offset:request.read_offset],
+            skip_special_tokens=False)
+        window = self.tokenizer.decode(ids[request.prefix_offset:],
+                                       skip_special_tokens=False)
+        if len(window) <= len(prefix) or window.endswith('\ufffd'):
+            return ''
+        request.prefix_offset = request.read_offset
+        request.read_offset = len(ids)
+        return window[len(prefix):]
+
+    def _loop(self):
+        active, cache, mask = [], None, None
+        while True:
+            new = [] if active else [self._waiting.get()]
+            while len(active) + len(new) < self.max_batch_size:
+                try:
+                    new.append(self._waiting.get_nowait())
+                except queue.Empty:
+                    break
+            new = [request for request in new if not request.cancelled]
+            try:
+                rows = []
+                if active:
+                    logits, cache, mask = self._decode(active, cache, mask)
+                    rows += list(zip(active, logits))
+                if new:
+                    logits, new_cache, new_mask = self._prefill(new)
+                    cache, mask = self._merge(cache, mask, new_cache,
+                                              new_mask)
+                    rows += list(zip(new, logits))
+                active = active + new
+                self._steps += 1
+                self._batch_rows += len(active)
+                keep = []
+                for idx, (request, row) in enumerate(rows):
+                    if request.cancelled:
+                        continue
+                    if self._emit(request, self._sample(request, row)):
+                        request.output.put(None)
+                    else:
+                        keep.append(idx)
+                if len(keep) < len(active):
+                    active = [active[idx] for idx in keep]
+                    if active:
+                        cache, mask = self._select(cache, mask, keep)
+                    else:
+                        cache, mask = None, None
+            except Exception as e:
+                logger.exception(f'Batched generation failed: {e}')
+                for request in active + new:
+                    request.output.put(e)
+                active, cache, mask = [], None, None
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_generation_service(path: str,
+                           max_batch_size: int = 8) -> BatchedGenerationService:
+    """モデルのパスごとに 1 つの生成サービス（と 1 つのモデル）を共有する。"""
+    with _services_lock:
+        if path not in _services:
+            _services[path] = BatchedGenerationService.from_pretrained(
+                path, max_batch_size=max_batch_size)
+        return _services[path]
+
+
+class BatchedHFTransformer(BaseModel):
+    """``HFTransformerCasualLM`` の代わりに、共有の生成サービスで生成する。
+
+    複数のサーチャーから同時に呼ばれても、モデルは 1 つだけ読み込まれ、
+    生成はまとめてバッチで実行される。``session_id`` は使わない。
+    """
+
+    def __init__(self, path: str, max_batch_size: int = 8, **kwargs):
+        super().__init__(path=path, **kwargs)
+        self.service = get_generation_service(path, max_batch_size)
+
+    def stream_chat(self, inputs: List[dict], session_id: int = 0,
+                    **gen_params):
+        prompt = self.template_parser(inputs)
+        params = self.update_gen_params(**gen_params)
+        for status, text in self.service.stream(prompt, **params):
+            yield status, text, None
+
+    def stream_generate(self, inputs: str, **gen_params):
+        params = self.update_gen_params(**gen_params)
+        for status, text in self.service.stream(inputs, **params):
+            yield status, text, None
+
+    def generate(self, inputs: str, **gen_params) -> str:
+        text = ''
+        for _, text, _ in self.stream_generate(inputs, **gen_params):
+            pass
+        return text
+
+    def chat(self, inputs: List[dict], session_id: int = 0,
+             **gen_params) -> str:
+        return self.generate(self.template_parser(inputs), **gen_params)
@@ -0,0 +1,72 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+_current_token = contextvars.ContextVar('mindsearch_cancel_token',
+                                       default=None)
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    """協調的キャンセルのためのトークン。
+
+    プランナー・各サーチャーノード・検索リクエストが同じトークン（またはその
+    子トークン）を参照し、``cancel()`` されると次のチャンクの境界で処理を
+    止める。登録したコールバックはキャンセルした側のスレッドで即座に呼ばれる。
+    """
+
+    def __init__(self, parent: Optional['CancelToken'] = None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reason = None
+        if parent is not None:
+            parent.on_cancel(lambda: self.cancel(parent.reason))
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = 'cancelled') -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise QueryCancelled(self.reason)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._event.wait(timeout)
+
+    def child(self) -> 'CancelToken':
+        return CancelToken(parent=self)
+
+    @contextmanager
+    def bind(self):
+        """このスレッドで呼ばれるアクション（検索など）から参照できるようにする。"""
+        token = _current_token.set(self)
+        try:
+            yield self
+        finally:
+            _current_token.reset(token)
+
+
+def current_token() -> Optional[CancelToken]:
+    return _current_token.get()
@@ -0,0 +1,56 @@
+import json
+import urllib.request
+from typing import Iterator, Optional
+
+from .streaming import delta_from_dict
+
+
+class ServerError(Exception):
+    """サーバー側で質問の処理に失敗した。"""
+
+
+def iter_sse(lines) -> Iterator[tuple]:
+    """バイト列の行から ``(event, data)`` を順に取り出す。"""
+    event, data = 'message', []
+    for raw in lines:
+        line = raw.decode('utf-8').rstrip('\r\n')
+        if not line:
+            if data:
+                yield event, '\n'.join(data)
+            event, data = 'message', []
+        elif line.startswith(':'):
+            continue
+        elif line.startswith('event:'):
+            event = line[6:].strip()
+        elif line.startswith('data:'):
+            data.append(line[5:].lstrip())
+
+
+def stream_remote(url: str,
+                  query: str,
+                  lang: str = 'cn',
+                  model_format: Optional[str] = None,
+                  deadline: Optional[float] = None,
+                  timeout: Optional[float] = None) -> Iterator:
+    """``mindsearch.server`` に質問を送り、差分を ``stream_deltas`` と同じ形で返す。
+
+    ジェネレーターを途中で閉じると接続を切り、サーバー側の質問も取り消される。
+    """
+    body = dict(query=query, lang=lang, deadline=deadline)
+    if model_format:
+        body['model_format'] = model_format
+    request = urllib.request.Request(
+        url.rstrip('/') + '/solve',
+        data=json.dumps(body).encode('utf-8'),
+        headers={
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream'
+        })
+    with urllib.request.urlopen(request, timeout=timeout) as resp:
+        for event, data in iter_sse(resp):
+            if event == 'delta':
+                yield delta_from_dict(json.loads(data))
+            elif event == 'error':
+                raise ServerError(json.loads(data)['message'])
+            elif event == 'done':
+                return
@@ -0,0 +1,218 @@
+import logging
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_CJK = r'぀-ヿ㐀-䶿一-鿿가-힯'
+_WORD_RE = re.compile(rf'[{_CJK}]+|[^\W_{_CJK}]+')
+_CJK_RE = re.compile(rf'[{_CJK}]')
+_SENTENCE_RE = re.compile(r'(?<=[。．！？.!?])\s*')
+
+
+class TokenCounter:
+    """トークン数を数える。同じ文字列の結果はキャッシュする。
+
+    ``tiktoken`` があればそのエンコーディングを使い、なければ CJK は 1 文字
+    1 トークン、それ以外は 4 文字 1 トークンとして見積もる。
+    """
+
+    def __init__(self, encoding: Optional[str] = 'cl100k_base',
+                 cache_size: int = 65536):
+        self.encoding = None
+        if encoding:
+            try:
+                import tiktoken
+                self.encoding = tiktoken.get_encoding(encoding)
+            except Exception:
+                logger.info('tiktoken is not available, '
+                            'estimating token counts')
+        self.count = lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text: str) -> int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        cjk = len(_CJK_RE.findall(text))
+        return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+@lru_cache(maxsize=65536)
+def _terms(text: str) -> Counter:
+    """関連度計算用の語の頻度。CJK は 2 文字ずつ、それ以外は単語で区切る。"""
+    terms = []
+    for word in _WORD_RE.findall(unicodedata.normalize('NFKC', text).lower()):
+        if _CJK_RE.match(word):
+            terms += [word[i:i + 2] for i in range(max(len(word) - 1, 1))]
+        else:
+            terms.append(word)
+    return Counter(terms)
+
+
+@dataclass
+class Chunk:
+    text: str
+    kind: str
+    index: int
+    position: int
+    tokens: int = 0
+    score: float = 0.0
+
+
+@dataclass
+class PackedContext:
+    parents: List[str]
+    context: str
+    stats: Dict[str, int] = field(default_factory=dict)
+
+
+class ContextPacker:
+    """サーチャーのプロンプトに入れる文脈をトークン予算内に詰める。
+
+    親ノードの回答と検索結果（スニペット・本文）をチャンクに分け、サブ質問
+    との関連度（BM25）が高い順に ``budget`` トークンまで採用する。採用した
+    チャンクは元の順序に戻して組み立てるので、グラフが深くなってもプロンプト
+    の長さ（プリフィルの時間）はほぼ一定に保たれる。
+    """
+
+    def __init__(self,
+                 budget: int = 3000,
+                 chunk_tokens: int = 200,
+                 counter: Optional[TokenCounter] = None):
+        self.budget = budget
+        self.chunk_tokens = chunk_tokens
+        self.counter = counter or get_token_counter()
+
+    def _lines(self, text: str) -> Iterator[str]:
+        # 長すぎる行は文の区切りで、それでも長ければ文字数で分ける
+        for line in text.split('\n'):
+            if self.counter.count(line) <= self.chunk_tokens:
+                yield line
+                continue
+            for sentence in _SENTENCE_RE.split(line):
+                tokens = self.counter.count(sentence)
+                if tokens <= self.chunk_tokens:
+                    yield sentence
+                    continue
+                step = max(len(sentence) * self.chunk_tokens // tokens, 1)
+                for start in range(0, len(sentence), step):
+                    yield sentence[start:start + step]
+
+    def _split(self, text: str) -> List[str]:
+        pieces, current, tokens = [], [], 0
+        for line in self._lines(text):
+            line_tokens = self.counter.count(line)
+            if current and tokens + line_tokens > self.chunk_tokens:
+                pieces.append('\n'.join(current))
+                current, tokens = [], 0
+            current.append(line)
+            tokens += line_tokens
+        if current:
+            pieces.append('\n'.join(current))
+        return [piece for piece in pieces if piece.strip()]
+
+    def _chunks(self, parents, search_results, pages):
+        chunks = []
+        for idx, parent in enumerate(parents):
+            for pos, text in enumerate(self._split(parent)):
+                chunks.append(Chunk(text, 'parent', idx, pos))
+        for idx, result in enumerate(search_results):
+            header = (f"タイトル: {result['title']}\nURL: {result['link']}\n"
+                      f"概要: {result['snippet']}\n")
+            chunks.append(Chunk(header, 'result', idx, 0))
+            page = pages.get(result['link'])
+            if page:
+                for pos, text in enumerate(self._split(page), start=1):
+                    chunks.append(Chunk(text, 'result', idx, pos))
+        for chunk in chunks:
+            chunk.tokens = self.counter.count(chunk.text)
+        return chunks
+
+    def _score(self, question, chunks):
+        query = set(_terms(question))
+        docs = [_terms(chunk.text) for chunk in chunks]
+        if not docs:
+            return
+        avg_len = sum(sum(doc.values()) for doc in docs) / len(docs) or 1
+        df = Counter(term for doc in docs for term in query if term in doc)
+        for chunk, doc in zip(chunks, docs):
+            norm = 1.2 * (0.25 + 0.75 * sum(doc.values()) / avg_len)
+            score = 0.0
+            for term in query:
+                tf = doc.get(term, 0)
+                if not tf:
+                    continue
+                idf = math.log(1 + (len(docs) - df[term] + 0.5) /
+                               (df[term] + 0.5))
+                score += idf * tf * 2.2 / (tf + norm)
+            # 検索順位が高いもの・見出し（スニペット）を少し優先する
+            if chunk.kind == 'result':
+                score += 0.5 / (1 + chunk.index)
+                if chunk.position == 0:
+                    score += 1.0
+            chunk.score = score
+
+    def pack(self,
+             question: str,
+             parents: List[str],
+             search_results: List[Dict],
+             pages: Optional[Dict[str, str]] = None) -> PackedContext:
+        chunks = self._chunks(parents, search_results, pages or {})
+        self._score(question, chunks)
+        headers = {(c.kind, c.index): c
+                   for c in chunks if c.kind == 'result' and c.position == 0}
+        selected, used = set(), 0
+        for chunk in sorted(chunks, key=lambda c: c.score, reverse=True):
+            if id(chunk) in selected:
+                continue
+            needed = [chunk]
+            # 本文だけを入れても出典が分からないので、見出しも一緒に入れる
+            header = headers.get((chunk.kind, chunk.index))
+            if header not in (None, chunk) and id(header) not in selected:
+                needed.insert(0, header)
+            cost = sum(c.tokens for c in needed)
+            if used + cost > self.budget:
+                continue
+            selected.update(id(c) for c in needed)
+            used += cost
+
+        kept = [chunk for chunk in chunks if id(chunk) in selected]
+        grouped = {}
+        for chunk in kept:
+            grouped.setdefault((chunk.kind, chunk.index), []).append(chunk.text)
+        packed_parents = [
+            '\n'.join(grouped[('parent', idx)]) for idx in range(len(parents))
+            if ('parent', idx) in grouped
+        ]
+        results = []
+        for idx in range(len(search_results)):
+            texts = grouped.get(('result', idx))
+            if texts:
+                body = '\n'.join(texts[1:])
+                results.append(texts[0] + (f'本文: {body}\n' if body else ''))
+        total = sum(chunk.tokens for chunk in chunks)
+        stats = dict(context_tokens=used,
+                     context_budget=self.budget,
+                     context_dropped_tokens=total - used,
+                     context_dropped_chunks=len(chunks) - len(kept))
+        return PackedContext(packed_parents, '\n'.join(results), stats)
+
+
+_counter = None
+_counter_lock = threading.Lock()
+
+
+def get_token_counter() -> TokenCounter:
+    global _counter
+    with _counter_lock:
+        if _counter is None:
+            # 空文字にすると tiktoken を使わず見積もりで数える
+            _counter = TokenCounter(
+                os.environ.get('MINDSEARCH_TOKENIZER', 'cl100k_base') or None)
+    return _counter
@@ -0,0 +1,99 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+_current_deadline = contextvars.ContextVar('mindsearch_deadline',
+                                           default=None)
+
+
+class Deadline:
+    """1 つの質問に割り当てた持ち時間（秒）と、その使い道の内訳。
+
+    ``budget`` が ``None`` なら無制限。``reserve`` は最終回答の生成に残して
+    おく時間で、残り時間がこれを下回ると ``low`` になり、新しいサブ質問は
+    出さずに最終回答へ進む。ステージごとの時間は並列に動くノードの分も
+    足し合わせるため、合計が経過時間を超えることがある。
+    """
+
+    def __init__(self,
+                 budget: Optional[float] = None,
+                 reserve: Optional[float] = None):
+        self.budget = budget
+        if reserve is None:
+            reserve = budget * 0.2 if budget else 0.0
+        self.reserve = reserve
+        self.started = time.monotonic()
+        self._stages: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining(self) -> Optional[float]:
+        if self.budget is None:
+            return None
+        return max(self.budget - self.elapsed(), 0.0)
+
+    def time_left(self) -> Optional[float]:
+        """最終回答用の時間を除いた、検索などに使える残り時間。"""
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        return max(remaining - self.reserve, 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
+
+    @property
+    def low(self) -> bool:
+        return self.time_left() == 0.0
+
+    def charge(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            entry = self._stages.setdefault(stage, dict(seconds=0.0, calls=0))
+            entry['seconds'] += seconds
+            entry['calls'] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.charge(name, time.monotonic() - start)
+
+    @contextmanager
+    def bind(self):
+        """このスレッドで呼ばれるアクション（検索など）から参照できるようにする。"""
+        token = _current_deadline.set(self)
+        try:
+            yield self
+        finally:
+            _current_deadline.reset(token)
+
+    def report(self) -> Dict:
+        with self._lock:
+            stages = sorted(self._stages.items(),
+                            key=lambda item: item[1]['seconds'],
+                            reverse=True)
+            stages = {
+                name: dict(seconds=round(entry['seconds'], 3),
+                           calls=entry['calls'])
+                for name, entry in stages
+            }
+        remaining = self.remaining()
+        return dict(budget=self.budget,
+                    elapsed=round(self.elapsed(), 3),
+                    remaining=None if remaining is None else round(
+                        remaining, 3),
+                    exceeded=self.expired,
+                    stages=stages)
+
+
+def current_deadline() -> Deadline:
+    """スレッドに結びつけられた持ち時間。なければ無制限の ``Deadline`` を返す。"""
+    deadline = _current_deadline.get()
+    return deadline if deadline is not None else Deadline()
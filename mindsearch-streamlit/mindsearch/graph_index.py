@@ -0,0 +1,152 @@
+import sys
+from collections import defaultdict
+from copy import deepcopy
+from typing import Any, Dict, Iterator, List, Optional
+
+# state  1进行中，2未开始，3已结束
+RUNNING = 1
+NOT_STARTED = 2
+FINISHED = 3
+
+
+class _Record:
+    """スロットに値を持ち、従来の dict のノード・エッジと同じように読み書きできる。
+
+    値が ``None`` のフィールドは dict でキーがない状態として扱う。
+    dict と同じく値で比較する書き換え可能なオブジェクトなので、ハッシュは
+    持たない（集合や dict のキーにはできない）。
+    """
+    __slots__ = ()
+    _fields = ()
+    __hash__ = None
+
+    def __getitem__(self, key: str) -> Any:
+        value = getattr(self, key) if key in self._fields else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in self._fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key) -> bool:
+        return key in self._fields and getattr(self, key) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (_Record, dict)):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key) if key in self._fields else None
+        return default if value is None else value
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return self.get(key)
+
+    def keys(self) -> List[str]:
+        return [key for key in self._fields if getattr(self, key) is not None]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    copy = to_dict
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+
+class Node(_Record):
+    """グラフのノード。名前は intern して、同じ名前の文字列を共有する。
+
+    ``detail`` は検索エージェントの ``AgentReturn`` への参照。スナップショット
+    の読み手が書き換えても元のグラフに響かないように、``deepcopy`` では
+    終わったノードの ``detail`` もコピーする。
+    """
+    __slots__ = ('name', 'type', 'content', 'response', 'detail')
+    _fields = ('type', 'content', 'response', 'detail')
+
+    def __init__(self,
+                 name: str,
+                 type: str,
+                 content: Optional[str] = None,
+                 response: Optional[str] = None,
+                 detail: Any = None):
+        self.name = sys.intern(name)
+        self.type = sys.intern(type)
+        self.content = content
+        self.response = response
+        self.detail = detail
+
+    def __deepcopy__(self, memo):
+        return Node(self.name, self.type, self.content, self.response,
+                    deepcopy(self.detail, memo))
+
+
+class Edge(_Record):
+    """グラフのエッジ。``id`` はグラフ内の連番。"""
+    __slots__ = ('id', 'name', 'state')
+    _fields = __slots__
+
+    def __init__(self, id: int, name: str, state: int = NOT_STARTED):
+        self.id = id
+        self.name = sys.intern(name)
+        self.state = state
+
+    def __deepcopy__(self, memo):
+        return Edge(self.id, self.name, self.state)
+
+
+class GraphIndex:
+    """前向き・逆向きの隣接インデックスと各ノードの状態を保持する。
+
+    エッジの ``state`` は対象ノードの状態が変わったときだけ、そのノードに
+    入るエッジに限って更新するため、イベントあたりのコストはグラフの大きさに
+    依存しない。
+    """
+
+    def __init__(self):
+        self.children: Dict[str, List[Edge]] = defaultdict(list)
+        self.parents: Dict[str, List[str]] = defaultdict(list)
+        self.incoming: Dict[str, List[Edge]] = defaultdict(list)
+        self.status: Dict[str, int] = {}
+
+    def add_node(self, name: str) -> None:
+        name = sys.intern(name)
+        self.status.setdefault(name, NOT_STARTED)
+        self.children.setdefault(name, [])
+
+    def add_edge(self, start: str, end: str, edge: Edge) -> Edge:
+        start = sys.intern(start)
+        edge.state = self.status.get(end, NOT_STARTED)
+        self.children[start].append(edge)
+        self.parents[edge.name].append(start)
+        self.incoming[edge.name].append(edge)
+        return edge
+
+    def set_status(self, name: str, status: int) -> bool:
+        if self.status.get(name) == status:
+            return False
+        self.status[name] = status
+        for edge in self.incoming.get(name, ()):
+            edge.state = status
+        return True
+
+    def clear(self) -> None:
+        self.children.clear()
+        self.parents.clear()
+        self.incoming.clear()
+        self.status.clear()
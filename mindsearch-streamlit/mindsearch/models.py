@@ -1,75 +1,119 @@
+import concurrent.futures
+import importlib
+import json
 import os
+import threading
 from datetime import datetime
-from lagent.actions import ActionExecutor, BaseAction
+from functools import partial
+from typing import Optional, Type
+from lagent.actions import ActionExecutor, BaseAction, tool_api
+from lagent.actions.parser import BaseParser, JsonParser
 from lagent.schema import ActionReturn, ActionStatusCode
-from googleapiclient.discovery import build
+
+from .cancellation import current_token
+from .deadline import current_deadline
+from .search_backend import (AsyncSearchClient, SingleFlight,
+                             get_search_client, run_sync)
+from .search_cache import SearchCache
+from .tracing import tracer
 
 class GoogleSearch(BaseAction):
-    name = "google_search"
-    description = "Perform a Google search and return the results"
-
-    def __init__(self):
-        super().__init__()
-        api_key = os.environ.get("GOOGLE_API_KEY")
-        search_engine_id = os.environ.get("GOOGLE_SEARCH_ENGINE_ID")
-        self.service = build("customsearch", "v1", developerKey=api_key)
-        self.search_engine_id = search_engine_id
-
-    def __call__(self, query: str, num_results: int = 5) -> ActionReturn:
-        try:
-            result = self.service.cse().list(q=query, cx=self.search_engine_id, num=num_results).execute()
-            items = result.get('items', [])
-            search_results = [{'title': item['title'], 'link': item['link'], 'snippet': item['snippet']} for item in items]
-            
-            return ActionReturn(
-                status=ActionStatusCode.SUCCESS,
-                result=[{
-                    "content": json.dumps(search_results, ensure_ascii=False),
-                    "type": "text"
-                }]
-            )
-        except Exception as e:
-            return ActionReturn(
-                status=ActionStatusCode.ERROR,
-                result=[{
-                    "content": f"Error during Google search: {str(e)}",
-                    "type": "text"
-                }]
-            )
+    """Google の Custom Search JSON API で Web を検索する。"""
+
+    # lagent 組み込みの GoogleSearch とツール名が衝突しないようにする
+    __tool_name__ = 'google_search'
+
+    def __init__(self,
+                 cache: Optional[SearchCache] = None,
+                 client: Optional[AsyncSearchClient] = None,
+                 description: Optional[dict] = None,
+                 parser: Type[BaseParser] = JsonParser,
+                 enable: bool = True):
+        super().__init__(description, parser, enable)
+        # HTTP 接続は共有ループ上のコネクションプールを全スレッドで共有する
+        self.client = client if client is not None else get_search_client()
+        # 同じサブ質問の再検索でクォータを消費しないようにキャッシュする
+        self.cache = cache if cache is not None else SearchCache.from_env()
+        # 同じ検索が同時に走っている間は API を呼ばずにその結果を待つ
+        self.inflight = SingleFlight()
+
+    async def acall(self, query: str, num_results: int = 5) -> ActionReturn:
+        with tracer.start_span('google_search', query=query) as span:
+            return await self._search(query, num_results, span)
+
+    async def _search(self, query, num_results, span):
+        key = self.cache.make_key(query, num_results)
+        search_results = self.cache.get(key)
+        span.set(cache_hit=search_results is not None)
+        if search_results is None:
+            try:
+                search_results = await self.inflight.do(
+                    key, partial(self._fetch, key, query, num_results))
+            except Exception as e:
+                span.set(error=str(e))
+                return ActionReturn(
+                    type=self.name,
+                    errmsg=f"Error during Google search: {str(e)}",
+                    state=ActionStatusCode.HTTP_ERROR)
+
+        return ActionReturn(
+            type=self.name,
+            state=ActionStatusCode.SUCCESS,
+            result=[{
+                "content": json.dumps(search_results, ensure_ascii=False),
+                "type": "text"
+            }]
+        )
+
+    async def _fetch(self, key, query, num_results):
+        # 待ち手が全員取り消されても、結果はキャッシュに残す
+        search_results = await self.client.search(query, num_results)
+        self.cache.set(key, search_results)
+        return search_results
+
+    @tool_api
+    def run(self, query: str, num_results: int = 5) -> ActionReturn:
+        """Google で検索し、タイトル・URL・概要の一覧を JSON で返す。
+
+        Args:
+            query (str): 検索クエリ
+            num_results (int): 返す件数
+        """
+        # 質問の持ち時間を超えて検索を待たない
+        deadline = current_deadline()
+        with tracer.start_span('google_search', query=query) as span, \
+                deadline.stage('search'):
+            try:
+                return run_sync(self._search(query, num_results, span),
+                                timeout=deadline.remaining(),
+                                cancel_token=current_token())
+            except (concurrent.futures.CancelledError,
+                    concurrent.futures.TimeoutError) as e:
+                reason = 'cancelled' if isinstance(
+                    e, concurrent.futures.CancelledError) else 'timed out'
+                span.set(error=reason)
+                return ActionReturn(type=self.name,
+                                    errmsg=f"Google search {reason}",
+                                    state=ActionStatusCode.HTTP_ERROR)
 
 # グローバル変数としてaction_executorを定義
 global_action_executor = None
+_action_executor_lock = threading.Lock()
 
 def get_action_executor():
     global global_action_executor
-    if global_action_executor is None:
-        global_action_executor = ActionExecutor()
-        google_search = GoogleSearch()
-        if "GoogleSearch" not in global_action_executor.actions:
-            global_action_executor.register_action(google_search)
+    with _action_executor_lock:
+        if global_action_executor is None:
+            global_action_executor = ActionExecutor(actions=[GoogleSearch()])
     return global_action_executor
 
 
+# バックエンドのクラスと meta_template は文字列で指定し、create_model で
+# 初めて読み込む。gpt4 だけを使う場合に torch・transformers・lmdeploy を
+# import しないようにするため。
+INTERNLM2_META = 'lagent.llms.meta_template.INTERNLM2_META'
 
-
-
-
-# The rest of your model initialization code...
-import mindsearch.agent.models as llm_factory
-from mindsearch.agent.mindsearch_agent import (MindSearchAgent,
-                                               MindSearchProtocol)
-from mindsearch.agent.mindsearch_prompt import (
-    FINAL_RESPONSE_CN, FINAL_RESPONSE_EN, GRAPH_PROMPT_CN, GRAPH_PROMPT_EN,
-    fewshot_example_cn, fewshot_example_en, graph_fewshot_example_cn,
-    graph_fewshot_example_en, searcher_context_template_cn,
-    searcher_context_template_en, searcher_input_template_cn,
-    searcher_input_template_en, searcher_system_prompt_cn,
-    searcher_system_prompt_en)
-
-
-
-
-internlm_server = dict(type=LMDeployServer,
+internlm_server = dict(type='lagent.llms.LMDeployServer',
                        path='internlm/internlm2_5-7b-chat',
                        model_name='internlm2',
                        meta_template=INTERNLM2_META,
@@ -80,7 +124,7 @@ internlm_server = dict(type=LMDeployServer,
                        repetition_penalty=1.02,
                        stop_words=['<|im_end|>'])
 
-internlm_client = dict(type=LMDeployClient,
+internlm_client = dict(type='lagent.llms.LMDeployClient',
                        model_name='internlm2_5-7b-chat',
                        url='http://127.0.0.1:23333',
                        meta_template=INTERNLM2_META,
@@ -91,8 +135,11 @@ internlm_client = dict(type=LMDeployClient,
                        repetition_penalty=1.02,
                        stop_words=['<|im_end|>'])
 
-internlm_hf = dict(type=HFTransformerCasualLM,
+# 同時に来たサーチャーの生成を 1 つのモデルでまとめてバッチ実行する
+internlm_hf = dict(type='mindsearch.batch_generation.BatchedHFTransformer',
                    path='internlm/internlm2_5-7b-chat',
+                   max_batch_size=int(
+                       os.environ.get('MINDSEARCH_HF_MAX_BATCH', 8)),
                    meta_template=INTERNLM2_META,
                    top_p=0.8,
                    top_k=None,
@@ -101,12 +148,12 @@ internlm_hf = dict(type=HFTransformerCasualLM,
                    repetition_penalty=1.02,
                    stop_words=['<|im_end|>'])
 
-gpt4 = dict(type=GPTAPI,
+gpt4 = dict(type='lagent.llms.GPTAPI',
             model_type='gpt-4-turbo',
             key=os.environ.get('OPENAI_API_KEY', 'YOUR OPENAI API KEY'))
 
 url = 'https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation'
-qwen = dict(type=GPTAPI,
+qwen = dict(type='lagent.llms.GPTAPI',
             model_type='qwen-max-longcontext',
             key=os.environ.get('QWEN_API_KEY', 'YOUR QWEN API KEY'),
             openai_api_base=url,
@@ -123,18 +170,37 @@ qwen = dict(type=GPTAPI,
             repetition_penalty=1.02,
             stop_words=['<|im_end|>'])
 
+MODEL_CONFIGS = dict(internlm_server=internlm_server,
+                     internlm_client=internlm_client,
+                     internlm_hf=internlm_hf,
+                     gpt4=gpt4,
+                     qwen=qwen)
 
+_lazy_objects = {}
+_lazy_objects_lock = threading.Lock()
 
-def create_model(model_format):
-    if model_format == 'internlm_server':
-        return LMDeployServer(**internlm_server)
-    elif model_format == 'internlm_client':
-        return LMDeployClient(**internlm_client)
-    elif model_format == 'internlm_hf':
-        return HFTransformerCasualLM(**internlm_hf)
-    elif model_format == 'gpt4':
-        return GPTAPI(**gpt4)
-    elif model_format == 'qwen':
-        return GPTAPI(**qwen)
-    else:
+
+def _import_object(path: str):
+    """``'package.module.Name'`` 形式のパスからオブジェクトを読み込む。"""
+    with _lazy_objects_lock:
+        if path not in _lazy_objects:
+            module_name, _, attr = path.rpartition('.')
+            module = importlib.import_module(module_name)
+            _lazy_objects[path] = getattr(module, attr)
+        return _lazy_objects[path]
+
+
+def load_backend(model_format):
+    """``model_format`` のバックエンドのクラスを返す（依存はここで読み込む）。"""
+    if model_format not in MODEL_CONFIGS:
         raise ValueError(f"サポートされていないモデル形式です: {model_format}")
+    return _import_object(MODEL_CONFIGS[model_format]['type'])
+
+
+def create_model(model_format):
+    model_cls = load_backend(model_format)
+    config = dict(MODEL_CONFIGS[model_format])
+    config.pop('type')
+    if isinstance(config.get('meta_template'), str):
+        config['meta_template'] = _import_object(config['meta_template'])
+    return model_cls(**config)
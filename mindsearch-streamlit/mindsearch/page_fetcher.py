@@ -0,0 +1,397 @@
+import asyncio
+import codecs
+import hashlib
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+from typing import Dict, List, Optional
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+
+from .search_backend import run_on_search_loop
+from .search_cache import SearchCache, TTLCache
+
+logger = logging.getLogger(__name__)
+
+SKIP_TAGS = {
+    'script', 'style', 'noscript', 'template', 'svg', 'nav', 'header',
+    'footer', 'aside', 'form', 'iframe', 'button', 'select'
+}
+BLOCK_TAGS = {
+    'p', 'div', 'section', 'article', 'main', 'li', 'ul', 'ol', 'br', 'tr',
+    'td', 'pre', 'blockquote', 'dd', 'dt', 'figcaption', 'h1', 'h2', 'h3',
+    'h4', 'h5', 'h6'
+}
+HTML_TYPES = {'text/html', 'application/xhtml+xml'}
+TEXT_TYPES = HTML_TYPES | {'text/plain'}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+
+def is_public_address(address: str) -> bool:
+    """インターネット上の（ループバック・プライベート・リンクローカルでない）アドレスか。"""
+    try:
+        ip = ipaddress.ip_address(address.split('%', 1)[0])
+    except ValueError:
+        return False
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+class PublicResolver(AbstractResolver):
+    """名前解決の結果から公開アドレス以外を除く（SSRF 対策）。
+
+    接続先は解決後のアドレスで決まるので、ホスト名の文字列ではなくここで
+    判定する。リダイレクト先の接続もこのリゾルバーを通る。
+    """
+
+    def __init__(self, resolver: Optional[AbstractResolver] = None):
+        self._resolver = resolver or aiohttp.DefaultResolver()
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        hosts = await self._resolver.resolve(host, port, family)
+        allowed = [h for h in hosts if is_public_address(h['host'])]
+        if not allowed:
+            raise OSError(f'{host} does not resolve to a public address')
+        return allowed
+
+    async def close(self) -> None:
+        await self._resolver.close()
+
+
+class PlainTextExtractor:
+    """``text/plain`` はそのまま ``max_chars`` 文字まで使う。"""
+
+    def __init__(self, max_chars: int = 4000):
+        self.max_chars = max_chars
+        self.title = ''
+        self._parts = []
+        self._length = 0
+
+    @property
+    def full(self) -> bool:
+        return self._length >= self.max_chars
+
+    def feed(self, data: str) -> None:
+        if not self.full:
+            self._parts.append(data)
+            self._length += len(data)
+
+    def text(self) -> str:
+        return ''.join(self._parts)[:self.max_chars]
+
+
+class MainTextExtractor(HTMLParser):
+    """HTML をチャンクごとに受け取り、本文らしいテキストだけを取り出す。
+
+    スクリプトやナビゲーションなどは捨て、ブロック要素ごとに空白を詰めた
+    テキストを集める。短すぎるブロック（メニューなど）は本文とみなさない。
+    ``full`` になったら呼び出し側はダウンロードを打ち切ってよい。
+    """
+
+    def __init__(self, max_chars: int = 4000, min_block_chars: int = 20):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.min_block_chars = min_block_chars
+        self.title = ''
+        self._blocks = []
+        self._current = []
+        self._length = 0
+        self._skip_depth = 0
+        self._in_title = False
+
+    @property
+    def full(self) -> bool:
+        return self._length >= self.max_chars
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == 'title':
+            self._in_title = True
+        elif tag in BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag == 'title':
+            self._in_title = False
+        elif tag in BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip_depth and not self.full:
+            self._current.append(data)
+
+    def _flush(self):
+        text = ' '.join(''.join(self._current).split())
+        self._current = []
+        if len(text) >= self.min_block_chars and not self.full:
+            self._blocks.append(text)
+            self._length += len(text)
+
+    def text(self) -> str:
+        self._flush()
+        return '\n'.join(self._blocks)[:self.max_chars]
+
+
+class PageCache:
+    """抽出済みページのコンテンツアドレス型キャッシュ。
+
+    URL から本文のハッシュを引き、ハッシュから本文を引く 2 段構成なので、
+    同じ内容のページ（ミラーやリダイレクト先）は 1 つだけ保持される。
+    ``path`` を指定すると、URL の索引は SQLite、本文はハッシュ名のファイル
+    としてディスクにも保存する。
+    """
+
+    def __init__(self,
+                 max_size: int = 512,
+                 ttl: Optional[float] = 86400,
+                 path: Optional[str] = None):
+        self.path = path
+        if path:
+            os.makedirs(path, exist_ok=True)
+        self.urls = SearchCache(
+            max_size=max_size * 4,
+            ttl=ttl,
+            path=os.path.join(path, 'index.sqlite') if path else None)
+        self.blobs = TTLCache(max_size=max_size, ttl=None)
+
+    @classmethod
+    def from_env(cls) -> 'PageCache':
+        ttl = os.environ.get('MINDSEARCH_PAGE_CACHE_TTL')
+        return cls(max_size=int(
+            os.environ.get('MINDSEARCH_PAGE_CACHE_SIZE', 512)),
+                   ttl=float(ttl) if ttl else 86400,
+                   path=os.environ.get('MINDSEARCH_PAGE_CACHE_DIR'))
+
+    @staticmethod
+    def digest(page: Dict) -> str:
+        return hashlib.sha256(page['text'].encode('utf-8')).hexdigest()
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], f'{digest}.json')
+
+    def get(self, url: str) -> Optional[Dict]:
+        digest = self.urls.get(url)
+        if digest is None:
+            return None
+        page = self.blobs.get(digest)
+        if page is None and self.path:
+            try:
+                with open(self._blob_path(digest), encoding='utf-8') as f:
+                    page = json.load(f)
+            except FileNotFoundError:
+                return None
+            self.blobs.set(digest, page)
+        return dict(page, url=url) if page is not None else None
+
+    def set(self, url: str, page: Dict) -> None:
+        digest = self.digest(page)
+        blob = dict(title=page['title'], text=page['text'])
+        self.blobs.set(digest, blob)
+        if self.path and not os.path.exists(self._blob_path(digest)):
+            os.makedirs(os.path.dirname(self._blob_path(digest)),
+                        exist_ok=True)
+            tmp = f'{self._blob_path(digest)}.{os.getpid()}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(blob, f, ensure_ascii=False)
+            os.replace(tmp, self._blob_path(digest))
+        self.urls.set(url, digest)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return dict(self.urls.stats, blobs=len(self.blobs))
+
+
+class PageFetcher:
+    """検索結果の上位ページを並行に取得し、本文を抽出する。
+
+    接続は共有ループ上の ``aiohttp`` のプールを使い、ホストごとの同時接続数
+    と 1 リクエストのタイムアウトを制限する。本文はダウンロードしながら
+    抽出し、十分な長さになった時点で打ち切る。同じ URL の同時取得は 1 回に
+    まとめ、結果は ``PageCache`` に保存する。ループバック・プライベート・
+    リンクローカルのアドレスには（リダイレクト先も含めて）接続しない。
+    """
+
+    def __init__(self,
+                 top_k: int = 3,
+                 max_connections: int = 20,
+                 per_host: int = 2,
+                 timeout: float = 10,
+                 max_bytes: int = 2 * 1024 * 1024,
+                 max_chars: int = 4000,
+                 max_hosts: int = 256,
+                 max_redirects: int = 5,
+                 allow_private: bool = False,
+                 cache: Optional[PageCache] = None):
+        self.top_k = top_k
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_chars = max_chars
+        self.max_hosts = max_hosts
+        self.max_redirects = max_redirects
+        self.allow_private = allow_private
+        self.cache = cache if cache is not None else PageCache.from_env()
+        self._session = None
+        # ホストごとの [セマフォ, 使用中の数]。最近使ったホストから max_hosts 件
+        self._host_limits = OrderedDict()
+        self._inflight = {}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                resolver=None if self.allow_private else PublicResolver())
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'User-Agent': 'Mozilla/5.0 (compatible; MindSearch)'})
+        return self._session
+
+    def _acquire_host(self, host: str) -> asyncio.Semaphore:
+        entry = self._host_limits.get(host)
+        if entry is None:
+            entry = self._host_limits[host] = [
+                asyncio.Semaphore(self.per_host), 0
+            ]
+        self._host_limits.move_to_end(host)
+        entry[1] += 1
+        # 古いホストから捨てる。使用中のホストは同時接続数を守るために残す
+        for old in list(self._host_limits):
+            if len(self._host_limits) <= self.max_hosts:
+                break
+            if self._host_limits[old][1] == 0:
+                del self._host_limits[old]
+        return entry[0]
+
+    def _release_host(self, host: str) -> None:
+        entry = self._host_limits.get(host)
+        if entry is not None:
+            entry[1] -= 1
+
+    def _allowed(self, url: str) -> bool:
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            return False
+        if self.allow_private:
+            return True
+        # IP アドレスを直接書いた URL は名前解決を通らないのでここで判定する
+        try:
+            ipaddress.ip_address(parts.hostname.split('%', 1)[0])
+        except ValueError:
+            return True
+        return is_public_address(parts.hostname)
+
+    async def _download(self, url: str) -> Optional[Dict]:
+        target = url
+        for _ in range(self.max_redirects + 1):
+            if not self._allowed(target):
+                logger.info(f'Refusing to fetch {target}')
+                return None
+            host = urlsplit(target).netloc
+            limit = self._acquire_host(host)
+            try:
+                async with limit:
+                    result = await self._get(target)
+            finally:
+                self._release_host(host)
+            if not isinstance(result, str):
+                break
+            target = urljoin(target, result)
+        else:
+            # リダイレクトが多すぎる
+            return None
+        if result is None:
+            return None
+        title, text = result
+        page = dict(url=url, title=title, text=text)
+        if page['text']:
+            self.cache.set(url, page)
+        return page
+
+    async def _get(self, url: str):
+        """本文を ``(title, text)`` で返す。リダイレクトなら移動先の URL を返す。"""
+        async with self._get_session().get(url,
+                                           allow_redirects=False) as resp:
+            if resp.status in REDIRECT_STATUSES and 'Location' in resp.headers:
+                return resp.headers['Location']
+            if resp.status != 200 or resp.content_type not in TEXT_TYPES:
+                return None
+            try:
+                decoder = codecs.getincrementaldecoder(
+                    resp.charset or 'utf-8')('replace')
+            except LookupError:
+                decoder = codecs.getincrementaldecoder('utf-8')('replace')
+            # text/plain は HTML として解釈せず、そのまま使う
+            if resp.content_type in HTML_TYPES:
+                extractor = MainTextExtractor(self.max_chars)
+            else:
+                extractor = PlainTextExtractor(self.max_chars)
+            received = 0
+            async for chunk in resp.content.iter_chunked(16384):
+                received += len(chunk)
+                extractor.feed(decoder.decode(chunk))
+                # 本文が十分集まったら残りは読まない
+                if extractor.full or received >= self.max_bytes:
+                    break
+            extractor.feed(decoder.decode(b'', final=True))
+        return extractor.title.strip(), extractor.text()
+
+    async def _fetch(self, url: str) -> Optional[Dict]:
+        if not self._allowed(url):
+            return None
+        page = self.cache.get(url)
+        if page is not None:
+            return page
+        task = self._inflight.get(url)
+        if task is None:
+            task = self._inflight[url] = asyncio.ensure_future(
+                self._download(url))
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        # 待ち手の 1 つが取り消されても、他の待ち手の取得は続ける
+        return await asyncio.shield(task)
+
+    async def fetch(self, url: str) -> Optional[Dict]:
+        try:
+            return await run_on_search_loop(self._fetch(url))
+        except Exception as e:
+            logger.info(f'Failed to fetch {url}: {e!r}')
+            return None
+
+    async def fetch_many(self, urls: List[str]) -> List[Optional[Dict]]:
+        return await asyncio.gather(*(self.fetch(url) for url in urls))
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await run_on_search_loop(self._session.close())
+            self._session = None
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_page_fetcher() -> PageFetcher:
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = PageFetcher(
+                top_k=int(os.environ.get('MINDSEARCH_FETCH_TOP_K', 3)),
+                per_host=int(os.environ.get('MINDSEARCH_FETCH_PER_HOST', 2)),
+                timeout=float(os.environ.get('MINDSEARCH_FETCH_TIMEOUT', 10)),
+                allow_private=os.environ.get('MINDSEARCH_FETCH_ALLOW_PRIVATE',
+                                             '0') == '1')
+    return _fetcher
@@ -0,0 +1,239 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class QuotaExceeded(Exception):
+    """1 日のクォータを使い切った。翌日のリセットまで待っても意味がない。"""
+
+
+def key_label(key: str) -> str:
+    # 統計やログに API キーそのものを出さない
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:8] if key else '-'
+
+
+class TokenBucket:
+    """共有ループ上で使うトークンバケット。
+
+    トークンがなければ失敗させずに順番に待たせる。429 を受けたら
+    ``throttled`` でレートを半分にしてバケットを空け、成功が続けば
+    ``succeeded`` で少しずつ元のレートに戻す（AIMD）。
+    """
+
+    def __init__(self,
+                 rate: float,
+                 burst: Optional[float] = None,
+                 min_rate: Optional[float] = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or rate / 16
+        # 既定では溜めずに一定間隔で通す（1 秒あたりのクォータを超えない）
+        self.burst = burst or 1
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = None
+        self.acquired = 0
+        self.waits = 0
+        self.waited = 0.0
+        self.throttles = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # ロックを持ったまま待つので、待ち手は到着順に通る
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                delay = (1 - self._tokens) / self.rate
+                self.waits += 1
+                self.waited += delay
+                await asyncio.sleep(delay)
+                self._refill()
+            self._tokens -= 1
+            self.acquired += 1
+
+    def throttled(self, retry_after: Optional[float] = None) -> None:
+        self.throttles += 1
+        self.rate = max(self.rate / 2, self.min_rate)
+        # 待っている呼び出しもまとめて後ろにずらす
+        self._refill()
+        self._tokens = min(self._tokens, 0) - (retry_after or 0) * self.rate
+
+    def succeeded(self) -> None:
+        if self.rate < self.max_rate:
+            self.rate = min(self.rate + self.max_rate / 20, self.max_rate)
+
+    @property
+    def stats(self) -> Dict:
+        return dict(rate=self.rate,
+                    max_rate=self.max_rate,
+                    acquired=self.acquired,
+                    waits=self.waits,
+                    waited_s=self.waited,
+                    throttles=self.throttles)
+
+
+class RateLimiter:
+    """API キーごとに 1 つのトークンバケットを持つ。"""
+
+    def __init__(self, rate: float = 10, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, key: str) -> TokenBucket:
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.rate, self.burst)
+            return self._buckets[key]
+
+    @property
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            buckets = dict(self._buckets)
+        return {key_label(key): b.stats for key, b in buckets.items()}
+
+
+class DailyQuota:
+    """API キーごとの 1 日の呼び出し回数を数え、上限を超えたら断る。
+
+    Google の API のクォータは太平洋時間の 0 時にリセットされるので、
+    日付はそのタイムゾーンで区切る。``limit`` が ``None`` なら数えるだけ。
+    """
+
+    def __init__(self,
+                 limit: Optional[int] = None,
+                 tz: str = 'America/Los_Angeles'):
+        self.limit = limit
+        try:
+            from zoneinfo import ZoneInfo
+            self.tz = ZoneInfo(tz)
+        except Exception:
+            self.tz = timezone.utc
+        self._date = None
+        self._used = Counter()
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def _roll(self):
+        today = datetime.now(self.tz).date()
+        if today != self._date:
+            self._date = today
+            self._used.clear()
+
+    def consume(self, key: str = '', n: int = 1) -> None:
+        with self._lock:
+            self._roll()
+            if self.limit is not None and self._used[key] + n > self.limit:
+                self.rejected += 1
+                raise QuotaExceeded(
+                    f'Daily quota of {self.limit} requests exhausted')
+            self._used[key] += n
+
+    def remaining(self, key: str = '') -> Optional[int]:
+        with self._lock:
+            self._roll()
+            if self.limit is None:
+                return None
+            return max(self.limit - self._used[key], 0)
+
+    @property
+    def stats(self) -> Dict:
+        with self._lock:
+            self._roll()
+            resets_at = datetime.combine(self._date + timedelta(days=1),
+                                         datetime.min.time(), self.tz)
+            return dict(date=self._date.isoformat(),
+                        limit=self.limit,
+                        used={key_label(k): v
+                              for k, v in self._used.items()},
+                        rejected=self.rejected,
+                        resets_at=resets_at.isoformat())
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+    return isinstance(error,
+                      (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+async def retry_with_backoff(
+        func: Callable[[], Awaitable[T]],
+        retries: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        retry_delay: Callable[[Exception], Optional[float]] = retry_after
+) -> T:
+    """429・5xx・接続エラーのときに指数バックオフ（フルジッター）で再試行する。
+
+    ``retry_delay`` が秒数を返したら（既定では ``Retry-After`` ヘッダー）、
+    バックオフの代わりにその秒数だけ待つ。
+    """
+    attempt = 0
+    while True:
+        try:
+            return await func()
+        except Exception as e:
+            if attempt >= retries or not is_retryable(e):
+                raise
+            delay = retry_delay(e) or random.uniform(
+                0, min(max_delay, base_delay * 2**attempt))
+            logger.info(f'Retrying after {e!r} in {delay:.2f}s')
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+_limiter = None
+_quota = None
+_limit_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _limiter
+    with _limit_lock:
+        if _limiter is None:
+            burst = os.environ.get('GOOGLE_SEARCH_BURST')
+            _limiter = RateLimiter(
+                rate=float(os.environ.get('GOOGLE_SEARCH_QPS', 10)),
+                burst=float(burst) if burst else None)
+    return _limiter
+
+
+def get_daily_quota() -> DailyQuota:
+    global _quota
+    with _limit_lock:
+        if _quota is None:
+            limit = os.environ.get('GOOGLE_SEARCH_DAILY_LIMIT')
+            _quota = DailyQuota(int(limit) if limit else None)
+    return _quota
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """``model_format`` ごとに 1 つのウォームなモデルをプロセス全体で保持する。
+
+    Streamlit のセッション（スクリプトスレッド）間で共有しても安全で、
+    同じ形式のモデルが同時に二重ロードされることはない。
+    """
+
+    def __init__(self, factory: Optional[Callable] = None):
+        self._factory = factory
+        self._models = {}
+        self._errors = {}
+        self._load_times = {}
+        self._loading = set()
+        self._lock = threading.Lock()
+        self._format_locks = {}
+
+    def _create(self, model_format):
+        if self._factory is None:
+            from .models import create_model
+            return create_model(model_format)
+        return self._factory(model_format)
+
+    def _format_lock(self, model_format) -> threading.Lock:
+        with self._lock:
+            return self._format_locks.setdefault(model_format,
+                                                 threading.Lock())
+
+    def get(self, model_format: str):
+        model = self._models.get(model_format)
+        if model is not None:
+            return model
+        with self._format_lock(model_format):
+            model = self._models.get(model_format)
+            if model is not None:
+                return model
+            with self._lock:
+                self._loading.add(model_format)
+                self._errors.pop(model_format, None)
+            start = time.time()
+            try:
+                model = self._create(model_format)
+            except Exception as exc:
+                with self._lock:
+                    self._errors[model_format] = exc
+                raise
+            finally:
+                with self._lock:
+                    self._loading.discard(model_format)
+            self._load_times[model_format] = time.time() - start
+            self._models[model_format] = model
+            logger.info(f'Loaded {model_format} in '
+                        f'{self._load_times[model_format]:.1f}s')
+            return model
+
+    def preload(self,
+                model_formats: Iterable[str],
+                background: bool = True) -> List[threading.Thread]:
+        threads = []
+        for model_format in model_formats:
+            if self.status(model_format) in ('ready', 'loading'):
+                continue
+            if not background:
+                self.get(model_format)
+                continue
+            with self._lock:
+                self._loading.add(model_format)
+            thread = threading.Thread(target=self._preload_one,
+                                      args=(model_format, ),
+                                      name=f'preload-{model_format}',
+                                      daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _preload_one(self, model_format):
+        try:
+            self.get(model_format)
+        except Exception:
+            logger.exception(f'Failed to preload {model_format}')
+
+    def status(self, model_format: Optional[str] = None):
+        if model_format is None:
+            with self._lock:
+                formats = set(self._models) | set(self._errors) | set(
+                    self._loading)
+            return {fmt: self.status(fmt) for fmt in sorted(formats)}
+        if model_format in self._models:
+            return 'ready'
+        if model_format in self._loading:
+            return 'loading'
+        if model_format in self._errors:
+            return 'error'
+        return 'cold'
+
+    def is_ready(self, model_format: str) -> bool:
+        return model_format in self._models
+
+    @property
+    def load_times(self) -> Dict[str, float]:
+        return dict(self._load_times)
+
+    def error(self, model_format: str) -> Optional[Exception]:
+        return self._errors.get(model_format)
+
+    def evict(self, model_format: str) -> None:
+        with self._format_lock(model_format):
+            self._models.pop(model_format, None)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ModelRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+    return _registry
@@ -0,0 +1,432 @@
+"""1 回の質問の実行をすべて記録し、LLM・検索 API なしで再生する。
+
+記録::
+
+    for delta in record_run(agent, query, 'runs.jsonl.gz'):
+        ...
+
+再生（``speed=None`` ならできるだけ速く、``1.0`` なら記録どおりの速さ）::
+
+    for delta in replay_run('runs.jsonl.gz', speed=1.0):
+        ...
+
+ログは 1 行 1 レコードの追記専用の JSON Lines（``.gz`` なら gzip）で、
+プランナー・サーチャーの LLM のチャンク、検索とページ取得の結果、
+``stream_deltas`` の差分（生成されたコードとグラフのイベントを含む）を
+経過時間とともに残す。1 つのファイルに複数の実行を追記できる。
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+from lagent.actions import ActionExecutor, BaseAction
+from lagent.schema import ActionReturn, ActionStatusCode, ModelStatusCode
+
+from . import models, page_fetcher
+from .search_cache import AnswerCache, normalize_query
+from .streaming import AgentReturnReducer, delta_from_dict, delta_to_dict
+
+logger = logging.getLogger(__name__)
+
+
+def _open(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def message_key(inputs) -> str:
+    # システムプロンプト（日付など）が変わっても同じ呼び出しとみなせるよう、
+    # 最後のメッセージだけで照合する
+    last = inputs[-1] if isinstance(inputs, list) and inputs else inputs
+    return hashlib.sha1(
+        json.dumps(last, ensure_ascii=False, sort_keys=True,
+                   default=str).encode('utf-8')).hexdigest()[:16]
+
+
+class RunRecorder:
+    """1 回の実行のレコードをログに追記する。スレッドセーフ。"""
+
+    def __init__(self, path: str, run_id: Optional[str] = None):
+        self.path = path
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self._file = _open(path, 'a')
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._calls = 0
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._start
+
+    def next_call(self) -> int:
+        with self._lock:
+            self._calls += 1
+            return self._calls
+
+    def write(self, kind: str, **data) -> None:
+        record = dict(r=self.run_id, t=round(self.elapsed(), 4), k=kind, **data)
+        line = json.dumps(record,
+                          ensure_ascii=False,
+                          separators=(',', ':'),
+                          default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class RecordingLLM:
+    """``stream_chat`` のチャンクを記録しながらそのまま返すラッパー。"""
+
+    def __init__(self, llm, recorder: RunRecorder, role: str):
+        self.llm = llm
+        self.recorder = recorder
+        self.role = role
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def stream_chat(self, inputs, *args, **kwargs):
+        call = self.recorder.next_call()
+        started = self.recorder.elapsed()
+        chunks, text = [], ''
+        try:
+            for status, response, extra in self.llm.stream_chat(
+                    inputs, *args, **kwargs):
+                # 累積テキストは増えた分だけを残す
+                if response.startswith(text):
+                    chunks.append([
+                        round(self.recorder.elapsed() - started, 4),
+                        int(status), response[len(text):]
+                    ])
+                else:
+                    chunks.append([
+                        round(self.recorder.elapsed() - started, 4),
+                        int(status), response, 1
+                    ])
+                text = response
+                yield status, response, extra
+        finally:
+            self.recorder.write('llm',
+                                call=call,
+                                role=self.role,
+                                key=message_key(inputs),
+                                start=round(started, 4),
+                                chunks=chunks)
+
+
+class RecordingSearch(BaseAction):
+    """``GoogleSearch`` アクションの結果と所要時間を記録するラッパー。"""
+
+    def __init__(self, action: BaseAction, recorder: RunRecorder):
+        # 元のアクションと同じ名前・引数でアクションエグゼキューターに載せる
+        super().__init__(description=action.description)
+        self.action = action
+        self.recorder = recorder
+
+    def run(self, query: str, num_results: int = 5) -> ActionReturn:
+        started = time.monotonic()
+        action_return = self.action(dict(query=query, num_results=num_results))
+        self.recorder.write('search',
+                            query=query,
+                            state=int(action_return.state),
+                            result=action_return.result,
+                            errmsg=action_return.errmsg,
+                            seconds=round(time.monotonic() - started, 4))
+        return action_return
+
+
+class RecordingPageFetcher:
+    """``PageFetcher.fetch_many`` の結果と所要時間を記録するラッパー。"""
+
+    def __init__(self, fetcher, recorder: RunRecorder):
+        self.fetcher = fetcher
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.fetcher, name)
+
+    async def fetch_many(self, urls: List[str]):
+        started = time.monotonic()
+        pages = await self.fetcher.fetch_many(urls)
+        self.recorder.write('pages',
+                            urls=urls,
+                            pages=pages,
+                            seconds=round(time.monotonic() - started, 4))
+        return pages
+
+
+class RunLog:
+    """ログファイルから 1 回の実行のレコードを読み出す。"""
+
+    def __init__(self, records: List[Dict]):
+        self.records = records
+        self.meta = next((r for r in records if r['k'] == 'run'), {})
+
+    @classmethod
+    def load(cls, path: str, run: int = -1) -> 'RunLog':
+        runs = defaultdict(list)
+        with _open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    runs[record['r']].append(record)
+        if not runs:
+            raise ValueError(f'No runs recorded in {path}')
+        return cls(list(runs.values())[run])
+
+    def of_kind(self, kind: str) -> List[Dict]:
+        return [r for r in self.records if r['k'] == kind]
+
+    @property
+    def deltas(self) -> List:
+        return [delta_from_dict(r['delta']) for r in self.of_kind('delta')]
+
+    @property
+    def seconds(self) -> float:
+        return self.records[-1]['t'] if self.records else 0.0
+
+
+class _Player:
+    """記録した時刻どおりに待つ。``speed`` が ``None`` なら待たない。"""
+
+    def __init__(self, speed: Optional[float] = None):
+        self.speed = speed
+
+    def delay(self, seconds: float) -> float:
+        return seconds / self.speed if self.speed else 0.0
+
+    def sleep_until(self, started: float, offset: float) -> None:
+        wait = started + self.delay(offset) - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ReplayLLM(_Player):
+    """記録した LLM の応答を返す。最後のメッセージが同じ呼び出しを優先し、
+    見つからなければ同じ役割の未使用の呼び出しを記録順に使う。"""
+
+    def __init__(self, log: RunLog, role: str, speed: Optional[float] = None):
+        super().__init__(speed)
+        self.role = role
+        calls = [r for r in log.of_kind('llm') if r['role'] == role]
+        calls.sort(key=lambda r: r['call'])
+        self._order = deque(calls)
+        self._by_key = defaultdict(deque)
+        for call in calls:
+            self._by_key[call['key']].append(call)
+        self._used = set()
+        self._lock = threading.Lock()
+        self.misses = 0
+
+    def _take(self, inputs) -> Dict:
+        with self._lock:
+            candidates = self._by_key.get(message_key(inputs))
+            while candidates:
+                call = candidates.popleft()
+                if call['call'] not in self._used:
+                    break
+            else:
+                self.misses += 1
+                while self._order and self._order[0]['call'] in self._used:
+                    self._order.popleft()
+                if not self._order:
+                    raise LookupError(
+                        f'No recorded {self.role} LLM call left to replay')
+                call = self._order.popleft()
+            self._used.add(call['call'])
+            return call
+
+    def stream_chat(self, inputs, *args, **kwargs):
+        call = self._take(inputs)
+        started, text = time.monotonic(), ''
+        for chunk in call['chunks']:
+            offset, status, piece = chunk[:3]
+            self.sleep_until(started, offset)
+            text = piece if len(chunk) > 3 else text + piece
+            yield ModelStatusCode(status), text, None
+
+
+class ReplaySearch(_Player, BaseAction):
+    """記録した検索結果を同じクエリ（正規化後）に返す。"""
+
+    def __init__(self, log: RunLog, speed: Optional[float] = None):
+        _Player.__init__(self, speed)
+        BaseAction.__init__(
+            self, description=models.GoogleSearch.__tool_description__)
+        self._results = defaultdict(deque)
+        for record in log.of_kind('search'):
+            self._results[normalize_query(record['query'])].append(record)
+        self._lock = threading.Lock()
+
+    def run(self, query: str, num_results: int = 5) -> ActionReturn:
+        with self._lock:
+            records = self._results.get(normalize_query(query))
+            # 同じクエリを何度も検索した場合は最後の記録を使い回す
+            record = (records.popleft() if len(records) > 1 else records[0]
+                      ) if records else None
+        if record is None:
+            return ActionReturn(type=self.name,
+                                errmsg='No recorded search result',
+                                state=ActionStatusCode.HTTP_ERROR)
+        time.sleep(self.delay(record['seconds']))
+        return ActionReturn(type=self.name,
+                            state=ActionStatusCode(record['state']),
+                            result=record['result'],
+                            errmsg=record.get('errmsg'))
+
+
+class ReplayPageFetcher(_Player):
+    """記録したページ本文を返す。記録にない URL は取得失敗として扱う。"""
+
+    def __init__(self, log: RunLog, speed: Optional[float] = None):
+        super().__init__(speed)
+        self.pages = {}
+        self.top_k = 0
+        for record in log.of_kind('pages'):
+            self.top_k = max(self.top_k, len(record['urls']))
+            for url, page in zip(record['urls'], record['pages']):
+                self.pages[url] = (page, record['seconds'])
+
+    async def fetch_many(self, urls: List[str]):
+        found = [self.pages.get(url, (None, 0.0)) for url in urls]
+        await asyncio.sleep(self.delay(max(s for _, s in found)))
+        return [page for page, _ in found]
+
+
+@contextmanager
+def _patched(agent, planner_llm, searcher_llm, search, fetcher):
+    """エージェントの LLM と、サーチャーの検索アクション・ページ取得を差し替える。
+
+    差し替えるのはこのエージェントの設定だけなので、同じプロセスの他の
+    質問やプロセス共有の検索アクション・ページ取得には影響しない。
+    """
+    saved = (agent.llm, agent.searcher_cfg, agent.answer_cache)
+    searcher_cfg = dict(agent.searcher_cfg)
+    agent.llm = planner_llm(agent.llm)
+    searcher_cfg['llm'] = searcher_llm(searcher_cfg.get('llm'))
+    executor = (searcher_cfg.get('action_executor')
+                or models.get_action_executor())
+    searcher_cfg['action_executor'] = ActionExecutor(
+        actions=[search(executor.actions['google_search'])])
+    searcher_cfg['page_fetcher'] = fetcher(
+        searcher_cfg.get('page_fetcher') or page_fetcher.get_page_fetcher())
+    agent.searcher_cfg = searcher_cfg
+    # 回答キャッシュが効くとサーチャーの呼び出しが記録・再生されない
+    agent.answer_cache = AnswerCache(max_size=0)
+    try:
+        yield
+    finally:
+        agent.llm, agent.searcher_cfg, agent.answer_cache = saved
+
+
+def record_run(agent,
+               query: str,
+               path: str,
+               config: Optional[Dict] = None,
+               **kwargs) -> Iterator:
+    """``agent.stream_deltas(query)`` を実行し、すべてを ``path`` に記録する。
+
+    ``config``（``lang`` など）は再生時にエージェントを作るために残す。
+    """
+    recorder = RunRecorder(path)
+    # 秒数などの値だけを残す（CancelToken や Deadline は再生時に作り直す）
+    recorder.write('run',
+                   query=query,
+                   config=config or {},
+                   kwargs={
+                       k: v
+                       for k, v in kwargs.items()
+                       if isinstance(v, (str, int, float, bool))
+                   })
+    with _patched(agent,
+                  lambda llm: RecordingLLM(llm, recorder, 'planner'),
+                  lambda llm: RecordingLLM(llm, recorder, 'searcher'),
+                  lambda action: RecordingSearch(action, recorder),
+                  lambda fetcher: RecordingPageFetcher(fetcher, recorder)):
+        try:
+            for delta in agent.stream_deltas(query, **kwargs):
+                recorder.write('delta', delta=delta_to_dict(delta))
+                yield delta
+        finally:
+            recorder.write('end')
+            recorder.close()
+
+
+def default_agent_factory(log: RunLog):
+    from .agent import init_agent
+    config = log.meta.get('config', {})
+    return init_agent(lang=config.get('lang', 'cn'), llm=object())
+
+
+def replay_run(path: str,
+               run: int = -1,
+               speed: Optional[float] = None,
+               agent_factory: Optional[Callable] = None,
+               log: Optional[RunLog] = None) -> Iterator:
+    """記録した実行を LLM・検索 API を呼ばずに再生し、差分を返す。
+
+    ``agent_factory(log)`` は記録時と同じプロンプト設定のエージェントを返す
+    こと（LLM は再生用に差し替えるので何でもよい）。
+    """
+    log = log or RunLog.load(path, run)
+    agent = (agent_factory or default_agent_factory)(log)
+    kwargs = log.meta.get('kwargs', {})
+    with _patched(agent, lambda _: ReplayLLM(log, 'planner', speed),
+                  lambda _: ReplayLLM(log, 'searcher', speed),
+                  lambda _: ReplaySearch(log, speed),
+                  lambda _: ReplayPageFetcher(log, speed)):
+        yield from agent.stream_deltas(log.meta['query'], **kwargs)
+
+
+def final_state(deltas) -> Dict:
+    """比較用に、差分から最終回答と各ノードの回答を取り出す。"""
+    reducer = AgentReturnReducer()
+    for delta in deltas:
+        reducer.apply(delta)
+    agent_return = reducer.agent_return
+    return dict(response=agent_return.response,
+                nodes={
+                    name: node.get('response')
+                    for name, node in agent_return.nodes.items()
+                })
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='記録した実行を再生し、所要時間と記録との一致を報告する')
+    parser.add_argument('path')
+    parser.add_argument('--run', type=int, default=-1)
+    parser.add_argument('--speed',
+                        type=float,
+                        default=None,
+                        help='1.0 で記録どおりの速さ。省略するとできるだけ速く')
+    args = parser.parse_args()
+
+    log = RunLog.load(args.path, args.run)
+    start = time.perf_counter()
+    replayed = list(replay_run(args.path, speed=args.speed, log=log))
+    print(
+        json.dumps(dict(query=log.meta.get('query'),
+                        recorded_s=log.seconds,
+                        replayed_s=time.perf_counter() - start,
+                        deltas=len(replayed),
+                        matches=final_state(replayed) == final_state(
+                            log.deltas)),
+                   ensure_ascii=False,
+                   indent=2))
+
+
+if __name__ == '__main__':
+    main()
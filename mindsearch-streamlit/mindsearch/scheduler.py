@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable
+
+
+class SearcherScheduler:
+    """プロセス全体で共有するサーチャージョブのスケジューラー。
+
+    同時実行数は ``max_workers`` で全体として制限され、待ち行列はセッション
+    ごとに分けてラウンドロビンで取り出す。大きなプランを投げたセッションが
+    他のユーザーを飢餓状態にしないためである。ワーカースレッドは必要に応じて
+    生成し、``idle_timeout`` 秒仕事がなければ終了する。
+    """
+
+    def __init__(self, max_workers: int = 10, idle_timeout: float = 30):
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+        self._workers = set()
+        self._idle = 0
+        self._running = 0
+        self._pending = 0
+        self._shutdown = False
+        self._submitted = 0
+        self._completed = 0
+        self._cancelled = 0
+        self._waits = deque(maxlen=1000)
+
+    def submit(self, session_id: Hashable, fn: Callable, *args,
+               **kwargs) -> Future:
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('cannot submit after shutdown')
+            self._queues.setdefault(session_id, deque()).append(
+                (future, fn, args, kwargs, time.monotonic()))
+            self._submitted += 1
+            self._pending += 1
+            if (self._pending > self._idle
+                    and len(self._workers) < self.max_workers):
+                worker = threading.Thread(target=self._work,
+                                          name='mindsearch-searcher',
+                                          daemon=True)
+                self._workers.add(worker)
+                worker.start()
+            self._cond.notify()
+        return future
+
+    def _pop_job(self):
+        for session_id in list(self._queues):
+            jobs = self._queues[session_id]
+            if not jobs:
+                del self._queues[session_id]
+                continue
+            job = jobs.popleft()
+            self._pending -= 1
+            # 取り出したセッションは末尾に回す（ラウンドロビン）
+            if jobs:
+                self._queues.move_to_end(session_id)
+            else:
+                del self._queues[session_id]
+            return job
+        return None
+
+    def _work(self):
+        current = threading.current_thread()
+        while True:
+            with self._cond:
+                job = self._pop_job()
+                while job is None:
+                    if self._shutdown:
+                        self._workers.discard(current)
+                        return
+                    self._idle += 1
+                    notified = self._cond.wait(self.idle_timeout)
+                    self._idle -= 1
+                    job = self._pop_job()
+                    if job is None and not notified:
+                        self._workers.discard(current)
+                        return
+                self._running += 1
+            future, fn, args, kwargs, enqueued_at = job
+            outcome = None
+            try:
+                if future.set_running_or_notify_cancel():
+                    self._waits.append(time.monotonic() - enqueued_at)
+                    try:
+                        outcome = future.set_result, fn(*args, **kwargs)
+                    except BaseException as exc:
+                        outcome = future.set_exception, exc
+            finally:
+                # 待っている側が結果を受け取った時点で統計が揃っているように、
+                # 先に数えてから future を完了させる
+                with self._cond:
+                    self._running -= 1
+                    self._completed += 1
+                if outcome is not None:
+                    outcome[0](outcome[1])
+
+    def close_session(self, session_id: Hashable) -> int:
+        """セッションの未実行ジョブをキャンセルし、キャンセル数を返す。"""
+        with self._cond:
+            jobs = self._queues.pop(session_id, deque())
+            self._pending -= len(jobs)
+        cancelled = sum(job[0].cancel() for job in jobs)
+        with self._cond:
+            self._cancelled += cancelled
+        return cancelled
+
+    def shutdown(self) -> None:
+        with self._cond:
+            self._shutdown = True
+            sessions = list(self._queues)
+            self._cond.notify_all()
+        for session_id in sessions:
+            self.close_session(session_id)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            waits = sorted(self._waits)
+            return dict(
+                queue_depth=self._pending,
+                queued_sessions=len(self._queues),
+                running=self._running,
+                workers=len(self._workers),
+                submitted=self._submitted,
+                completed=self._completed,
+                cancelled=self._cancelled,
+                wait_avg=sum(waits) / len(waits) if waits else 0.0,
+                wait_p95=waits[int(len(waits) * 0.95)] if waits else 0.0,
+                wait_max=waits[-1] if waits else 0.0,
+            )
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> SearcherScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = SearcherScheduler(max_workers=int(
+                os.environ.get('MINDSEARCH_SEARCHER_WORKERS', 10)))
+    return _scheduler
@@ -0,0 +1,206 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import aiohttp
+
+from .rate_limit import (DailyQuota, RateLimiter, get_daily_quota,
+                         get_rate_limiter, retry_after, retry_with_backoff)
+
+CSE_URL = 'https://www.googleapis.com/customsearch/v1'
+
+T = TypeVar('T')
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_search_loop() -> asyncio.AbstractEventLoop:
+    """検索用の共有イベントループ（専用スレッドで常駐）を返す。"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever,
+                             name='mindsearch-search-loop',
+                             daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def run_sync(coro: Awaitable[T],
+             timeout: Optional[float] = None,
+             cancel_token=None) -> T:
+    """ワーカースレッドから共有ループ上のコルーチンを実行して結果を待つ。
+
+    ``cancel_token`` がキャンセルされると実行中のコルーチンも取り消し、
+    ``concurrent.futures.CancelledError`` を送出する。``timeout`` を過ぎた
+    場合もコルーチンを取り消してから ``TimeoutError`` を送出する。
+    """
+    loop = get_search_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError('run_sync() cannot be called from the search loop')
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    if cancel_token is not None:
+        cancel_token.on_cancel(future.cancel)
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
+async def run_on_search_loop(coro: Awaitable[T]) -> T:
+    """任意のイベントループから共有ループ上のコルーチンを await する。"""
+    loop = get_search_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(
+        asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+class SingleFlight:
+    """同じキーの実行中の呼び出しを 1 つにまとめる（シングルフライト）。
+
+    キャッシュはまだ結果のない同時の呼び出しには効かないので、後から来た
+    呼び出しは先に始まった呼び出しの結果（または例外）を待つ。状態は共有
+    ループ上でだけ触るので、同期（``run_sync``）・非同期のどちらの経路から
+    呼んでもまとめられる。
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def _do(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # 待ち手の 1 つが取り消されても、他の待ち手の呼び出しは続ける
+        return await asyncio.shield(task)
+
+    async def do(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        return await run_on_search_loop(self._do(key, func))
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return dict(calls=self.calls,
+                    executed=self.calls - self.coalesced,
+                    coalesced=self.coalesced,
+                    inflight=len(self._inflight))
+
+
+def _retry_delay(error: Exception) -> Optional[float]:
+    # 429 の Retry-After は throttled() でバケットに反映済みなので、
+    # 再試行の前に重ねて待たない
+    if getattr(error, 'status', None) == 429:
+        return None
+    return retry_after(error)
+
+
+class AsyncSearchClient:
+    """Custom Search JSON API の非同期クライアント。
+
+    すべての呼び出しは共有ループ上の 1 つの ``aiohttp.ClientSession`` を使い、
+    keep-alive 付きの上限ありコネクションプールを共有する。リクエストは
+    API キーごとのレート制限を待ってから送り、1 日のクォータに数える。
+    429・5xx はバックオフして再試行する。
+    """
+
+    def __init__(self,
+                 api_key: Optional[str] = None,
+                 search_engine_id: Optional[str] = None,
+                 max_connections: int = 20,
+                 keepalive_timeout: float = 30,
+                 timeout: float = 10,
+                 max_retries: int = 4,
+                 limiter: Optional[RateLimiter] = None,
+                 quota: Optional[DailyQuota] = None,
+                 endpoint: str = CSE_URL):
+        self.api_key = api_key or os.environ.get('GOOGLE_API_KEY')
+        self.search_engine_id = search_engine_id or os.environ.get(
+            'GOOGLE_SEARCH_ENGINE_ID')
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.endpoint = endpoint
+        self.limiter = limiter if limiter is not None else get_rate_limiter()
+        self.quota = quota if quota is not None else get_daily_quota()
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # セッションはループに紐づくため、必ず共有ループ上で生成する
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def _request(self, params: Dict) -> Dict:
+        bucket = self.limiter.bucket(self.api_key or '')
+        await bucket.acquire()
+        self.quota.consume(self.api_key or '')
+        try:
+            async with self._get_session().get(self.endpoint,
+                                               params=params) as resp:
+                resp.raise_for_status()
+                result = await resp.json()
+        except aiohttp.ClientResponseError as e:
+            if e.status == 429:
+                bucket.throttled(retry_after(e))
+            raise
+        bucket.succeeded()
+        return result
+
+    async def _search(self, query: str, num_results: int) -> List[Dict]:
+        params = dict(key=self.api_key,
+                      cx=self.search_engine_id,
+                      q=query,
+                      num=num_results)
+        result = await retry_with_backoff(lambda: self._request(params),
+                                          retries=self.max_retries,
+                                          retry_delay=_retry_delay)
+        items = result.get('items', [])
+        return [{
+            'title': item['title'],
+            'link': item['link'],
+            'snippet': item.get('snippet', '')
+        } for item in items]
+
+    async def search(self, query: str, num_results: int = 5) -> List[Dict]:
+        return await run_on_search_loop(self._search(query, num_results))
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await run_on_search_loop(self._session.close())
+            self._session = None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_search_client() -> AsyncSearchClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = AsyncSearchClient(
+                max_connections=int(
+                    os.environ.get('GOOGLE_SEARCH_MAX_CONNECTIONS', 20)),
+                max_retries=int(os.environ.get('GOOGLE_SEARCH_RETRIES', 4)))
+    return _client
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from copy import deepcopy
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def normalize_query(query: str) -> str:
+    query = unicodedata.normalize('NFKC', query).casefold()
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+class TTLCache:
+    """スレッドセーフなインメモリ LRU キャッシュ（TTL 付き）。"""
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, stored_at = item
+                if not self._expired(stored_at):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.expirations += 1
+        loaded = self._load(key)
+        with self._lock:
+            if loaded is None:
+                self.misses += 1
+                return None
+            value, stored_at = loaded
+            self.hits += 1
+            self._put(key, value, stored_at)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        stored_at = time.time()
+        with self._lock:
+            self._put(key, value, stored_at)
+        self._store(key, value, stored_at)
+
+    def _put(self, key, value, stored_at):
+        self._data[key] = (value, stored_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, key: str) -> Optional[Tuple[Any, float]]:
+        return None
+
+    def _store(self, key: str, value: Any, stored_at: float) -> None:
+        pass
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    expirations=self.expirations,
+                    size=len(self._data))
+
+
+class SearchCache(TTLCache):
+    """検索結果用キャッシュ。``path`` を指定すると SQLite にも永続化する。"""
+
+    def __init__(self,
+                 max_size: int = 1024,
+                 ttl: Optional[float] = 3600,
+                 path: Optional[str] = None,
+                 max_disk_size: Optional[int] = None):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.path = path
+        self.max_disk_size = max_disk_size or max_size * 10
+        self._conn = None
+        self._db_lock = threading.Lock()
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS search_cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                'stored_at REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS '
+                               'search_cache_stored_at ON '
+                               'search_cache (stored_at)')
+            self._conn.commit()
+
+    @classmethod
+    def from_env(cls) -> 'SearchCache':
+        ttl = os.environ.get('GOOGLE_SEARCH_CACHE_TTL')
+        return cls(max_size=int(
+            os.environ.get('GOOGLE_SEARCH_CACHE_SIZE', 1024)),
+                   ttl=float(ttl) if ttl else 3600,
+                   path=os.environ.get('GOOGLE_SEARCH_CACHE_PATH'))
+
+    @staticmethod
+    def make_key(query: str, num_results: int) -> str:
+        return f'{num_results}:{normalize_query(query)}'
+
+    def _load(self, key):
+        if self._conn is None:
+            return None
+        with self._db_lock:
+            row = self._conn.execute(
+                'SELECT value, stored_at FROM search_cache WHERE key = ?',
+                (key, )).fetchone()
+            if row is None:
+                return None
+            value, stored_at = row
+            if self._expired(stored_at):
+                self._conn.execute('DELETE FROM search_cache WHERE key = ?',
+                                   (key, ))
+                self._conn.commit()
+                self.expirations += 1
+                return None
+        return json.loads(value), stored_at
+
+    def _store(self, key, value, stored_at):
+        if self._conn is None:
+            return
+        with self._db_lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), stored_at))
+            cur = self._conn.execute(
+                'DELETE FROM search_cache WHERE key IN ('
+                'SELECT key FROM search_cache ORDER BY stored_at DESC '
+                'LIMIT -1 OFFSET ?)', (self.max_disk_size, ))
+            self.evictions += max(cur.rowcount, 0)
+            self._conn.commit()
+
+    def close(self) -> None:
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.close()
+            self._conn = None
+
+
+class AnswerCache(TTLCache):
+    """完了したサーチャーノードの回答（``response`` と ``detail``）のキャッシュ。
+
+    キーはサブ質問・元の質問・親ノードの回答から作るので、同じサブ質問でも
+    前提となる回答が違えば別のエントリになる。
+    """
+
+    @classmethod
+    def from_env(cls) -> 'AnswerCache':
+        ttl = os.environ.get('MINDSEARCH_ANSWER_CACHE_TTL')
+        return cls(max_size=int(
+            os.environ.get('MINDSEARCH_ANSWER_CACHE_SIZE', 256)),
+                   ttl=float(ttl) if ttl else 3600)
+
+    @staticmethod
+    def make_key(question: str,
+                 root_question: Optional[str] = None,
+                 parent_response: Optional[List[dict]] = None) -> str:
+        parents = sorted((normalize_query(item['question']), item['answer'])
+                         for item in parent_response or [])
+        digest = hashlib.sha1(
+            json.dumps(parents, ensure_ascii=False).encode()).hexdigest()
+        return '\n'.join([
+            normalize_query(root_question or ''),
+            normalize_query(question), digest[:16]
+        ])
+
+    def get(self, key: str) -> Optional[Tuple[str, Any]]:
+        # 呼び出し側が detail を書き換えてもキャッシュに影響しないようにする
+        value = super().get(key)
+        return deepcopy(value) if value is not None else None
+
+    def set(self, key: str, value: Tuple[str, Any]) -> None:
+        super().set(key, deepcopy(value))
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache.from_env()
+    return _answer_cache
@@ -0,0 +1,248 @@
+"""MindSearch のヘッドレスな HTTP/SSE サーバー。
+
+使い方::
+
+    uvicorn mindsearch.server:app --host 0.0.0.0 --port 8002
+    curl -N -X POST localhost:8002/solve \\
+        -H 'Content-Type: application/json' -d '{"query": "..."}'
+
+1 つのプロセスでウォームなモデル（``ModelRegistry``）を共有し、各質問の
+差分（``stream_deltas``）を Server-Sent Events で送る。
+"""
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import time
+import uuid
+import weakref
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from .cancellation import CancelToken
+from .registry import get_registry
+from .streaming import delta_to_dict
+
+logger = logging.getLogger(__name__)
+
+
+class SolveRequest(BaseModel):
+    query: str
+    lang: str = 'cn'
+    model_format: str = os.environ.get('MINDSEARCH_MODEL_FORMAT',
+                                       'internlm_server')
+    # 質問の持ち時間（秒）。省略時はエージェントの既定値
+    deadline: Optional[float] = None
+
+
+def sse_event(event: str, data) -> str:
+    data = json.dumps(data, ensure_ascii=False, default=str)
+    return f'event: {event}\ndata: {data}\n\n'
+
+
+def default_agent_factory(request: SolveRequest):
+    from .agent import init_agent
+    return init_agent(lang=request.lang, model_format=request.model_format)
+
+
+class QueryServer:
+    """同時に実行する質問の数と待ち行列の長さを制限して差分を配信する。
+
+    エージェントは質問ごとにワーカースレッドで動かし、差分は質問ごとの
+    上限付きキューを通して送る。クライアントの読み出しが遅いとキューが
+    埋まり、エージェント側が待つ（バックプレッシャー）。待ち行列が
+    ``max_pending`` を超えた新しい質問は 503 で断る。接続が切れた質問は
+    取り消してワーカーを空ける。
+    """
+
+    def __init__(self,
+                 agent_factory: Optional[Callable] = None,
+                 max_queries: int = 8,
+                 max_pending: int = 32,
+                 buffer_size: int = 256,
+                 heartbeat: float = 15):
+        self.agent_factory = agent_factory or default_agent_factory
+        self.max_queries = max_queries
+        self.max_pending = max_pending
+        self.buffer_size = buffer_size
+        self.heartbeat = heartbeat
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_queries, thread_name_prefix='mindsearch-query')
+        self._slots = None
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.disconnected = 0
+
+    @classmethod
+    def from_env(cls, agent_factory: Optional[Callable] = None):
+        return cls(agent_factory,
+                   max_queries=int(os.environ.get('MINDSEARCH_MAX_QUERIES',
+                                                  8)),
+                   max_pending=int(os.environ.get('MINDSEARCH_MAX_PENDING',
+                                                  32)),
+                   buffer_size=int(
+                       os.environ.get('MINDSEARCH_STREAM_BUFFER', 256)))
+
+    def admit(self, request: SolveRequest) -> AsyncIterator[str]:
+        """待ち行列に空きがあれば質問を受け付け、差分を送るストリームを返す。"""
+        if self.waiting >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=503,
+                                detail='Too many pending queries',
+                                headers={'Retry-After': '1'})
+        # レスポンスの開始を待たずに数え、同時に来た質問も正しく断る
+        self.waiting += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.waiting -= 1
+
+        stream = self.stream(request, release)
+        # 応答が始まる前に接続が切れてストリームが捨てられても枠を返す
+        weakref.finalize(stream, release)
+        return stream
+
+    def _put(self, queue, loop, item, cancel_token) -> bool:
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=0.1)
+                return True
+            except concurrent.futures.TimeoutError:
+                # キューが一杯のまま接続が切れたら待つのをやめる
+                if cancel_token.cancelled:
+                    future.cancel()
+                    return False
+
+    def _produce(self, request, queue, loop, cancel_token):
+        try:
+            agent = self.agent_factory(request)
+            deltas = agent.stream_deltas(request.query,
+                                         cancel_token=cancel_token,
+                                         deadline=request.deadline)
+            try:
+                for delta in deltas:
+                    if not self._put(queue, loop,
+                                     ('delta', delta_to_dict(delta)),
+                                     cancel_token):
+                        break
+            finally:
+                deltas.close()
+        except Exception as e:
+            logger.exception(f'Query failed: {e}')
+            self._put(queue, loop, ('error', dict(message=str(e))),
+                      cancel_token)
+        self._put(queue, loop, ('done', None), cancel_token)
+
+    async def stream(self, request: SolveRequest,
+                     release: Callable[[], None]):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_queries)
+        query_id = uuid.uuid4().hex
+        cancel_token = CancelToken()
+        try:
+            yield sse_event('queued', dict(query_id=query_id))
+            await self._slots.acquire()
+        finally:
+            release()
+        self.running += 1
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.buffer_size)
+        finished = False
+        loop.run_in_executor(self.executor, self._produce, request, queue,
+                             loop, cancel_token)
+        try:
+            yield sse_event('started', dict(query_id=query_id))
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(
+                        queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    # プロキシに接続を切られないように定期的にコメントを送る
+                    yield ': ping\n\n'
+                    continue
+                if event == 'done':
+                    finished = True
+                    self.completed += 1
+                    yield sse_event('done',
+                                    dict(query_id=query_id,
+                                         seconds=time.monotonic() - start))
+                    break
+                yield sse_event(event, data)
+        finally:
+            if not finished:
+                self.disconnected += 1
+                cancel_token.cancel('disconnected')
+            self.running -= 1
+            self._slots.release()
+
+    def stats(self):
+        return dict(max_queries=self.max_queries,
+                    max_pending=self.max_pending,
+                    waiting=self.waiting,
+                    running=self.running,
+                    completed=self.completed,
+                    rejected=self.rejected,
+                    disconnected=self.disconnected)
+
+
+def create_app(agent_factory: Optional[Callable] = None,
+               server: Optional[QueryServer] = None) -> FastAPI:
+    server = server or QueryServer.from_env(agent_factory)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        # Streamlit 版と同じく、指定したモデルを起動時にロードしておく
+        preload = os.environ.get('MINDSEARCH_PRELOAD', '')
+        if preload:
+            get_registry().preload(
+                [fmt.strip() for fmt in preload.split(',') if fmt.strip()])
+        yield
+        server.executor.shutdown(wait=False, cancel_futures=True)
+
+    app = FastAPI(title='MindSearch', lifespan=lifespan)
+    app.state.query_server = server
+
+    @app.post('/solve')
+    async def solve(request: SolveRequest):
+        return StreamingResponse(server.admit(request),
+                                 media_type='text/event-stream',
+                                 headers={
+                                     'Cache-Control': 'no-cache',
+                                     'X-Accel-Buffering': 'no'
+                                 })
+
+    @app.get('/health')
+    async def health():
+        return dict(models=get_registry().status(), queries=server.stats())
+
+    return app
+
+
+app = create_app()
+
+
+def main():
+    import argparse
+
+    import uvicorn
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8002)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import logging
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from lagent.schema import ModelStatusCode
+from lagent.utils.util import filter_suffix
+
+logger = logging.getLogger(__name__)
+
+
+class InteractiveChat:
+    """LMDeploy の対話モード（``/v1/chat/interactive``）で 1 つのセッションを続ける。
+
+    プロンプトは ``LMDeployServer.stream_chat`` と同じく ``template_parser``
+    で文字列にする。サーバーがセッションの履歴と KV キャッシュを持つので、
+    2 ターン目以降は、会話全体を描画した文字列のうち、サーバーが既に持って
+    いる部分（前のプロンプトと生成結果）より後ろだけを送る。前の続きに
+    ならなければセッションを終了して最初から送り直す。
+    """
+
+    def __init__(self, llm, session_id: int):
+        self.llm = llm
+        self.session_id = session_id
+        self.started = False
+        # 最後に最後まで生成できたターンで、サーバー側の履歴にある文字列
+        self._history: Optional[str] = None
+
+    @staticmethod
+    def supported(llm) -> bool:
+        from lagent.llms import LMDeployServer
+
+        # LMDeployClient も LMDeployServer のサブクラス。記録用のラッパーなどは
+        # 通常の stream_chat を通す
+        return isinstance(llm, LMDeployServer) and callable(
+            getattr(llm.client, 'chat_interactive_v1', None))
+
+    def _new_text(self, prompt: str) -> Optional[str]:
+        history = self._history
+        if history is None or not prompt.startswith(history):
+            return None
+        return prompt[len(history):] or None
+
+    def stream_chat(self, messages: List[dict], **kwargs):
+        prompt = self.llm.template_parser(messages)
+        text = self._new_text(prompt)
+        if text is None:
+            if self.started:
+                self.end()
+            text = prompt
+        # 途中で打ち切られたターンはサーバー側の履歴と食い違うので、完了まで空にする
+        self._history = None
+        self.started = True
+        params = self.llm.update_gen_params(**kwargs)
+        stop_words = params.get('stop_words')
+        response = ''
+        for output in self.llm.client.chat_interactive_v1(
+                text,
+                session_id=self.session_id,
+                interactive_mode=True,
+                stream=True,
+                stop=stop_words,
+                request_output_len=params.get('max_new_tokens'),
+                top_p=params.get('top_p', 0.8),
+                top_k=params.get('top_k', 40),
+                temperature=params.get('temperature', 0.8),
+                repetition_penalty=params.get('repetition_penalty', 1.0),
+                skip_special_tokens=False):
+            response += output.get('text', '')
+            if response:
+                yield (ModelStatusCode.STREAM_ING,
+                       filter_suffix(response, stop_words), None)
+        # 停止語も含めて生成した文字列がそのままサーバー側の履歴に残る
+        self._history = prompt + response
+        yield ModelStatusCode.END, filter_suffix(response, stop_words), None
+
+    def end(self) -> None:
+        """サーバー側のセッション（履歴と KV キャッシュ）を終了する。"""
+        self._history = None
+        if not self.started:
+            return
+        self.started = False
+        try:
+            for _ in self.llm.client.chat_interactive_v1(
+                    '',
+                    session_id=self.session_id,
+                    interactive_mode=False,
+                    request_output_len=0):
+                pass
+        except Exception as e:
+            logger.warning(f'Failed to end session {self.session_id}: {e}')
+
+
+class SessionManager:
+    """LLM バックエンドに渡す ``session_id`` を衝突なく払い出す。
+
+    ID は単調増加で割り当て、使用中の ID は上限で折り返した後も再利用しない。
+    プランナーは 1 つの質問の全ターンを ``stream_chat`` で同じセッションに
+    送る。``MINDSEARCH_INTERACTIVE_SESSIONS=1`` のときは、LMDeploy の
+    バックエンドに対話モードでサーバーに履歴を持たせ、解放時にセッションを
+    終了する。既定ではどのバックエンドにも毎回プロンプト全体を送る。サーチャーは 1 回で終わる生成なので ID を払い出すだけで、
+    共通の接頭辞の再利用はエンジン側のプレフィックスキャッシュに任せる。
+    """
+
+    def __init__(self,
+                 start: int = 1,
+                 limit: int = 2**31 - 1,
+                 on_release: Optional[Callable[[int], None]] = None):
+        self.start = start
+        self.limit = limit
+        self.on_release = on_release
+        self._next = start
+        self._in_use: Dict[int, Optional[str]] = {}
+        self._chats: Dict[int, InteractiveChat] = {}
+        self.interactive = os.environ.get('MINDSEARCH_INTERACTIVE_SESSIONS',
+                                          '0') != '0'
+        self._lock = threading.Lock()
+
+    def acquire(self, group: Optional[str] = None) -> int:
+        with self._lock:
+            if len(self._in_use) >= self.limit - self.start:
+                raise RuntimeError('no free session ids')
+            while self._next in self._in_use:
+                self._advance()
+            session_id = self._next
+            self._advance()
+            self._in_use[session_id] = group
+            return session_id
+
+    def _advance(self):
+        self._next += 1
+        if self._next >= self.limit:
+            self._next = self.start
+
+    def stream_chat(self, session_id: int, llm, messages: List[dict],
+                    **kwargs):
+        """``session_id`` のセッションで 1 ターン生成する（複数ターン用）。"""
+        if self.interactive and InteractiveChat.supported(llm):
+            with self._lock:
+                chat = self._chats.get(session_id)
+                if chat is None or chat.llm is not llm:
+                    chat = self._chats[session_id] = InteractiveChat(
+                        llm, session_id)
+            return chat.stream_chat(messages, **kwargs)
+        return llm.stream_chat(messages, session_id=session_id, **kwargs)
+
+    def release(self, session_id: int, llm=None) -> None:
+        with self._lock:
+            self._in_use.pop(session_id, None)
+            chat = self._chats.pop(session_id, None)
+        # 対話モードで開いたセッションはサーバー側の履歴と KV キャッシュを解放する
+        if chat is not None:
+            chat.end()
+        end_session = getattr(llm, 'end_session', None)
+        if callable(end_session):
+            end_session(session_id)
+        if self.on_release is not None:
+            self.on_release(session_id)
+
+    @contextmanager
+    def session(self, group: Optional[str] = None, llm=None):
+        session_id = self.acquire(group)
+        try:
+            yield session_id
+        finally:
+            self.release(session_id, llm)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            groups = Counter(group or 'default'
+                             for group in self._in_use.values())
+            return dict(active=len(self._in_use),
+                        interactive=sum(chat.started
+                                        for chat in self._chats.values()),
+                        groups=dict(groups))
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_session_manager() -> SessionManager:
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = SessionManager()
+    return _manager
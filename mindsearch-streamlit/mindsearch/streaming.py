@@ -0,0 +1,213 @@
+from copy import deepcopy
+from dataclasses import asdict, dataclass, fields
+from typing import Any, Dict, List, Optional
+
+from lagent.schema import (ActionReturn, ActionStatusCode, ActionValidCode,
+                           AgentReturn, AgentStatusCode)
+
+from .graph_index import FINISHED, RUNNING, Edge, GraphIndex, Node
+
+
+@dataclass
+class ResponseUpdated:
+    """プランナーの応答テキストの差分。``replace`` の場合は全文を置き換える。"""
+    state: AgentStatusCode
+    text: str
+    replace: bool = False
+
+
+@dataclass
+class NodeAdded:
+    name: str
+    node_type: str
+    content: Optional[str] = None
+
+
+@dataclass
+class EdgeAdded:
+    start: str
+    end: str
+    edge_id: int
+
+
+@dataclass
+class TokenAppended:
+    """サーチャーノードの応答テキストの差分。"""
+    name: str
+    text: str
+    state: AgentStatusCode
+    replace: bool = False
+
+
+@dataclass
+class NodeFinished:
+    name: str
+    response: str
+    detail: Any = None
+
+
+@dataclass
+class ReferencesUpdated:
+    references: Dict[str, str]
+
+
+@dataclass
+class StepsUpdated:
+    inner_steps: List[dict]
+
+
+@dataclass
+class StateChanged:
+    state: AgentStatusCode
+
+
+@dataclass
+class BudgetReported:
+    """持ち時間の使い道の内訳（``Deadline.report()``）。質問の最後に 1 回送る。"""
+    report: Dict[str, Any]
+
+
+NODE_DELTAS = (NodeAdded, TokenAppended, NodeFinished)
+DELTA_TYPES = {
+    cls.__name__: cls
+    for cls in (ResponseUpdated, NodeAdded, EdgeAdded, TokenAppended,
+                NodeFinished, ReferencesUpdated, StepsUpdated, StateChanged,
+                BudgetReported)
+}
+
+
+def _agent_return_to_dict(agent_return: AgentReturn) -> Dict[str, Any]:
+    # フィールドにない属性（lagent のバージョンによっては type・content）も残す
+    data = asdict(agent_return)
+    for key, value in vars(agent_return).items():
+        data.setdefault(key, value)
+    return data
+
+
+def _agent_return_from_dict(data: Dict[str, Any]) -> AgentReturn:
+    names = {f.name for f in fields(AgentReturn)}
+    data = dict(data)
+    data['state'] = AgentStatusCode(data.get('state', 0))
+    data['actions'] = [
+        _action_return_from_dict(action) if isinstance(action, dict) else
+        action for action in data.get('actions') or []
+    ]
+    agent_return = AgentReturn(
+        **{k: v
+           for k, v in data.items() if k in names})
+    for key, value in data.items():
+        if key not in names:
+            setattr(agent_return, key, value)
+    return agent_return
+
+
+def _action_return_from_dict(data: Dict[str, Any]) -> ActionReturn:
+    data = dict(data)
+    data['state'] = ActionStatusCode(data.get('state', 0))
+    if data.get('valid') is not None:
+        data['valid'] = ActionValidCode(data['valid'])
+    return ActionReturn(**data)
+
+
+def delta_to_dict(delta) -> Dict[str, Any]:
+    """差分を JSON にできる dict にする（SSE などでプロセスの外に送る用）。"""
+    data = dict(type=type(delta).__name__, **asdict(delta))
+    if isinstance(getattr(delta, 'detail', None), AgentReturn):
+        data['detail'] = _agent_return_to_dict(delta.detail)
+    return data
+
+
+def delta_from_dict(data: Dict[str, Any]):
+    """``delta_to_dict`` の逆。リデューサーにそのまま渡せる差分に戻す。"""
+    data = dict(data)
+    cls = DELTA_TYPES[data.pop('type')]
+    if 'state' in data:
+        data['state'] = AgentStatusCode(data['state'])
+    if isinstance(data.get('detail'), dict):
+        data['detail'] = _agent_return_from_dict(data['detail'])
+    return cls(**data)
+
+
+class AgentReturnReducer:
+    """差分ストリームから ``AgentReturn`` の全体状態を復元するリデューサー。"""
+
+    def __init__(self, inner_steps: Optional[List[dict]] = None):
+        self.agent_return = AgentReturn()
+        self.agent_return.type = 'planner'
+        self.agent_return.nodes = {}
+        self.agent_return.adjacency_list = {}
+        self.agent_return.inner_steps = list(inner_steps or [])
+        self.index = GraphIndex()
+
+    def apply(self, delta) -> Optional[str]:
+        """差分を適用し、ノードに関する差分であればそのノード名を返す。"""
+        agent_return = self.agent_return
+        if isinstance(delta, ResponseUpdated):
+            agent_return.state = delta.state
+            agent_return.response = delta.text if delta.replace else (
+                agent_return.response or '') + delta.text
+        elif isinstance(delta, NodeAdded):
+            node = Node(delta.name, delta.node_type, delta.content)
+            agent_return.nodes[node.name] = node
+            self.index.add_node(delta.name)
+            return delta.name
+        elif isinstance(delta, EdgeAdded):
+            agent_return.adjacency_list.setdefault(delta.start, []).append(
+                self.index.add_edge(delta.start, delta.end,
+                                    Edge(delta.edge_id, delta.end)))
+        elif isinstance(delta, TokenAppended):
+            node = self._searcher_node(delta.name)
+            node.response = delta.text if delta.replace else (
+                node.response or '') + delta.text
+            detail = node.detail
+            if detail is None:
+                detail = AgentReturn()
+                detail.type = 'searcher'
+                detail.content = node.content
+                node.detail = detail
+            detail.state = delta.state
+            detail.response = node.response
+            self._set_node_status(delta.name, delta.state)
+            return delta.name
+        elif isinstance(delta, NodeFinished):
+            node = self._searcher_node(delta.name)
+            node.response = delta.response
+            node.detail = delta.detail
+            self._set_node_status(delta.name, delta.detail.state)
+            return delta.name
+        elif isinstance(delta, ReferencesUpdated):
+            agent_return.references.update(delta.references)
+        elif isinstance(delta, StepsUpdated):
+            agent_return.inner_steps = list(delta.inner_steps)
+        elif isinstance(delta, StateChanged):
+            agent_return.state = delta.state
+        elif isinstance(delta, BudgetReported):
+            agent_return.budget = delta.report
+        return None
+
+    def _searcher_node(self, name):
+        node = self.agent_return.nodes.get(name)
+        if node is None:
+            node = Node(name, 'searcher')
+            self.agent_return.nodes[node.name] = node
+        return node
+
+    def _set_node_status(self, name, state):
+        self.index.set_status(
+            name, FINISHED if state == AgentStatusCode.END else RUNNING)
+
+    def snapshot(self, as_dict: bool = False) -> AgentReturn:
+        snapshot = deepcopy(self.agent_return)
+        if as_dict:
+            snapshot.nodes = {
+                name: node.to_dict()
+                for name, node in snapshot.nodes.items()
+            }
+            for node in snapshot.nodes.values():
+                if node.get('detail') is not None:
+                    node['detail'] = asdict(node['detail'])
+            snapshot.adjacency_list = {
+                start: [edge.to_dict() for edge in edges]
+                for start, edges in snapshot.adjacency_list.items()
+            }
+        return snapshot
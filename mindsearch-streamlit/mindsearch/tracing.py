@@ -0,0 +1,205 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+_current_span = contextvars.ContextVar('mindsearch_span', default=None)
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'trace_id', 'span_id', 'parent_id',
+                 'start', 'end_time', 'attributes', 'tokens', '_token')
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end_time = None
+        self.attributes = attributes
+        self.tokens = 0
+        self._token = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def mark_token(self, count: int = 1) -> None:
+        """ストリーミングのトークン（チャンク）を記録する。最初の 1 回で TTFT を取る。"""
+        if not self.tokens:
+            self.attributes['ttft'] = time.time() - self.start
+        self.tokens += count
+
+    def end(self) -> None:
+        if self.end_time is not None:
+            return
+        self.end_time = time.time()
+        if self.tokens:
+            self.attributes['tokens'] = self.tokens
+        self.tracer._export(self)
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.attributes['error'] = repr(exc)
+        self.end()
+
+    def to_dict(self) -> Dict:
+        return dict(trace_id=self.trace_id,
+                    span_id=self.span_id,
+                    parent_id=self.parent_id,
+                    name=self.name,
+                    start=self.start,
+                    end=self.end_time,
+                    duration=(self.end_time or time.time()) - self.start,
+                    attributes=self.attributes)
+
+
+class _NullSpan:
+    """トレース無効時に返す何もしないスパン。"""
+    __slots__ = ()
+    trace_id = None
+    span_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def mark_token(self, count=1):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class JsonLinesExporter:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return dict(boolValue=value)
+    if isinstance(value, int):
+        return dict(intValue=str(value))
+    if isinstance(value, float):
+        return dict(doubleValue=value)
+    return dict(stringValue=str(value))
+
+
+class OTLPJsonExporter(JsonLinesExporter):
+    """OTLP/JSON（``ExportTraceServiceRequest``）形式で 1 スパン 1 行書き出す。
+
+    出力は OpenTelemetry Collector の ``otlpjsonfile`` レシーバーで読み込める。
+    """
+
+    def __init__(self, path: str, service_name: str = 'mindsearch'):
+        super().__init__(path)
+        self.service_name = service_name
+
+    def export(self, span: Span) -> None:
+        otlp_span = dict(
+            traceId=span.trace_id,
+            spanId=span.span_id,
+            name=span.name,
+            kind=1,
+            startTimeUnixNano=str(int(span.start * 1e9)),
+            endTimeUnixNano=str(int(span.end_time * 1e9)),
+            attributes=[
+                dict(key=key, value=_otlp_value(value))
+                for key, value in span.attributes.items()
+            ],
+            status=dict(code=2 if 'error' in span.attributes else 1))
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+        request = dict(resourceSpans=[
+            dict(resource=dict(attributes=[
+                dict(key='service.name',
+                     value=dict(stringValue=self.service_name))
+            ]),
+                 scopeSpans=[
+                     dict(scope=dict(name='mindsearch'), spans=[otlp_span])
+                 ])
+        ])
+        line = json.dumps(request, ensure_ascii=False)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+class InMemoryExporter:
+
+    def __init__(self):
+        self.spans: List[Span] = []
+
+    def export(self, span: Span) -> None:
+        self.spans.append(span)
+
+
+class Tracer:
+    """スパンを記録してエクスポーターに渡す。無効時は ``NULL_SPAN`` を返すだけ。"""
+
+    def __init__(self, exporters=None):
+        self.exporters = list(exporters or [])
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    @classmethod
+    def from_env(cls) -> 'Tracer':
+        path = os.environ.get('MINDSEARCH_TRACE')
+        if not path:
+            return cls()
+        if os.environ.get('MINDSEARCH_TRACE_FORMAT', 'jsonl') == 'otlp':
+            return cls([OTLPJsonExporter(path)])
+        return cls([JsonLinesExporter(path)])
+
+    def add_exporter(self, exporter) -> None:
+        self.exporters.append(exporter)
+
+    def current_span(self):
+        return _current_span.get()
+
+    def start_span(self, name: str, parent=None, **attributes):
+        """スパンを開始する。``parent`` を省略すると現在のスパンの子になる。
+
+        ジェネレーターのようにスレッドやコンテキストをまたぐ場合は ``with``
+        を使わずに ``parent`` を明示し、``end()`` で終了する。
+        """
+        if not self.exporters:
+            return NULL_SPAN
+        if parent is None:
+            parent = _current_span.get()
+        if parent is None or parent is NULL_SPAN:
+            return Span(self, name, uuid.uuid4().hex, None, attributes)
+        return Span(self, name, parent.trace_id, parent.span_id, attributes)
+
+    def _export(self, span: Span) -> None:
+        for exporter in self.exporters:
+            exporter.export(span)
+
+
+tracer = Tracer.from_env()
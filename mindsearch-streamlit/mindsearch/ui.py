@@ -0,0 +1,191 @@
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, Optional, TypeVar
+
+import streamlit as st
+from lagent.schema import AgentReturn, AgentStatusCode
+
+NODE_ICONS = {'done': '✅', 'running': '⏳', 'waiting': '⬜'}
+
+T = TypeVar('T')
+
+
+class FrameThrottle:
+    """描画を 1 秒あたり ``fps`` 回までに抑える。間の状態は捨てて最新だけ描く。"""
+
+    def __init__(self, fps: float = 10,
+                 clock: Callable[[], float] = time.monotonic):
+        self.interval = 1 / fps if fps else 0
+        self.clock = clock
+        self._last = None
+        self.frames = 0
+        self.skipped = 0
+
+    def ready(self) -> bool:
+        now = self.clock()
+        if self._last is not None and now - self._last < self.interval:
+            self.skipped += 1
+            return False
+        self._last = now
+        self.frames += 1
+        return True
+
+
+def tick_every(iterable: Iterable[T],
+               interval: Optional[float]) -> Iterator[Optional[T]]:
+    """``iterable`` を別スレッドで回し、間が空いたら ``None`` を挟んで返す。
+
+    要素が ``interval`` 秒来なければ ``None`` を返す。差分が途切れている間も読み手が起こされるので、間引いたままの描画を
+    ``StreamRenderer.flush`` で流せる。読み手がやめたら、元のイテレータは
+    次の要素を出したところで閉じる。
+    """
+    items = queue.Queue(maxsize=256)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(('item', item)):
+                    break
+        except Exception as e:
+            put(('error', e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+        put(('done', None))
+
+    threading.Thread(target=produce, name='mindsearch-ui-stream',
+                     daemon=True).start()
+    try:
+        while True:
+            try:
+                kind, item = items.get(timeout=interval)
+            except queue.Empty:
+                yield None
+                continue
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def node_status(node: Dict) -> str:
+    detail = node.get('detail')
+    if detail is not None and detail.state == AgentStatusCode.END:
+        return 'done'
+    return 'running' if node.get('response') else 'waiting'
+
+
+class StreamRenderer:
+    """``AgentReturnReducer`` の状態をプレースホルダーに上書きして描く。
+
+    トークンごとにウィジェットを作り直さず、回答・ノードの進み具合は同じ
+    ``st.empty()`` をその場で更新する。グラフのエッジと参考文献は増える
+    一方なので、新しく増えた分だけを書き足す。``update`` はフレームレートを
+    超える呼び出しを何もせずに返すので、トークンのストリームを遅くしない。
+    描かなかった状態は残しておき、``flush`` で次のフレームに描く。
+    """
+
+    def __init__(self, fps: float = 10):
+        self.throttle = FrameThrottle(fps)
+        self.response = st.empty()
+        with st.expander('検索の進み具合', expanded=True):
+            self.progress = st.progress(0.0)
+            self.nodes = st.container()
+        with st.expander('検索グラフ'):
+            self.graph = st.container()
+        st.write('参考文献:')
+        self.references = st.container()
+        self._node_slots = {}
+        self._node_views = {}
+        self._edges = set()
+        self._reference_keys = set()
+        self._response = None
+        self._progress = None
+        self._pending = None
+
+    def update(self, agent_return: AgentReturn, force: bool = False) -> bool:
+        if not force and not self.throttle.ready():
+            self._pending = agent_return
+            return False
+        self._pending = None
+        self._render_response(agent_return)
+        self._render_nodes(agent_return)
+        self._render_graph(agent_return)
+        self._render_references(agent_return)
+        return True
+
+    @property
+    def dirty(self) -> bool:
+        """間引かれてまだ描いていない状態があるか。"""
+        return self._pending is not None
+
+    def flush(self) -> bool:
+        """間引かれた最新の状態を、フレームの間隔が空いていれば描く。"""
+        if self._pending is None:
+            return False
+        return self.update(self._pending)
+
+    def _render_response(self, agent_return):
+        response = agent_return.response or ''
+        if response != self._response:
+            self._response = response
+            self.response.markdown(response)
+
+    def _render_nodes(self, agent_return):
+        searchers = {
+            name: node
+            for name, node in (agent_return.nodes or {}).items()
+            if node.get('type') == 'searcher'
+        }
+        done = 0
+        for name, node in searchers.items():
+            status = node_status(node)
+            done += status == 'done'
+            view = (f"{NODE_ICONS[status]} **{name}**: "
+                    f"{node.get('content') or ''} "
+                    f"（{len(node.get('response') or '')} 文字）")
+            if self._node_views.get(name) == view:
+                continue
+            if name not in self._node_slots:
+                self._node_slots[name] = self.nodes.empty()
+            self._node_slots[name].markdown(view)
+            self._node_views[name] = view
+        if searchers and self._progress != (done, len(searchers)):
+            self._progress = (done, len(searchers))
+            self.progress.progress(done / len(searchers),
+                                   text=f'{done}/{len(searchers)} ノード完了')
+
+    def _render_graph(self, agent_return):
+        for start, edges in (agent_return.adjacency_list or {}).items():
+            for edge in edges:
+                if (start, edge['name']) in self._edges:
+                    continue
+                self._edges.add((start, edge['name']))
+                self.graph.markdown(f"`{start}` → `{edge['name']}`")
+
+    def _render_references(self, agent_return):
+        for key, value in (agent_return.references or {}).items():
+            if key in self._reference_keys:
+                continue
+            self._reference_keys.add(key)
+            self.references.write(f'{key}: {value}')
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return dict(frames=self.throttle.frames,
+                    skipped=self.throttle.skipped)
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pytest
+from lagent.schema import AgentReturn, AgentStatusCode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# mindsearch パッケージと、ベンチマーク用の偽の LLM・検索バックエンドを使う
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from mindsearch import agent as agent_module  # noqa: E402
+from mindsearch.agent import WebSearchGraph  # noqa: E402
+from mindsearch.scheduler import SearcherScheduler  # noqa: E402
+from mindsearch.search_cache import AnswerCache  # noqa: E402
+
+
+class FakeSearcher:
+    """``searcher_cfg['run']`` を呼んで回答を返すサーチャー。"""
+
+    def __init__(self, run):
+        self.run = run
+
+    def stream_chat(self, question, root_question, parent_response=None,
+                    cancel_token=None, **kwargs):
+        answer = AgentReturn(state=AgentStatusCode.STREAM_ING)
+        for text in self.run(question, parent_response, cancel_token):
+            answer.response = text
+            yield answer
+        answer.state = AgentStatusCode.END
+        yield answer
+
+
+@pytest.fixture
+def make_graph(monkeypatch):
+    monkeypatch.setattr(agent_module, 'SearcherAgent', FakeSearcher)
+    graphs = []
+
+    def make_graph(run, edges, workers=4):
+        graph = WebSearchGraph()
+        graph.scheduler = SearcherScheduler(max_workers=workers)
+        graph.answer_cache = AnswerCache(max_size=0)
+        graph.searcher_cfg = dict(run=run)
+        graph.add_root_node('question')
+        for name in dict.fromkeys(n for edge in edges for n in edge):
+            if name != 'root':
+                graph.add_node(name, name)
+        for start, end in edges:
+            graph.add_edge(start, end)
+        graphs.append(graph)
+        return graph
+
+    yield make_graph
+    for graph in graphs:
+        graph.close()
+        graph.scheduler.shutdown()
@@ -0,0 +1,258 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from mindsearch.batch_generation import BatchedGenerationService
+
+EOS, STOP = 0, 1
+VOCAB = ['</s>', '<|action_end|>'] + list('abcdefghijklmnopqrstuvwxyz')
+
+
+class FakeTokenizer:
+    """1 文字 1 トークンの語彙に、``</s>`` と特殊トークンを 1 つ足したもの。"""
+
+    eos_token_id = EOS
+    pad_token_id = None
+
+    def encode(self, text, add_special_tokens=True):
+        if text in VOCAB:
+            return [VOCAB.index(text)]
+        return [VOCAB.index(char) for char in text]
+
+    def __call__(self, text):
+        return dict(input_ids=self.encode(text))
+
+    def decode(self, ids, skip_special_tokens=False):
+        return ''.join(VOCAB[idx] for idx in ids
+                       if not (skip_special_tokens and idx in (EOS, STOP)))
+
+
+class ByteTokenizer:
+    """UTF-8 のバイトを 1 トークンとするトークナイザー。``decode`` の呼び出しを記録する。"""
+
+    eos_token_id = 0
+    pad_token_id = None
+
+    def __init__(self):
+        self.decoded = []
+
+    def encode(self, text, add_special_tokens=True):
+        return list(text.encode())
+
+    def __call__(self, text):
+        return dict(input_ids=self.encode(text))
+
+    def decode(self, ids, skip_special_tokens=False):
+        self.decoded.append(len(ids))
+        return bytes(ids).decode(errors='replace')
+
+
+class Gate:
+    """モデルの呼び出しを止めておき、その間にリクエストを積むためのもの。"""
+
+    def __init__(self):
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def wait(self):
+        self.entered.set()
+        self.gate.wait(5)
+
+
+class FakeModel(Gate):
+    """KV キャッシュに入力トークンをそのまま持つ 1 層のモデル。
+
+    各行の系列をキャッシュとマスクから復元して ``rule`` で次のトークンを
+    決めるので、キャッシュの結合・選択・左詰めがずれると出力が変わる。
+    """
+
+    def __init__(self, rule):
+        super().__init__()
+        self.rule = rule
+
+    def parameters(self):
+        import torch
+        return iter([torch.zeros(1)])
+
+    def __call__(self, input_ids, attention_mask, position_ids,
+                 past_key_values=None, use_cache=True):
+        import torch
+        self.wait()
+        keys = (input_ids + 1).float()[:, None, :, None]
+        if past_key_values is not None:
+            keys = torch.cat([past_key_values[0][0], keys], dim=2)
+        assert keys.size(2) == attention_mask.size(1)
+        logits = torch.zeros(input_ids.size(0), input_ids.size(1), len(VOCAB))
+        for row in range(input_ids.size(0)):
+            seq = [
+                int(key) - 1
+                for key, seen in zip(keys[row, 0, :, 0], attention_mask[row])
+                if seen
+            ]
+            assert int(position_ids[row, -1]) == len(seq) - 1
+            logits[row, -1, self.rule(seq)] = 1.0
+        return SimpleNamespace(logits=logits,
+                               past_key_values=((keys, keys.clone()), ))
+
+
+class ListService(BatchedGenerationService):
+    """テンソルの代わりに、行ごとの系列のリストを KV キャッシュとするサービス。
+
+    torch なしでスケジューリング（バッチへの追加・終わった行の除去）と
+    停止語の処理を確かめる。デコードのたびにキャッシュの各行がその行の
+    リクエストの系列と一致することを確かめる。
+    """
+
+    def __init__(self, rule, tokenizer, **kwargs):
+        self.rule = rule
+        self.model_gate = Gate()
+        super().__init__(
+            SimpleNamespace(
+                parameters=lambda: iter([SimpleNamespace(device='cpu')])),
+            tokenizer, **kwargs)
+
+    def _prefill(self, requests):
+        self.model_gate.wait()
+        cache = [list(request.input_ids) for request in requests]
+        return [self.rule(seq) for seq in cache], cache, None
+
+    def _decode(self, requests, cache, mask):
+        self.model_gate.wait()
+        for request, seq in zip(requests, cache):
+            seq.append(request.generated[-1])
+            assert seq == request.input_ids + request.generated
+        return [self.rule(seq) for seq in cache], cache, None
+
+    def _merge(self, cache, mask, new_cache, new_mask):
+        return (cache or []) + new_cache, None
+
+    @staticmethod
+    def _select(cache, mask, keep):
+        return [cache[idx] for idx in keep], None
+
+    def _sample(self, request, logits):
+        return logits
+
+
+@pytest.fixture(params=['list', 'torch'])
+def make_service(request):
+    """``rule`` で次のトークンを決めるサービスと、そのモデルの ``Gate``。"""
+
+    def make(rule, tokenizer=None):
+        tokenizer = tokenizer or FakeTokenizer()
+        if request.param == 'list':
+            service = ListService(rule, tokenizer)
+            return service, service.model_gate
+        pytest.importorskip('torch')
+        model = FakeModel(rule)
+        return BatchedGenerationService(model, tokenizer), model
+
+    return make
+
+
+def checksum(seq):
+    # 系列全体に依存するので、どこかがずれると以降の出力が全部変わる
+    return 2 + sum(seq) % 26
+
+
+def reference(rule, prompt, max_new_tokens):
+    seq, out = FakeTokenizer().encode(prompt), []
+    while len(out) < max_new_tokens:
+        token = rule(seq)
+        if token in (EOS, STOP):
+            break
+        seq.append(token)
+        out.append(token)
+    return FakeTokenizer().decode(out)
+
+
+def generate(service, prompt, **kwargs):
+    texts = [text for _, text in service.stream(prompt, temperature=0,
+                                                **kwargs)]
+    return texts[-1]
+
+
+def test_requests_joining_and_leaving_a_batch_match_solo_runs(make_service):
+    service, model = make_service(checksum)
+    jobs = dict(a=('hello', 8), b=('xy', 3), c=('batching', 6))
+    results = {}
+
+    def run(name):
+        prompt, max_new_tokens = jobs[name]
+        results[name] = generate(service, prompt,
+                                 max_new_tokens=max_new_tokens)
+
+    model.gate.clear()
+    threads = {name: threading.Thread(target=run, args=(name, ))
+               for name in jobs}
+    threads['a'].start()
+    # a のプリフィル中に b と c を積み、次のステップで a のキャッシュに結合させる
+    assert model.entered.wait(5)
+    threads['b'].start()
+    threads['c'].start()
+    while service._waiting.qsize() < 2:
+        time.sleep(0.01)
+    model.gate.set()
+    for thread in threads.values():
+        thread.join(5)
+
+    assert results == {
+        name: reference(checksum, prompt, max_new_tokens)
+        for name, (prompt, max_new_tokens) in jobs.items()
+    }
+    # a の単独プリフィル + (a のデコードと b, c のプリフィル) + デコード 6 回
+    assert service.stats()['steps'] == 8
+
+
+def test_special_stop_word_ends_generation(make_service):
+
+    def rule(seq):
+        return STOP if seq[-2:] == [VOCAB.index('x')] * 2 else VOCAB.index('x')
+
+    service, _ = make_service(rule)
+    assert generate(service, 'ab', max_new_tokens=8,
+                    stop_words=['<|action_end|>']) == 'xx'
+    # 停止語に指定しなければ特殊トークンも本文に残る
+    assert generate(service, 'ab', max_new_tokens=4) == 'xx<|action_end|>x'
+
+
+def test_text_stop_word_truncates_output(make_service):
+
+    def rule(seq):
+        return VOCAB.index('y' if seq[-1] == VOCAB.index('x') else 'x')
+
+    service, _ = make_service(rule)
+    assert generate(service, 'a', max_new_tokens=8, stop_words=['yx']) == 'x'
+    # 同じトークンで複数の停止語が見つかったら、いちばん前で切る
+    assert generate(service, 'a', max_new_tokens=8,
+                    stop_words=['yx', 'xyx']) == ''
+
+
+def test_eos_ends_generation(make_service):
+    service, _ = make_service(lambda seq: EOS)
+    stream = list(service.stream('abc', temperature=0))
+    assert [text for _, text in stream] == ['']
+
+
+def test_decoding_is_incremental_and_waits_for_whole_characters(
+        make_service):
+    answer = 'héllo wörld '.encode() * 20
+
+    def rule(seq):
+        return answer[len(seq) - 1] if len(seq) <= len(answer) else 0
+
+    tokenizer = ByteTokenizer()
+    service, _ = make_service(rule, tokenizer)
+    texts = [
+        text for _, text in service.stream(
+            'q', temperature=0, max_new_tokens=1000, stop_words=['wörld x'])
+    ]
+    assert texts[-1] == answer.decode()
+    # 2 バイトの文字の途中では送らないので、置換文字は出ない
+    assert not any('\ufffd' in text for text in texts)
+    assert all(a == b[:len(a)] for a, b in zip(texts, texts[1:]))
+    # 系列全体ではなく、直前のトークンからの数トークンだけをデコードする
+    assert max(tokenizer.decoded) <= 3
@@ -0,0 +1,72 @@
+import threading
+
+from fakes import PLANNER_SCRIPT, FakeLLM
+from lagent.schema import AgentStatusCode
+
+from mindsearch.agent import MindSearchAgent, MindSearchProtocol
+from mindsearch.cancellation import CancelToken
+from mindsearch.streaming import StateChanged
+
+
+def test_child_tokens_follow_their_parent():
+    parent = CancelToken()
+    child = parent.child()
+    called = []
+    child.on_cancel(lambda: called.append(child.reason))
+    parent.cancel('stop')
+    assert child.cancelled and called == ['stop']
+    # キャンセル後に登録したコールバックもすぐ呼ばれる
+    child.on_cancel(lambda: called.append('late'))
+    assert called == ['stop', 'late']
+
+
+def test_cancel_stops_in_flight_searchers(make_graph):
+    running = threading.Barrier(3, timeout=5)
+    stopped = threading.Barrier(3, timeout=5)
+    seen = {}
+
+    def run(question, parent_response, cancel_token):
+        running.wait()
+        while not cancel_token.wait(0.01):
+            yield question
+        seen[question] = cancel_token.reason
+        stopped.wait()
+
+    graph = make_graph(run, [('root', 'a'), ('root', 'b'), ('a', 'c')])
+    graph.run()
+    running.wait()
+    graph.cancel('user')
+    assert graph.wait(5)
+    # 実行中のノードはチャンクの境界で止まり、まだ始まっていないノードは捨てる
+    stopped.wait()
+    assert seen == dict(a='user', b='user')
+    assert 'c' not in graph.timings
+    items = []
+    while not graph.searcher_resp_queue.empty():
+        items.append(graph.searcher_resp_queue.get())
+    assert graph.end_signal in items
+
+
+def make_agent(llm):
+    return MindSearchAgent(llm=llm,
+                           searcher_cfg=dict(),
+                           protocol=MindSearchProtocol(meta_prompt='planner'))
+
+
+def test_cancel_before_the_stream_starts_is_kept():
+    llm = FakeLLM(PLANNER_SCRIPT)
+    agent = make_agent(llm)
+    deltas = agent.stream_deltas('質問')
+    agent.cancel()
+    deltas = list(deltas)
+    assert StateChanged(AgentStatusCode.SESSION_CLOSED) in deltas
+    assert llm.calls == 0
+
+
+def test_cancel_applies_to_the_token_passed_in():
+    agent = make_agent(FakeLLM(PLANNER_SCRIPT))
+    token = CancelToken()
+    deltas = agent.stream_deltas('質問', cancel_token=token)
+    agent.cancel('stop')
+    assert token.cancelled and token.reason == 'stop'
+    assert StateChanged(AgentStatusCode.SESSION_CLOSED) in list(deltas)
@@ -0,0 +1,115 @@
+import pytest
+
+from mindsearch.context_packer import ContextPacker, TokenCounter
+
+# tiktoken の有無で結果が変わらないよう、見積もり（英数字 4 文字で 1 トークン）で数える
+COUNTER = TokenCounter(None)
+
+
+def make_packer(budget=3000, chunk_tokens=20):
+    return ContextPacker(budget=budget,
+                         chunk_tokens=chunk_tokens,
+                         counter=COUNTER)
+
+
+def make_results(n):
+    return [
+        dict(title=f'title {i}', link=f'https://example.com/{i}',
+             snippet=f'snippet {i}') for i in range(n)
+    ]
+
+
+def test_split_keeps_lines_together_up_to_the_chunk_size():
+    packer = make_packer(chunk_tokens=20)
+    lines = [f'line {i} has some words.' for i in range(6)]  # 各 6 トークン
+    pieces = packer._split('\n'.join(lines))
+    assert pieces == ['\n'.join(lines[0:3]), '\n'.join(lines[3:6])]
+    assert packer._split('\n \n\n') == []
+
+
+def test_split_breaks_long_lines_at_sentences_then_by_length():
+    packer = make_packer(chunk_tokens=20)
+    sentences = ' '.join(f'Sentence {i} is here with words.'
+                         for i in range(4))
+    run_on = 'x' * 200
+    pieces = packer._split(f'{sentences}\n{run_on}')
+    assert all(COUNTER.count(piece) <= 20 for piece in pieces)
+    # 文の途中では切らず、区切りのない行だけ文字数で切る
+    assert 'Sentence 1 is here with words.' in pieces[0].split('\n')
+    assert ''.join(p for p in pieces if p.startswith('x')) == run_on
+    assert max(len(p) for p in pieces if p.startswith('x')) < len(run_on)
+
+
+def test_relevant_chunk_wins_under_a_tight_budget():
+    results = make_results(3)
+    filler = 'unrelated filler text about something else entirely'
+    pages = {r['link']: filler for r in results}
+    # 検索順位が一番低い結果の本文だけが質問に関係する
+    pages[results[2]['link']] = 'the capital of france is paris'
+    packer = make_packer()
+    question = 'what is the capital of france'
+    header = COUNTER.count(packer._chunks([], results[2:], {})[0].text)
+    packer.budget = header + COUNTER.count(pages[results[2]['link']])
+
+    packed = packer.pack(question, [], results, pages)
+    assert packed.context == ('タイトル: title 2\nURL: https://example.com/2\n'
+                              '概要: snippet 2\n'
+                              '本文: the capital of france is paris\n')
+    assert packed.stats['context_tokens'] == packer.budget
+    assert packed.stats['context_dropped_chunks'] == 4
+
+
+def test_body_is_packed_with_its_header_in_original_order():
+    results = make_results(2)
+    body = '\n'.join(f'paris fact number {i} here.' for i in range(6))
+    pages = {results[1]['link']: body}
+    packer = make_packer()
+    parent = 'the parent said paris.'
+
+    packed = packer.pack('paris', [parent, 'nothing'], results, pages)
+    assert packed.parents == [parent, 'nothing']
+    first, second = packed.context.split('\n\n')
+    assert first == 'タイトル: title 0\nURL: https://example.com/0\n概要: snippet 0'
+    # 複数のチャンクに分かれた本文も見出しの後に元の順序で並ぶ
+    assert second == ('タイトル: title 1\nURL: https://example.com/1\n'
+                      f'概要: snippet 1\n本文: {body}\n')
+
+    # 見出しが入らない予算では本文も入れない
+    packer.budget = COUNTER.count(body.split('\n')[0]) + 1
+    packed = packer.pack('paris fact', [], results, pages)
+    assert 'fact' not in packed.context
+    assert packed.stats['context_tokens'] == 0
+
+
+def test_headers_without_pages_are_counted_once():
+    results = make_results(3)
+    packer = make_packer()
+    packed = packer.pack('snippet', [], results)
+    assert packed.context.count('タイトル: ') == 3
+    assert packed.stats['context_dropped_tokens'] == 0
+    assert packed.stats['context_tokens'] == COUNTER.count(
+        packer._chunks([], results, {})[0].text) * 3
+
+
+@pytest.mark.parametrize('budget', [0, 10, 25, 60, 120, 250, 10000])
+def test_packed_output_never_exceeds_the_budget(budget):
+    results = make_results(4)
+    pages = {
+        r['link']: '\n'.join(f'page {i} line {j} about cats and dogs.'
+                             for j in range(10))
+        for i, r in enumerate(results)
+    }
+    parents = ['cats are small.\n' * 8, 'dogs bark.']
+    packer = make_packer(budget=budget)
+
+    packed = packer.pack('cats', parents, results, pages)
+    used = sum(COUNTER.count(p) for p in packed.parents)
+    used += COUNTER.count(packed.context) if packed.context else 0
+    assert used <= packed.stats['context_tokens'] <= budget
+    total = sum(c.tokens for c in packer._chunks(parents, results, pages))
+    assert packed.stats['context_dropped_tokens'] == total - packed.stats[
+        'context_tokens']
+    if budget >= total:
+        assert packed.stats['context_dropped_chunks'] == 0
+        assert len(packed.parents) == 2
+        assert packed.context.count('本文: ') == 4
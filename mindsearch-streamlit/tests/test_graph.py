@@ -0,0 +1,97 @@
+import queue
+import threading
+
+from mindsearch.streaming import NodeFinished
+
+
+def finished(graph):
+    deltas = []
+    while True:
+        try:
+            deltas.append(graph.searcher_resp_queue.get_nowait())
+        except queue.Empty:
+            return {
+                d.name: d.response
+                for d in deltas if isinstance(d, NodeFinished)
+            }
+
+
+class Recorder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.parents = {}
+
+    def record(self, event, name):
+        with self.lock:
+            self.events.append((event, name))
+
+    def index(self, event, name):
+        return self.events.index((event, name))
+
+
+DIAMOND = [('root', 'a'), ('root', 'b'), ('a', 'c'), ('b', 'c'), ('c', 'd')]
+
+
+def test_nodes_start_after_all_their_parents_finish(make_graph):
+    recorder = Recorder()
+    # a と b は親が同じなので同時に実行される（片方だけだとここで止まる）
+    barrier = threading.Barrier(2, timeout=5)
+
+    def run(question, parent_response, cancel_token):
+        recorder.record('start', question)
+        recorder.parents[question] = sorted(
+            p['question'] for p in parent_response)
+        if question in ('a', 'b'):
+            barrier.wait()
+        yield f'{question} answer'
+        recorder.record('end', question)
+
+    graph = make_graph(run, DIAMOND)
+    graph.run()
+    assert graph.wait(5)
+
+    for start, end in DIAMOND:
+        if start != 'root':
+            assert recorder.index('end', start) < recorder.index(
+                'start', end)
+    # ルートは回答を持たないので親の回答には含まれない
+    assert recorder.parents == dict(a=[], b=[], c=['a', 'b'], d=['c'])
+    assert finished(graph) == {n: f'{n} answer' for n in 'abcd'}
+    assert graph.critical_path()['path'][-2:] == ['c', 'd']
+
+
+def test_failed_node_does_not_block_its_children(make_graph):
+    recorder = Recorder()
+
+    def run(question, parent_response, cancel_token):
+        recorder.record('start', question)
+        recorder.parents[question] = sorted(
+            p['question'] for p in parent_response)
+        if question == 'a':
+            raise RuntimeError('search failed')
+        yield f'{question} answer'
+
+    graph = make_graph(run, DIAMOND)
+    graph.run()
+    assert graph.wait(5)
+
+    # 失敗したノードの回答は子に渡らず、子はそれ以外の親の回答で実行される
+    assert recorder.parents['c'] == ['b']
+    assert recorder.index('start', 'a') < recorder.index('start', 'c')
+    assert finished(graph) == {n: f'{n} answer' for n in 'bcd'}
+    assert 'response' not in graph.nodes['a']
+
+
+def test_cyclic_dependencies_still_run(make_graph):
+    ran = []
+
+    def run(question, parent_response, cancel_token):
+        ran.append(question)
+        yield question
+
+    graph = make_graph(run, [('root', 'a'), ('a', 'b'), ('b', 'a')])
+    graph.run()
+    assert graph.wait(5)
+    assert sorted(ran) == ['a', 'b']
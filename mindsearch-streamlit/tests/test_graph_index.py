@@ -0,0 +1,52 @@
+from copy import deepcopy
+
+import pytest
+from lagent.schema import AgentReturn, AgentStatusCode
+
+from mindsearch.graph_index import Edge, Node
+from mindsearch.streaming import AgentReturnReducer, NodeAdded, NodeFinished
+
+
+def finished_detail(response='answer'):
+    return AgentReturn(state=AgentStatusCode.END,
+                       response=response,
+                       inner_steps=[dict(role='user', content='q')])
+
+
+def test_deepcopy_isolates_finished_detail():
+    node = Node('a', 'searcher', 'q', 'answer', finished_detail())
+    copy = deepcopy(node)
+    copy['detail'].response = 'changed'
+    copy['detail'].inner_steps.append(dict(role='assistant', content='x'))
+    assert node['detail'].response == 'answer'
+    assert len(node['detail'].inner_steps) == 1
+    assert (copy.name, copy['response']) == ('a', 'answer')
+
+
+def test_snapshots_do_not_share_details():
+    reducer = AgentReturnReducer()
+    reducer.apply(NodeAdded('a', 'searcher', 'q'))
+    reducer.apply(NodeFinished('a', 'answer', finished_detail()))
+    first = reducer.snapshot()
+    first.nodes['a']['detail'].response = 'changed'
+    second = reducer.snapshot()
+    assert second.nodes['a']['detail'].response == 'answer'
+    assert second.nodes['a']['detail'] is not first.nodes['a']['detail']
+
+
+def test_deepcopy_keeps_shared_detail_shared_within_one_copy():
+    detail = finished_detail()
+    nodes = dict(a=Node('a', 'searcher', detail=detail),
+                 b=Node('b', 'searcher', detail=detail))
+    copy = deepcopy(nodes)
+    assert copy['a']['detail'] is copy['b']['detail']
+    assert copy['a']['detail'] is not detail
+
+
+def test_records_compare_by_value_and_are_unhashable():
+    assert Node('a', 'searcher', 'q') == dict(type='searcher', content='q')
+    assert Edge(0, 'b') == Edge(0, 'b')
+    with pytest.raises(TypeError):
+        hash(Node('a', 'searcher'))
+    with pytest.raises(TypeError):
+        {Edge(0, 'b')}
@@ -0,0 +1,226 @@
+import asyncio
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from mindsearch.page_fetcher import (PageCache, PageFetcher, PublicResolver,
+                                     is_public_address)
+from mindsearch.search_backend import run_sync
+
+ARTICLE = ('<html><head><title>記事</title><script>var x = 1;</script>'
+           '</head><body><nav>ホーム 一覧 お問い合わせ</nav><article>'
+           '<p>本文の最初の段落です。十分な長さのテキストがあります。</p>'
+           '<p>短い</p>'
+           '<p>本文の二番目の段落です。こちらも十分な長さがあります。</p>'
+           '</article><footer>著作権表示のフッターです。長さは足りています。</footer>'
+           '</body></html>')
+PLAIN = '  1 行目 <b>タグではない</b>\n\n  2 行目  '
+
+
+class StandIn:
+    """ページ取得のテスト用のローカル HTTP サーバー。"""
+
+    def __init__(self):
+        self.requests = Counter()
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def url(self, path, host='127.0.0.1'):
+        return f'http://{host}:{self.server.server_address[1]}{path}'
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                stand_in.requests[path] += 1
+                if path == '/slow':
+                    time.sleep(2)
+                if path.startswith('/hold/'):
+                    with stand_in.lock:
+                        stand_in.active += 1
+                        stand_in.peak = max(stand_in.peak, stand_in.active)
+                    time.sleep(0.1)
+                    with stand_in.lock:
+                        stand_in.active -= 1
+                if path == '/redirect':
+                    self.send_response(302)
+                    self.send_header('Location', '/article')
+                    self.end_headers()
+                    return
+                content_type, body = dict(
+                    plain=('text/plain; charset=utf-8', PLAIN),
+                    image=('image/png', '\x89PNG'),
+                ).get(path.strip('/'), ('text/html; charset=utf-8', ARTICLE))
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_in():
+    stand_in = StandIn()
+    yield stand_in
+    stand_in.close()
+
+
+@pytest.fixture
+def make_fetcher():
+    fetchers = []
+
+    def make_fetcher(**kwargs):
+        kwargs.setdefault('allow_private', True)
+        fetcher = PageFetcher(cache=PageCache(), **kwargs)
+        fetchers.append(fetcher)
+        return fetcher
+
+    yield make_fetcher
+    for fetcher in fetchers:
+        run_sync(fetcher.close())
+
+
+def fetch(fetcher, *urls):
+    pages = run_sync(fetcher.fetch_many(list(urls)), timeout=10)
+    return pages if len(urls) > 1 else pages[0]
+
+
+def test_extracts_main_text(stand_in, make_fetcher):
+    page = fetch(make_fetcher(), stand_in.url('/article'))
+    assert page['title'] == '記事'
+    assert page['text'].split('\n') == [
+        '本文の最初の段落です。十分な長さのテキストがあります。',
+        '本文の二番目の段落です。こちらも十分な長さがあります。',
+    ]
+
+
+def test_plain_text_is_passed_through(stand_in, make_fetcher):
+    page = fetch(make_fetcher(), stand_in.url('/plain'))
+    assert page['text'] == PLAIN
+    assert page['title'] == ''
+
+
+def test_non_text_content_is_skipped(stand_in, make_fetcher):
+    assert fetch(make_fetcher(), stand_in.url('/image')) is None
+
+
+def test_pages_are_cached_by_url_and_content(stand_in, make_fetcher):
+    fetcher = make_fetcher()
+    first = fetch(fetcher, stand_in.url('/article'))
+    assert fetch(fetcher, stand_in.url('/article')) == first
+    assert stand_in.requests['/article'] == 1
+    # 同じ内容の別 URL は本文を 1 つだけ持つ
+    fetch(fetcher, stand_in.url('/article?mirror=1'))
+    assert fetcher.cache.stats['blobs'] == 1
+
+
+def test_concurrent_fetches_of_a_url_are_coalesced(stand_in, make_fetcher):
+    fetch(make_fetcher(), *[stand_in.url('/hold/0')] * 4)
+    assert stand_in.requests['/hold/0'] == 1
+
+
+def test_connections_per_host_are_limited(stand_in, make_fetcher):
+    pages = fetch(make_fetcher(per_host=2),
+                  *[stand_in.url(f'/hold/{idx}') for idx in range(6)])
+    assert all(page is not None for page in pages)
+    assert stand_in.peak == 2
+
+
+def test_slow_pages_time_out(stand_in, make_fetcher):
+    start = time.monotonic()
+    assert fetch(make_fetcher(timeout=0.3), stand_in.url('/slow')) is None
+    assert time.monotonic() - start < 1.5
+
+
+def test_redirects_are_followed(stand_in, make_fetcher):
+    page = fetch(make_fetcher(), stand_in.url('/redirect'))
+    assert page['url'] == stand_in.url('/redirect')
+    assert page['title'] == '記事'
+    assert stand_in.requests['/article'] == 1
+
+
+@pytest.mark.parametrize('host', ['127.0.0.1', 'localhost'])
+def test_private_addresses_are_refused(stand_in, make_fetcher, host):
+    fetcher = make_fetcher(allow_private=False)
+    assert fetch(fetcher, stand_in.url('/article', host)) is None
+    assert stand_in.requests['/article'] == 0
+
+
+@pytest.mark.parametrize('address, public', [
+    ('8.8.8.8', True),
+    ('2001:4860:4860::8888', True),
+    ('127.0.0.1', False),
+    ('10.1.2.3', False),
+    ('172.16.0.1', False),
+    ('192.168.0.1', False),
+    ('169.254.169.254', False),
+    ('::1', False),
+    ('fe80::1%eth0', False),
+    ('::ffff:127.0.0.1', False),
+    ('0.0.0.0', False),
+    ('224.0.0.1', False),
+])
+def test_is_public_address(address, public):
+    assert is_public_address(address) is public
+
+
+def test_resolver_drops_non_public_addresses():
+
+    class Resolver:
+
+        def __init__(self, hosts):
+            self.hosts = hosts
+
+        async def resolve(self, host, port=0, family=0):
+            return [dict(hostname=host, host=h, port=port) for h in self.hosts]
+
+        async def close(self):
+            pass
+
+    mixed = PublicResolver(Resolver(['10.0.0.1', '93.184.216.34']))
+    hosts = asyncio.run(mixed.resolve('example.com', 80))
+    assert [h['host'] for h in hosts] == ['93.184.216.34']
+    with pytest.raises(OSError):
+        asyncio.run(
+            PublicResolver(Resolver(['127.0.0.1'])).resolve('x.test', 80))
+
+
+def test_literal_private_addresses_are_refused_before_connecting():
+    fetcher = PageFetcher(cache=PageCache())
+    assert not fetcher._allowed('http://169.254.169.254/latest/meta-data')
+    assert not fetcher._allowed('http://[::1]:8080/')
+    assert not fetcher._allowed('file:///etc/passwd')
+    assert fetcher._allowed('https://example.com/')
+
+
+def test_host_limits_are_bounded():
+    fetcher = PageFetcher(max_hosts=2, cache=PageCache())
+    busy = fetcher._acquire_host('busy')
+    for idx in range(5):
+        fetcher._acquire_host(f'host{idx}')
+        fetcher._release_host(f'host{idx}')
+    # 使用中のホストは追い出さない
+    assert list(fetcher._host_limits) == ['busy', 'host4']
+    assert fetcher._acquire_host('busy') is busy
@@ -0,0 +1,63 @@
+import pytest
+from fakes import PLANNER_SCRIPT
+from lagent.actions import ActionExecutor, BaseAction
+
+from mindsearch.agent import MindSearchProtocol
+
+ACTION = ('<|action_start|><|interpreter|>```python\n'
+          'graph.add_response_node(node_name="response")\n'
+          '```<|action_end|>\n')
+
+OUTPUTS = [text.format(question='質問') for text in PLANNER_SCRIPT] + [
+    # プラグインとして書かれたコード
+    '回答します。' + ACTION.replace('<|interpreter|>', '<|plugin|>'),
+    # 2 つ目のアクション
+    'まず検索します。' + ACTION + '続けます。' + ACTION,
+    # 開始トークンのないマーカー
+    '検索します。<|interpreter|>graph.node("a")<|action_end|>\n',
+    # インタープリターのアクションの後にプラグインのマーカー
+    '検索します。' + ACTION + '<|action_start|><|plugin|>{}<|action_end|>',
+    # 同じプラグインのマーカーが 2 回（parse はエラーにする）
+    '<|action_start|><|plugin|>a<|action_start|><|plugin|>b',
+]
+
+
+def parse_or_error(parse, text):
+    try:
+        return parse(text)
+    except ValueError as e:
+        return type(e)
+
+
+class Interpreter(BaseAction):
+    """テスト用のインタープリター。"""
+
+    def run(self, command: str) -> str:
+        """コードを実行する。
+
+        Args:
+            command (str): コード
+        """
+        return command
+
+
+@pytest.mark.parametrize('output', OUTPUTS)
+@pytest.mark.parametrize('interpreter_executor',
+                         [None, ActionExecutor(actions=[Interpreter()])])
+def test_incremental_parse_matches_parse_on_every_prefix(
+        output, interpreter_executor):
+    protocol = MindSearchProtocol()
+    parser = protocol.stream_parser(interpreter_executor)
+    for end in range(len(output) + 1):
+        text = output[:end]
+        expected = parse_or_error(
+            lambda t: protocol.parse(
+                t, interpreter_executor=interpreter_executor), text)
+        assert parse_or_error(parser.feed, text) == expected, text
+
+
+def test_parser_restarts_when_response_shrinks():
+    protocol = MindSearchProtocol()
+    parser = protocol.stream_parser()
+    parser.feed(OUTPUTS[0])
+    assert parser.feed('やり直し') == protocol.parse('やり直し')
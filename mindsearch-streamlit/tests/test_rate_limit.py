@@ -0,0 +1,188 @@
+import asyncio
+from types import SimpleNamespace
+
+import aiohttp
+import pytest
+
+from mindsearch import rate_limit
+from mindsearch.rate_limit import DailyQuota, RateLimiter, TokenBucket
+from mindsearch.search_backend import AsyncSearchClient
+
+
+class FakeClock:
+    """``rate_limit`` の時計と ``asyncio.sleep`` を置き換える仮想時計。
+
+    時刻の誤差で待ちが終わらなくならないように、テストのレートは 2 の冪にする。
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, 'time',
+                        SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(rate_limit, 'asyncio',
+                        SimpleNamespace(Lock=asyncio.Lock, sleep=clock.sleep))
+    monkeypatch.setattr(rate_limit.random, 'uniform', lambda low, high: 0)
+    return clock
+
+
+def acquire_times(bucket, clock, count):
+    times = []
+
+    async def run():
+        for _ in range(count):
+            await bucket.acquire()
+            times.append(round(clock.now, 6))
+
+    asyncio.run(run())
+    return times
+
+
+def test_acquires_are_spaced_at_the_rate(clock):
+    bucket = TokenBucket(rate=4)
+    assert acquire_times(bucket, clock, 5) == [0, 0.25, 0.5, 0.75, 1]
+    assert bucket.stats['waits'] == 4
+
+
+def test_burst_passes_without_waiting(clock):
+    bucket = TokenBucket(rate=4, burst=3)
+    assert acquire_times(bucket, clock, 4) == [0, 0, 0, 0.25]
+
+
+def test_concurrent_waiters_are_served_in_order(clock):
+    bucket = TokenBucket(rate=4)
+    order = []
+
+    async def call(idx):
+        await bucket.acquire()
+        order.append((idx, clock.now))
+
+    async def run():
+        await asyncio.gather(*(call(idx) for idx in range(4)))
+
+    asyncio.run(run())
+    assert order == [(0, 0), (1, 0.25), (2, 0.5), (3, 0.75)]
+
+
+def test_throttled_halves_rate_and_drains_bucket(clock):
+    bucket = TokenBucket(rate=8)
+    acquire_times(bucket, clock, 1)
+    bucket.throttled(retry_after=2)
+    assert bucket.rate == 4
+    # Retry-After の 2 秒と、半分になったレートでの 1 回分
+    assert acquire_times(bucket, clock, 2) == [2.25, 2.5]
+
+
+def test_rate_backs_off_multiplicatively_and_recovers_additively(clock):
+    bucket = TokenBucket(rate=16)
+    for _ in range(6):
+        bucket.throttled()
+    assert bucket.rate == 1  # 下限は元のレートの 1/16
+    for expected in (1.8, 2.6, 3.4):
+        bucket.succeeded()
+        assert bucket.rate == pytest.approx(expected)
+    for _ in range(30):
+        bucket.succeeded()
+    assert bucket.rate == 16
+    assert bucket.stats['throttles'] == 6
+
+
+class FakeSession:
+    """決まった順にステータスを返す ``aiohttp.ClientSession`` の代わり。"""
+
+    closed = False
+
+    def __init__(self, statuses, retry_after='2'):
+        self.statuses = list(statuses)
+        self.retry_after = retry_after
+        self.calls = 0
+
+    def get(self, url, params=None):
+        self.calls += 1
+        return FakeResponse(self.statuses.pop(0), self.retry_after)
+
+
+class FakeResponse:
+
+    def __init__(self, status, retry_after):
+        self.status = status
+        self.retry_after = retry_after
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(
+                None, (),
+                status=self.status,
+                headers={'Retry-After': self.retry_after})
+
+    async def json(self):
+        return dict(items=[dict(title='t', link='https://example.com')])
+
+
+def make_client(session, rate=8):
+    client = AsyncSearchClient(api_key='key',
+                               search_engine_id='cx',
+                               limiter=RateLimiter(rate),
+                               quota=DailyQuota())
+    client._session = session
+    return client
+
+
+def test_retry_after_is_waited_once(clock):
+    session = FakeSession([429, 200])
+    client = make_client(session)
+    results = asyncio.run(client._search('q', 5))
+    assert results == [dict(title='t', link='https://example.com', snippet='')]
+    assert session.calls == 2
+    # 2 秒の Retry-After と半分のレートでの 1 回分だけ待つ（2 秒を二重に待たない）
+    assert clock.now == 2.25
+    bucket = client.limiter.bucket('key')
+    assert bucket.stats['waited_s'] == 2.25
+    assert bucket.stats['throttles'] == 1
+
+
+def test_server_errors_back_off_without_throttling(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit.random, 'uniform',
+                        lambda low, high: high)
+    session = FakeSession([503, 503, 200], retry_after=None)
+    client = make_client(session)
+    asyncio.run(client._search('q', 5))
+    assert clock.sleeps == [0.5, 1.0]
+    assert client.limiter.bucket('key').stats['throttles'] == 0
+
+
+def test_server_errors_honor_retry_after(clock):
+    session = FakeSession([503, 200], retry_after='3')
+    client = make_client(session)
+    asyncio.run(client._search('q', 5))
+    # 5xx ではバケットは待たせないので、再試行の前に Retry-After だけ待つ
+    assert clock.sleeps == [3]
+
+
+def test_daily_quota_rejects_past_limit():
+    quota = DailyQuota(limit=2)
+    quota.consume('a')
+    quota.consume('a')
+    with pytest.raises(rate_limit.QuotaExceeded):
+        quota.consume('a')
+    quota.consume('b')
+    assert quota.remaining('a') == 0
+    assert quota.stats['rejected'] == 1
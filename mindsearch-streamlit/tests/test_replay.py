@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+import pytest
+from bench_agent import QUESTION, build_agent
+from fakes import FakeSearchClient
+from lagent.actions import ActionExecutor
+
+from mindsearch import models, page_fetcher, search_cache
+from mindsearch.agent import WebSearchGraph
+from mindsearch.models import GoogleSearch
+from mindsearch.page_fetcher import PageCache, PageFetcher
+from mindsearch.replay import RunLog, final_state, record_run, replay_run
+from mindsearch.search_cache import SearchCache
+
+
+def make_agent():
+    agent = build_agent(
+        SimpleNamespace(planner_tps=None, searcher_tps=None,
+                        chars_per_token=2))
+    agent.searcher_cfg.update(
+        action_executor=ActionExecutor(actions=[
+            GoogleSearch(cache=SearchCache(max_size=0),
+                         client=FakeSearchClient())
+        ]),
+        page_fetcher=PageFetcher(top_k=0, cache=PageCache()))
+    return agent
+
+
+def shared_state():
+    return (WebSearchGraph.searcher_cfg,
+            models.get_action_executor().actions['google_search'],
+            page_fetcher.get_page_fetcher(), search_cache.get_answer_cache())
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = str(tmp_path / 'run.jsonl.gz')
+    deltas = list(record_run(make_agent(), QUESTION, path))
+    return path, deltas
+
+
+def test_replay_matches_recording(recording):
+    path, deltas = recording
+    replayed = list(replay_run(path, agent_factory=lambda _: make_agent()))
+    assert final_state(replayed) == final_state(deltas)
+    assert final_state(deltas)['nodes']
+
+
+def test_record_and_replay_leave_shared_state_alone(tmp_path, recording):
+    path, _ = recording
+    before = shared_state()
+    other = make_agent()
+    other_cfg = other.searcher_cfg
+    log_path = str(tmp_path / 'again.jsonl')
+    for stream in (record_run(make_agent(), QUESTION, log_path),
+                   replay_run(path, agent_factory=lambda _: make_agent())):
+        for _ in stream:
+            # 実行中も、他の質問が使うプロセス共有の設定は変わらない
+            assert all(a is b for a, b in zip(shared_state(), before))
+            assert other.searcher_cfg is other_cfg
+    assert all(a is b for a, b in zip(shared_state(), before))
+
+
+def test_patched_agent_is_restored(recording):
+    path, _ = recording
+    agent = make_agent()
+    saved = (agent.llm, agent.searcher_cfg, agent.answer_cache)
+    stream = replay_run(path, agent_factory=lambda _: agent)
+    next(stream)
+    assert agent.searcher_cfg is not saved[1]
+    assert agent.answer_cache.max_size == 0
+    stream.close()
+    assert (agent.llm, agent.searcher_cfg, agent.answer_cache) == saved
+
+
+def test_default_agent_factory_replays_without_llm(recording):
+    path, deltas = recording
+    log = RunLog.load(path)
+    replayed = list(replay_run(path, log=log))
+    assert final_state(replayed)['response'] == final_state(deltas)['response']
@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+from mindsearch.scheduler import SearcherScheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = SearcherScheduler(max_workers=1, idle_timeout=1)
+    yield scheduler
+    scheduler.shutdown()
+
+
+def block(scheduler):
+    """唯一のワーカーを止めておき、その間にジョブを積めるようにする。"""
+    started, release = threading.Event(), threading.Event()
+
+    def gate():
+        started.set()
+        release.wait(5)
+
+    future = scheduler.submit('gate', gate)
+    assert started.wait(5)
+    return release, future
+
+
+def test_sessions_are_served_round_robin(scheduler):
+    release, _ = block(scheduler)
+    order = []
+    futures = [
+        scheduler.submit(session, order.append, f'{session}{idx}')
+        for session, count in (('a', 3), ('b', 2), ('c', 1))
+        for idx in range(count)
+    ]
+    release.set()
+    for future in futures:
+        future.result(5)
+    # 先に多くのジョブを積んだセッションが他を待たせない
+    assert order == ['a0', 'b0', 'c0', 'a1', 'b1', 'a2']
+
+
+def test_jobs_of_one_session_keep_their_order(scheduler):
+    release, _ = block(scheduler)
+    order = []
+    futures = [scheduler.submit('a', order.append, idx) for idx in range(5)]
+    release.set()
+    for future in futures:
+        future.result(5)
+    assert order == list(range(5))
+
+
+def test_exceptions_are_set_on_the_future(scheduler):
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError, match='boom'):
+        scheduler.submit('a', fail).result(5)
+    assert scheduler.submit('a', lambda: 1).result(5) == 1
+
+
+def test_close_session_cancels_only_its_queued_jobs(scheduler):
+    release, _ = block(scheduler)
+    queued = [scheduler.submit('a', lambda: 'a') for _ in range(3)]
+    other = scheduler.submit('b', lambda: 'b')
+    assert scheduler.close_session('a') == 3
+    release.set()
+    assert all(future.cancelled() for future in queued)
+    assert other.result(5) == 'b'
+    stats = scheduler.stats()
+    assert stats['cancelled'] == 3
+    assert stats['queue_depth'] == 0
+
+
+def test_workers_are_bounded():
+    scheduler = SearcherScheduler(max_workers=2, idle_timeout=1)
+    release = threading.Event()
+    lock, running, peak = threading.Lock(), [0], [0]
+
+    def job():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        release.wait(5)
+        with lock:
+            running[0] -= 1
+
+    futures = [scheduler.submit(idx % 3, job) for idx in range(6)]
+    release.set()
+    for future in futures:
+        future.result(5)
+    scheduler.shutdown()
+    assert peak[0] <= 2
+    assert scheduler.stats()['completed'] == 6
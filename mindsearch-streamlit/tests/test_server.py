@@ -0,0 +1,112 @@
+import asyncio
+import gc
+import json
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from lagent.schema import AgentStatusCode
+
+from mindsearch.server import QueryServer, SolveRequest
+from mindsearch.streaming import ResponseUpdated
+
+
+class FakeAgent:
+    """``stream_deltas`` で回答を 1 文字ずつ差分として送るエージェント。"""
+
+    def __init__(self, answer='abc', gate=None):
+        self.answer = answer
+        self.gate = gate
+        self.cancel_token = None
+
+    def stream_deltas(self, query, cancel_token=None, deadline=None):
+        self.cancel_token = cancel_token
+        for char in self.answer:
+            if self.gate is not None:
+                self.gate.wait(5)
+            yield ResponseUpdated(AgentStatusCode.STREAM_ING, char)
+
+
+def make_server(agent=None, **kwargs):
+    agent = agent or FakeAgent()
+    return QueryServer(lambda request: agent, **kwargs), agent
+
+
+def events(body):
+    return [chunk.split('\n')[0][len('event: '):] for chunk in body]
+
+
+async def collect(stream, limit=None):
+    body = []
+    async for chunk in stream:
+        body.append(chunk)
+        if limit is not None and len(body) >= limit:
+            await stream.aclose()
+            break
+    return body
+
+
+def test_stream_sends_queued_started_deltas_and_done():
+    server, _ = make_server()
+    body = asyncio.run(collect(server.admit(SolveRequest(query='q'))))
+    assert events(body) == ['queued', 'started', 'delta', 'delta', 'delta',
+                            'done']
+    deltas = [json.loads(chunk.split('data: ', 1)[1]) for chunk in body[2:-1]]
+    assert ''.join(delta['text'] for delta in deltas) == 'abc'
+    assert server.stats() == dict(max_queries=8,
+                                  max_pending=32,
+                                  waiting=0,
+                                  running=0,
+                                  completed=1,
+                                  rejected=0,
+                                  disconnected=0)
+
+
+def test_pending_queries_past_the_limit_are_rejected():
+    server, _ = make_server(max_pending=2)
+    streams = [server.admit(SolveRequest(query='q')) for _ in range(2)]
+    with pytest.raises(HTTPException) as info:
+        server.admit(SolveRequest(query='q'))
+    assert info.value.status_code == 503
+    assert server.stats()['rejected'] == 1
+    del streams
+
+
+def test_stream_that_never_starts_releases_its_slot():
+    server, _ = make_server(max_pending=1)
+    stream = server.admit(SolveRequest(query='q'))
+    assert server.waiting == 1
+    # 応答が始まる前に接続が切れた場合など、一度も回されずに捨てられる
+    del stream
+    gc.collect()
+    assert server.waiting == 0
+    server.admit(SolveRequest(query='q'))
+
+
+def test_slot_is_released_once_when_stream_runs_and_is_dropped():
+    server, _ = make_server()
+    stream = server.admit(SolveRequest(query='q'))
+    asyncio.run(collect(stream))
+    del stream
+    gc.collect()
+    assert server.waiting == 0
+
+
+def test_disconnect_cancels_the_query():
+    gate = threading.Event()
+    server, agent = make_server(FakeAgent(gate=gate))
+
+    async def run():
+        body = await collect(server.admit(SolveRequest(query='q')), limit=2)
+        # ループを閉じる前に、取り消されたワーカーの後片付けを待つ
+        gate.set()
+        await asyncio.get_running_loop().run_in_executor(
+            None, server.executor.shutdown)
+        return body
+
+    body = asyncio.run(run())
+    assert events(body) == ['queued', 'started']
+    assert agent.cancel_token.cancelled
+    assert server.stats()['disconnected'] == 1
+    assert server.stats()['running'] == 0
@@ -0,0 +1,161 @@
+import pytest
+from lagent.llms import INTERNLM2_META, LMDeployClient
+from lagent.llms.base_llm import BaseModel
+from lagent.schema import ModelStatusCode
+
+from mindsearch.session import SessionManager
+
+
+class FakeAPIClient:
+    """``lmdeploy`` の ``APIClient.chat_interactive_v1`` の代わり。"""
+
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+        self.calls = []
+
+    def chat_interactive_v1(self, prompt, session_id, interactive_mode,
+                            **kwargs):
+        self.calls.append(
+            dict(prompt=prompt,
+                 session_id=session_id,
+                 interactive_mode=interactive_mode))
+        if not interactive_mode:
+            return
+        for piece in self.outputs.pop(0):
+            yield dict(text=piece, finish_reason=None)
+
+
+def make_llm(outputs):
+    llm = LMDeployClient.__new__(LMDeployClient)
+    BaseModel.__init__(llm,
+                       path='http://localhost:23333',
+                       meta_template=INTERNLM2_META,
+                       stop_words=['<|im_end|>'])
+    llm.client = FakeAPIClient(outputs)
+    llm.model_name = 'internlm2'
+    return llm
+
+
+SYSTEM = dict(role='system', content='planner')
+USER = dict(role='user', content='question')
+# INTERNLM2_META で描画した [SYSTEM, USER]
+PROMPT = ('<|im_start|>system\nplanner<|im_end|>\n'
+          '<|im_start|>user\nquestion<|im_end|>\n<|im_start|>assistant\n')
+
+
+@pytest.fixture(autouse=True)
+def interactive(monkeypatch):
+    monkeypatch.setenv('MINDSEARCH_INTERACTIVE_SESSIONS', '1')
+
+
+def test_ids_are_unique_and_wrap_around():
+    manager = SessionManager(start=1, limit=4)
+    held = manager.acquire()
+    ids = []
+    for _ in range(5):
+        with manager.session() as session_id:
+            ids.append(session_id)
+    assert held not in ids
+    assert ids == [2, 3, 2, 3, 2]
+    with manager.session('a'), manager.session('b'):
+        with pytest.raises(RuntimeError):
+            manager.acquire()
+
+
+def test_planner_turns_send_only_new_messages():
+    llm = make_llm([['plan', '<|im_end|>'], ['answer']])
+    manager = SessionManager()
+    session_id = manager.acquire('planner')
+
+    first = list(manager.stream_chat(session_id, llm, [SYSTEM, USER]))
+    assert first[-1] == (ModelStatusCode.END, 'plan', None)
+
+    environment = dict(role='environment', content='result',
+                       name='interpreter')
+    second = [SYSTEM, USER, dict(role='assistant', content='plan'),
+              environment]
+    assert list(manager.stream_chat(session_id, llm,
+                                    second))[-1][1] == 'answer'
+    assert manager.stats()['interactive'] == 1
+
+    manager.release(session_id, llm)
+    calls = llm.client.calls
+    # サーバーは生成した停止語まで持っているので、その後ろから送る
+    assert [c['prompt'] for c in calls] == [
+        PROMPT, '\n<|im_start|>environment name=<|interpreter|>\n'
+        'result<|im_end|>\n<|im_start|>assistant\n', ''
+    ]
+    assert calls[0]['prompt'] + 'plan<|im_end|>' + calls[1][
+        'prompt'] == llm.template_parser(second)
+    assert [c['interactive_mode'] for c in calls] == [True, True, False]
+    assert {c['session_id'] for c in calls} == {session_id}
+    assert manager.stats()['active'] == 0
+
+
+def test_diverged_or_aborted_turn_restarts_the_session():
+    llm = make_llm([['a', 'b'], ['c'], ['d']])
+    manager = SessionManager()
+    session_id = manager.acquire('planner')
+
+    # 途中で読むのをやめたターンの続きは送らない
+    stream = manager.stream_chat(session_id, llm, [SYSTEM, USER])
+    next(stream)
+    stream.close()
+    list(manager.stream_chat(session_id, llm, [SYSTEM, USER]))
+    # 前のターンの続きでない履歴
+    other = [SYSTEM, dict(role='user', content='other')]
+    list(manager.stream_chat(session_id, llm, other))
+
+    calls = llm.client.calls
+    assert [(c['prompt'], c['interactive_mode']) for c in calls] == [
+        (PROMPT, True),
+        ('', False),
+        (PROMPT, True),
+        ('', False),
+        (llm.template_parser(other), True),
+    ]
+
+
+def test_rewritten_assistant_output_restarts_the_session():
+    # 履歴に入れるときに書き換えた出力は、サーバー側の履歴の続きにならない
+    llm = make_llm([[' plan\n', '<|im_end|>'], ['answer']])
+    manager = SessionManager()
+    session_id = manager.acquire('planner')
+    list(manager.stream_chat(session_id, llm, [SYSTEM, USER]))
+    second = [SYSTEM, USER, dict(role='assistant', content='plan'),
+              dict(role='user', content='more')]
+    list(manager.stream_chat(session_id, llm, second))
+
+    calls = llm.client.calls
+    assert [(c['prompt'], c['interactive_mode']) for c in calls] == [
+        (PROMPT, True),
+        ('', False),
+        (llm.template_parser(second), True),
+    ]
+
+
+def test_other_backends_get_the_whole_prompt():
+
+    class LLM:
+
+        def stream_chat(self, inputs, session_id=0, **kwargs):
+            yield ModelStatusCode.END, f'{session_id}:{len(inputs)}', kwargs
+
+    manager = SessionManager()
+    session_id = manager.acquire('planner')
+    assert list(manager.stream_chat(session_id, LLM(), [SYSTEM, USER],
+                                    top_k=1)) == [(ModelStatusCode.END,
+                                                   f'{session_id}:2',
+                                                   dict(top_k=1))]
+    manager.release(session_id, LLM())
+    assert manager.stats()['interactive'] == 0
+
+
+def test_interactive_mode_is_opt_in(monkeypatch):
+    monkeypatch.delenv('MINDSEARCH_INTERACTIVE_SESSIONS')
+    llm = make_llm([])
+    llm.stream_chat = lambda inputs, session_id=0, **kwargs: iter(
+        [(ModelStatusCode.END, 'plain', None)])
+    manager = SessionManager()
+    assert list(manager.stream_chat(1, llm, [USER]))[-1][1] == 'plain'
+    assert llm.client.calls == []
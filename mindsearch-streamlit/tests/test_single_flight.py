@@ -0,0 +1,144 @@
+import asyncio
+import concurrent.futures
+import threading
+
+import pytest
+from fakes import FakeSearchClient
+from lagent.schema import ActionStatusCode
+
+from mindsearch.models import GoogleSearch
+from mindsearch.search_backend import (SingleFlight, run_on_search_loop,
+                                       run_sync)
+from mindsearch.search_cache import SearchCache
+
+
+class Call:
+    """``release`` されるまで終わらない呼び出し。実行回数を数える。"""
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.started = None
+        self.release = None
+
+    async def __call__(self):
+        self.calls += 1
+        self.started.set()
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def run_waiters(flight, call, count, key='k'):
+    """共有ループ上で ``count`` 個の待ち手を同時に走らせ、結果か例外を返す。"""
+
+    async def run():
+        call.started, call.release = asyncio.Event(), asyncio.Event()
+        waiters = [
+            asyncio.ensure_future(flight.do(key, call)) for _ in range(count)
+        ]
+        await call.started.wait()
+        # 全員がキーに並んでから終わらせる
+        await asyncio.sleep(0)
+        assert flight.stats['inflight'] == 1
+        call.release.set()
+        return await asyncio.gather(*waiters, return_exceptions=True)
+
+    return run_sync(run(), timeout=5)
+
+
+def test_concurrent_calls_share_one_execution():
+    flight, call = SingleFlight(), Call(result=['r'])
+    results = run_waiters(flight, call, 5)
+    assert results == [['r']] * 5
+    assert call.calls == 1
+    assert flight.stats == dict(calls=5, executed=1, coalesced=4, inflight=0)
+
+
+def test_error_reaches_every_waiter_and_is_not_cached():
+    flight, error = SingleFlight(), RuntimeError('quota')
+    call = Call(error=error)
+    results = run_waiters(flight, call, 3)
+    assert results == [error] * 3
+    assert call.calls == 1
+    # 失敗した呼び出しは残らないので、次は改めて実行する
+    call.error, call.result = None, ['ok']
+    assert run_waiters(flight, call, 2) == [['ok']] * 2
+    assert call.calls == 2
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight()
+
+    async def run():
+        return await asyncio.gather(
+            *(flight.do(key, lambda key=key: asyncio.sleep(0, key))
+              for key in 'aab'))
+
+    assert run_sync(run(), timeout=5) == ['a', 'a', 'b']
+    assert flight.stats['executed'] == 2
+
+
+def test_cancelled_waiter_does_not_cancel_shared_call():
+    flight, call = SingleFlight(), Call(result='r')
+
+    async def run():
+        call.started, call.release = asyncio.Event(), asyncio.Event()
+        first = asyncio.ensure_future(flight.do('k', call))
+        second = asyncio.ensure_future(flight.do('k', call))
+        await call.started.wait()
+        first.cancel()
+        await asyncio.sleep(0)
+        call.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert run_sync(run(), timeout=5) == 'r'
+    assert call.calls == 1
+
+
+def test_sync_and_async_callers_are_coalesced():
+    flight, call = SingleFlight(), Call(result='r')
+
+    async def prepare():
+        call.started, call.release = asyncio.Event(), asyncio.Event()
+
+    async def from_other_loop():
+        await run_on_search_loop(call.started.wait())
+        return await flight.do('k', call)
+
+    async def release():
+        await call.started.wait()
+        while flight.stats['calls'] < 2:
+            await asyncio.sleep(0.01)
+        call.release.set()
+
+    run_sync(prepare())
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        # 別スレッドからの run_sync と、別のイベントループからの await
+        sync_caller = pool.submit(run_sync, flight.do('k', call), 5)
+        async_caller = pool.submit(asyncio.run, from_other_loop())
+        run_sync(release(), timeout=5)
+        assert sync_caller.result(5) == async_caller.result(5) == 'r'
+    assert call.calls == 1
+
+
+def test_google_search_coalesces_normalized_queries():
+    client = FakeSearchClient(latency=0.3)
+    search = GoogleSearch(cache=SearchCache(max_size=0), client=client)
+    queries = ['MindSearch とは', ' mindsearch  とは ', 'MINDSEARCH とは']
+    returns = []
+    threads = [
+        threading.Thread(target=lambda q=q: returns.append(search.run(q)))
+        for q in queries * 2
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert [r.state for r in returns] == [ActionStatusCode.SUCCESS] * 6
+    assert len({r.result[0]['content'] for r in returns}) == 1
+    assert client.calls == 1
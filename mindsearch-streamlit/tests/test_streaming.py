@@ -0,0 +1,41 @@
+import json
+
+from lagent.schema import (ActionReturn, ActionStatusCode, AgentReturn,
+                           AgentStatusCode)
+
+from mindsearch.streaming import (NodeFinished, TokenAppended, delta_from_dict,
+                                  delta_to_dict)
+
+
+def round_trip(delta):
+    return delta_from_dict(json.loads(json.dumps(delta_to_dict(delta))))
+
+
+def test_token_appended_round_trip():
+    delta = TokenAppended('node', 'abc', AgentStatusCode.STREAM_ING)
+    back = round_trip(delta)
+    assert back == delta
+    assert isinstance(back.state, AgentStatusCode)
+
+
+def test_node_finished_restores_detail():
+    detail = AgentReturn(state=AgentStatusCode.END, response='answer')
+    detail.type = 'searcher'
+    detail.content = 'sub question'
+    detail.actions = [
+        ActionReturn(args=dict(query='q'),
+                     type='google_search',
+                     result=[dict(type='text', content='[]')],
+                     state=ActionStatusCode.SUCCESS)
+    ]
+    # フィールドにない属性も戻る
+    detail.elapsed = 1.5
+
+    back = round_trip(NodeFinished('node', 'answer', detail)).detail
+
+    assert back == detail
+    assert (back.type, back.content, back.elapsed) == ('searcher',
+                                                       'sub question', 1.5)
+    assert isinstance(back.actions[0], ActionReturn)
+    assert back.actions[0].state is ActionStatusCode.SUCCESS
+    assert back.state is AgentStatusCode.END
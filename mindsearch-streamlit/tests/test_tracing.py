@@ -0,0 +1,102 @@
+import json
+
+import pytest
+
+from mindsearch.tracing import (NULL_SPAN, JsonLinesExporter, OTLPJsonExporter,
+                                Tracer)
+
+
+def record_tree(tracer):
+    """エージェントと同じ形のスパン木を記録する。
+
+    ``query`` の子にキュー待ちを持つ ``searcher_node``、その子に検索
+    （``google_search``）と LLM（``searcher_llm``）。
+    """
+    query = tracer.start_span('query', question='q')
+    with tracer.start_span('searcher_node', parent=query, node='a',
+                           queue_wait=0.25):
+        with tracer.start_span('google_search', query='q a') as search:
+            search.set(results=3)
+        llm = tracer.start_span('searcher_llm', question='a')
+        llm.mark_token(5)
+        llm.end()
+    query.end()
+    return query
+
+
+def read_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_jsonl_records_the_span_tree(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    query = record_tree(Tracer([JsonLinesExporter(path)]))
+
+    # 終わった順に 1 スパン 1 行
+    records = read_lines(path)
+    assert [r['name'] for r in records] == [
+        'google_search', 'searcher_llm', 'searcher_node', 'query'
+    ]
+    spans = {r['name']: r for r in records}
+    assert {r['trace_id'] for r in records} == {query.trace_id}
+    assert spans['query']['parent_id'] is None
+    node = spans['searcher_node']
+    assert node['parent_id'] == spans['query']['span_id']
+    assert spans['google_search']['parent_id'] == node['span_id']
+    assert spans['searcher_llm']['parent_id'] == node['span_id']
+    assert node['attributes'] == dict(node='a', queue_wait=0.25)
+    assert spans['google_search']['attributes'] == dict(query='q a',
+                                                        results=3)
+    llm = spans['searcher_llm']['attributes']
+    assert llm['tokens'] == 5 and llm['ttft'] >= 0
+    for record in records:
+        assert record['end'] - record['start'] == pytest.approx(
+            record['duration'])
+
+
+def test_otlp_records_the_span_tree(tmp_path):
+    path = str(tmp_path / 'trace.otlp.jsonl')
+    query = record_tree(Tracer([OTLPJsonExporter(path, service_name='svc')]))
+
+    spans = {}
+    for request in read_lines(path):
+        [resource] = request['resourceSpans']
+        assert resource['resource']['attributes'] == [
+            dict(key='service.name', value=dict(stringValue='svc'))
+        ]
+        [scope] = resource['scopeSpans']
+        assert scope['scope'] == dict(name='mindsearch')
+        [span] = scope['spans']
+        spans[span['name']] = span
+    assert {s['traceId'] for s in spans.values()} == {query.trace_id}
+    assert 'parentSpanId' not in spans['query']
+    node = spans['searcher_node']
+    assert node['parentSpanId'] == spans['query']['spanId']
+    assert spans['google_search']['parentSpanId'] == node['spanId']
+    assert spans['searcher_llm']['parentSpanId'] == node['spanId']
+    assert node['attributes'] == [
+        dict(key='node', value=dict(stringValue='a')),
+        dict(key='queue_wait', value=dict(doubleValue=0.25)),
+    ]
+    assert dict(key='results', value=dict(
+        intValue='3')) in spans['google_search']['attributes']
+    for span in spans.values():
+        assert span['status'] == dict(code=1)
+        assert int(span['endTimeUnixNano']) >= int(span['startTimeUnixNano'])
+
+
+def test_errors_and_disabled_tracer(tmp_path):
+    path = str(tmp_path / 'trace.otlp.jsonl')
+    tracer = Tracer([OTLPJsonExporter(path)])
+    with pytest.raises(ValueError):
+        with tracer.start_span('execute_code'):
+            raise ValueError('boom')
+    [request] = read_lines(path)
+    [span] = request['resourceSpans'][0]['scopeSpans'][0]['spans']
+    assert span['status'] == dict(code=2)
+    assert dict(key='error', value=dict(
+        stringValue="ValueError('boom')")) in span['attributes']
+
+    # エクスポーターがなければ何も記録しない
+    assert Tracer().start_span('query') is NULL_SPAN
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+from lagent.schema import AgentReturn
+
+from mindsearch.ui import FrameThrottle, StreamRenderer, tick_every
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def renderer():
+    renderer = StreamRenderer(fps=10)
+    renderer.throttle = FrameThrottle(10, clock=Clock())
+    renderer.drawn = []
+    renderer._render_response = lambda agent_return: renderer.drawn.append(
+        agent_return.response)
+    return renderer
+
+
+def test_throttled_frame_is_drawn_by_flush(renderer):
+    clock = renderer.throttle.clock
+    assert renderer.update(AgentReturn(response='a'))
+    assert not renderer.update(AgentReturn(response='ab'))
+    assert renderer.dirty
+    # 次の差分が来なくても、間隔が空いたら最後の状態を描く
+    assert not renderer.flush()
+    clock.now = 0.1
+    assert renderer.flush()
+    assert renderer.drawn == ['a', 'ab']
+    assert not renderer.dirty
+    assert not renderer.flush()
+
+
+def test_drawn_frame_clears_pending_state(renderer):
+    renderer.update(AgentReturn(response='a'))
+    renderer.update(AgentReturn(response='ab'))
+    renderer.update(AgentReturn(response='abc'), force=True)
+    assert not renderer.dirty
+    assert renderer.drawn == ['a', 'abc']
+
+
+def slow(items, delay):
+    for item in items:
+        time.sleep(delay)
+        yield item
+
+
+def test_tick_every_wakes_reader_between_items():
+    out = list(tick_every(slow('ab', 0.2), 0.05))
+    assert [item for item in out if item is not None] == ['a', 'b']
+    assert out.index('a') > 0 and None in out[out.index('a'):]
+
+
+def test_tick_every_without_interval_only_yields_items():
+    assert list(tick_every(slow('abc', 0.01), None)) == ['a', 'b', 'c']
+
+
+def test_tick_every_raises_source_errors():
+
+    def broken():
+        yield 'a'
+        raise ValueError('boom')
+
+    stream = tick_every(broken(), None)
+    assert next(stream) == 'a'
+    with pytest.raises(ValueError, match='boom'):
+        next(stream)
+
+
+def test_closing_reader_closes_source():
+    closed = threading.Event()
+
+    def source():
+        try:
+            while True:
+                yield 'x'
+                time.sleep(0.01)
+        finally:
+            closed.set()
+
+    stream = tick_every(source(), 0.05)
+    assert next(stream) == 'x'
+    stream.close()
+    assert closed.wait(2)